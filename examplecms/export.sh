@@ -0,0 +1,3 @@
+#!/bin/sh
+# run from parent directory
+django-admin.py export_pages --pythonpath=. --pythonpath=examplecms --settings=settings
@@ -0,0 +1,252 @@
+'''
+Static export of published pages.
+
+Each public Page is rendered with the same template as page_detail
+and written to <output_dir>/<slugs>/index.html.  A manifest (manifest.json)
+records which file belongs to which public page (and a hash of its content),
+so after a publish only the pages that were affected need re-rendering.
+Public pages that are deleted (when unpublished, or a deletion is published)
+have their files removed, and deleting a public block re-renders its page.
+'''
+import os
+import errno
+import tempfile
+from hashlib import sha1
+from multiprocessing.dummy import Pool
+
+from django.utils import simplejson as json
+from django.db.models.signals import post_delete
+from django.template.loader import render_to_string
+
+from publish.signals import post_publish_run, post_unpublish
+
+from models import Page, PageBlock, Image, Category
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _file_mode():
+    # mkstemp creates files only we can read, so give them the
+    # permissions open() would have (there's no way to read the
+    # umask without setting it)
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+def _write_atomic(path, content):
+    # write to a temp file in the same directory and then move
+    # it into place, so nobody sees a half-written file
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.export-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.chmod(tmp_path, _file_mode())
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+class StaticExporter(object):
+
+    template_name = 'pubcms/page_detail.html'
+
+    def __init__(self, output_dir, workers=4):
+        self.output_dir = output_dir
+        self.workers = workers
+        # public pages deleted, or that have had blocks deleted,
+        # since the last export
+        self._deleted_page_ids = set()
+        self._changed_page_ids = set()
+
+    def connect(self):
+        post_delete.connect(self._page_deleted, sender=Page, dispatch_uid='pubcms-export-pages')
+        post_delete.connect(self._block_deleted, sender=PageBlock, dispatch_uid='pubcms-export-blocks')
+        post_publish_run.connect(self._export_run, dispatch_uid='pubcms-export')
+        post_unpublish.connect(self._export_unpublished, dispatch_uid='pubcms-export-unpublish')
+
+    def disconnect(self):
+        post_delete.disconnect(sender=Page, dispatch_uid='pubcms-export-pages')
+        post_delete.disconnect(sender=PageBlock, dispatch_uid='pubcms-export-blocks')
+        post_publish_run.disconnect(dispatch_uid='pubcms-export')
+        post_unpublish.disconnect(dispatch_uid='pubcms-export-unpublish')
+
+    # manifest
+
+    def _manifest_path(self):
+        return os.path.join(self.output_dir, MANIFEST_NAME)
+
+    def load_manifest(self):
+        try:
+            f = open(self._manifest_path())
+        except IOError:
+            return {}
+        try:
+            return dict((int(pk), entry) for pk, entry in json.load(f).items())
+        finally:
+            f.close()
+
+    def _save_manifest(self, manifest):
+        _write_atomic(self._manifest_path(), json.dumps(manifest, indent=1, sort_keys=True))
+
+    # rendering
+
+    def _relative_path(self, page):
+        return os.path.join(*(page._get_all_slugs() + ['index.html']))
+
+    def _render(self, page):
+        content = render_to_string(self.template_name, {'page': page}).encode('utf-8')
+        return self._relative_path(page), content
+
+    def _render_page(self, page):
+        return (page,) + self._render(page)
+
+    def _write(self, manifest, page, relative_path, content):
+        digest = sha1(content).hexdigest()
+        entry = manifest.get(page.pk)
+        if entry and entry['path'] != relative_path:
+            self._remove_file(entry['path'])
+        if not entry or entry['path'] != relative_path or entry['sha1'] != digest:
+            _write_atomic(os.path.join(self.output_dir, relative_path), content)
+        manifest[page.pk] = {'path': relative_path, 'sha1': digest}
+
+    def _remove_file(self, relative_path):
+        try:
+            os.unlink(os.path.join(self.output_dir, relative_path))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        # tidy up any directories that are now empty
+        directory = os.path.dirname(relative_path)
+        while directory:
+            try:
+                os.rmdir(os.path.join(self.output_dir, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def export_pages(self, pages, deleted_page_ids=()):
+        '''
+        re-render the given public pages (and any below them whose path
+        has changed) and remove the files of deleted pages
+        '''
+        manifest = self.load_manifest()
+
+        for pk in deleted_page_ids:
+            entry = manifest.pop(pk, None)
+            if entry:
+                self._remove_file(entry['path'])
+
+        pending = list(pages)
+        seen = set()
+        while pending:
+            page = pending.pop()
+            if page.pk in seen:
+                continue
+            seen.add(page.pk)
+            relative_path, content = self._render(page)
+            entry = manifest.get(page.pk)
+            if entry and entry['path'] != relative_path:
+                # moved, so everything underneath has moved too
+                pending.extend(Page.objects.published().filter(parent=page))
+            self._write(manifest, page, relative_path, content)
+
+        self._save_manifest(manifest)
+        return len(seen)
+
+    def rebuild(self):
+        '''
+        render every published page (in parallel) and replace the manifest.
+        each page is written as soon as it's rendered, so only a few are
+        held in memory at once
+        '''
+        old_manifest = self.load_manifest()
+        pages = list(Page.objects.published().select_related('parent'))
+
+        manifest = {}
+        pool = Pool(self.workers)
+        try:
+            for page, relative_path, content in pool.imap_unordered(self._render_page, pages):
+                entry = old_manifest.pop(page.pk, None)
+                if entry:
+                    manifest[page.pk] = entry
+                self._write(manifest, page, relative_path, content)
+        finally:
+            pool.close()
+            pool.join()
+
+        # remove anything left over from pages that are no longer published
+        current_paths = set(entry['path'] for entry in manifest.values())
+        for entry in old_manifest.values():
+            if entry['path'] not in current_paths:
+                self._remove_file(entry['path'])
+
+        self._save_manifest(manifest)
+        return len(pages)
+
+    # publish hooks
+
+    def affected_pages(self, all_published, public_page_ids=()):
+        '''
+        the public pages that need re-rendering after the given (draft)
+        objects have been published, along with those in public_page_ids
+        '''
+        page_ids, block_ids, image_ids, category_ids = set(), set(), set(), set()
+        for instance in all_published:
+            if instance.pk is None:
+                # deleted
+                continue
+            if isinstance(instance, Page):
+                page_ids.add(instance.pk)
+            elif isinstance(instance, PageBlock):
+                block_ids.add(instance.pk)
+            elif isinstance(instance, Image):
+                image_ids.add(instance.pk)
+            elif isinstance(instance, Category):
+                category_ids.add(instance.pk)
+
+        published = Page.objects.published()
+        pages = {}
+        querysets = []
+        if public_page_ids:
+            querysets.append(published.filter(pk__in=public_page_ids))
+        if page_ids:
+            querysets.append(published.filter(draft__pk__in=page_ids))
+        if block_ids:
+            querysets.append(published.filter(pageblock__draft__pk__in=block_ids))
+        if image_ids:
+            querysets.append(published.filter(pageblock__image__draft__pk__in=image_ids))
+        if category_ids:
+            querysets.append(published.filter(categories__draft__pk__in=category_ids))
+        for queryset in querysets:
+            for page in queryset.distinct():
+                pages[page.pk] = page
+        return pages.values()
+
+    def _page_deleted(self, sender, instance, **kw):
+        if instance.is_public:
+            self._deleted_page_ids.add(instance.pk)
+
+    def _block_deleted(self, sender, instance, **kw):
+        if instance.is_public:
+            self._changed_page_ids.add(instance.page_id)
+
+    def _export_run(self, sender, all_published, **kw):
+        deleted_page_ids, self._deleted_page_ids = self._deleted_page_ids, set()
+        changed_page_ids, self._changed_page_ids = self._changed_page_ids, set()
+        self.export_pages(self.affected_pages(all_published, changed_page_ids - deleted_page_ids),
+                          deleted_page_ids)
+
+    def _export_unpublished(self, sender, instance, **kw):
+        self._export_run(sender, [])
@@ -0,0 +1,29 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pubcms.export import StaticExporter
+
+
+class Command(BaseCommand):
+    help = 'Render every published page to static files (a full rebuild).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='Directory to write to. Defaults to settings.PUBCMS_EXPORT_ROOT.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of pages to render in parallel.'),
+    )
+
+    def handle(self, **options):
+        output = options.get('output') or getattr(settings, 'PUBCMS_EXPORT_ROOT', None)
+        if not output:
+            raise CommandError('Please give an --output directory or set PUBCMS_EXPORT_ROOT')
+
+        started = time.time()
+        exporter = StaticExporter(output, workers=options.get('workers') or 1)
+        count = exporter.rebuild()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Exported %d pages to %s in %.1fs\n' % (count, output, time.time() - started))
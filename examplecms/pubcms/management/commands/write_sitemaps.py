@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from pubcms.sitemaps import get_sitemap
+
+
+class Command(NoArgsCommand):
+    help = 'Write the sitemap files for every published page (a full rebuild).'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dirty', action='store_true', dest='dirty', default=False,
+            help='Only rewrite the sections that have had pages published since they were last written.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not getattr(settings, 'PUBCMS_SITEMAP_ROOT', None):
+            raise CommandError('Please set PUBCMS_SITEMAP_ROOT')
+
+        started = time.time()
+        if options.get('dirty'):
+            get_sitemap().generate_dirty()
+        else:
+            get_sitemap().generate()
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Wrote sitemaps to %s in %.1fs\n' % (settings.PUBCMS_SITEMAP_ROOT, time.time() - started))
@@ -1,18 +1,26 @@
 from django.db import models
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse as reverse_url
-from publish.models import Publishable
+from publish.models import Publishable, TimestampedPublishable
 
-class Page(Publishable):
+class Page(TimestampedPublishable):
     title = models.CharField(max_length=200)
     slug  = models.CharField(max_length=100, db_index=True)
     
     parent = models.ForeignKey('self', blank=True, null=True)
+    # slugs of this page and its parents, joined with '/' - kept
+    # up to date on save so urls don't need each parent loading
+    path = models.CharField(max_length=255, blank=True, editable=False, db_index=True)
 
     categories = models.ManyToManyField('Category', blank=True)
 
     class PublishMeta(Publishable.PublishMeta):
         publish_reverse_fields=['pageblock_set']
 
+    def __init__(self, *arg, **kw):
+        super(Page, self).__init__(*arg, **kw)
+        self._saved_path = self.path
+
     def __unicode__(self):
         return self.title
 
@@ -23,8 +31,47 @@ class Page(Publishable):
         slugs.append(self.slug)
         return slugs
 
+    def _compute_path(self):
+        if self.parent:
+            return '%s/%s' % (self.parent.path, self.slug)
+        return self.slug
+
+    def clean(self):
+        # the slugs are joined into path, which has to fit - as do
+        # the paths of any pages below this one that would change
+        path = self._compute_path()
+        longest = len(path)
+        if self.pk and self._saved_path and path != self._saved_path:
+            descendants = Page.objects.filter(is_public=self.is_public, path__startswith=self._saved_path + '/')
+            for descendant_path in descendants.values_list('path', flat=True):
+                longest = max(longest, len(descendant_path) - len(self._saved_path) + len(path))
+        max_length = self._meta.get_field('path').max_length
+        if longest > max_length:
+            raise ValidationError('Page paths are limited to %d characters, this would make one %d long'
+                                  % (max_length, longest))
+
+    def save(self, *arg, **kw):
+        self.path = self._compute_path()
+        super(Page, self).save(*arg, **kw)
+        if self.path != self._saved_path:
+            self._update_descendant_paths()
+            self._saved_path = self.path
+
+    def _update_descendant_paths(self):
+        # a level at a time - the children (in the same draft or public
+        # tree) are updated directly, so drafts aren't marked as changed
+        parents = {self.pk: self.path}
+        while parents:
+            children = Page.objects.filter(parent__in=parents.keys()).values_list('pk', 'parent', 'slug')
+            next_parents = {}
+            for pk, parent_id, slug in children:
+                path = '%s/%s' % (parents[parent_id], slug)
+                Page.objects.filter(pk=pk).update(path=path, mark_changed=False)
+                next_parents[pk] = path
+            parents = next_parents
+
     def get_absolute_url(self):
-        url = '/'.join(self._get_all_slugs())
+        url = self.path
         if self.is_public:
             return reverse_url('public_page_detail', args=[url])
         else:
@@ -48,3 +95,19 @@ class Category(Publishable):
 
     def __unicode__(self):
         return self.name
+
+
+from django.conf import settings
+
+if getattr(settings, 'PUBCMS_EXPORT_ROOT', None):
+    # keep the static export up to date as pages are published
+    from pubcms.export import StaticExporter
+    static_exporter = StaticExporter(settings.PUBCMS_EXPORT_ROOT)
+    static_exporter.connect()
+
+if getattr(settings, 'PUBCMS_SITEMAP_ROOT', None):
+    # mark the sitemap sections for whatever gets published as
+    # needing rewriting (by write_sitemaps --dirty)
+    from pubcms.sitemaps import get_sitemap
+    sitemap = get_sitemap()
+    sitemap.connect()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+from publish.sitemaps import StreamingSitemap, SitemapSection
+
+from models import Page
+
+
+class PageSection(SitemapSection):
+    changefreq = 'weekly'
+
+    url_prefix = None
+
+    def __init__(self):
+        super(PageSection, self).__init__('pages', Page, 'path', lastmod_field='published_at')
+
+    def location(self, path):
+        if self.url_prefix is None:
+            # every page url is the same apart from the path, so only reverse once
+            self.url_prefix = reverse('public_page_detail', args=[''])
+        return self.url_prefix + path
+
+
+def get_sitemap():
+    return StreamingSitemap(settings.PUBCMS_SITEMAP_ROOT, settings.PUBCMS_SITEMAP_BASE_URL, [PageSection()],
+                            sitemap_url=getattr(settings, 'PUBCMS_SITEMAP_URL', None))
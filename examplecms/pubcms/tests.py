@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import ValidationError
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+
+from pubcms.models import Page, PageBlock
+from pubcms.export import StaticExporter
+from pubcms.views import page_detail
+
+
+class TestStaticExporter(TransactionTestCase):
+
+    def setUp(self):
+        super(TestStaticExporter, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.exporter = StaticExporter(self.output_dir)
+        self.exporter.connect()
+
+        self.home = Page.objects.create(title='Home', slug='home')
+        self.about = Page.objects.create(title='About', slug='about', parent=self.home)
+        self.block = PageBlock.objects.create(page=self.about, content='about block')
+        self.about.publish()
+
+    def tearDown(self):
+        self.exporter.disconnect()
+        shutil.rmtree(self.output_dir)
+        super(TestStaticExporter, self).tearDown()
+
+    def _path(self, *slugs):
+        return os.path.join(self.output_dir, *(slugs + ('index.html',)))
+
+    def _read(self, *slugs):
+        f = open(self._path(*slugs))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_publish_exports_pages(self):
+        self.failUnless('about block' in self._read('home', 'about'))
+        self.failUnless(os.path.exists(self._path('home')))
+        public_ids = set(Page.objects.published().values_list('pk', flat=True))
+        self.failUnlessEqual(public_ids, set(self.exporter.load_manifest().keys()))
+
+    def test_exported_files_readable(self):
+        umask = os.umask(022)
+        try:
+            self.exporter.export_pages(Page.objects.published())
+        finally:
+            os.umask(umask)
+        self.failUnlessEqual(0644, os.stat(self._path('home', 'about')).st_mode & 0777)
+        self.failUnlessEqual(0644, os.stat(os.path.join(self.output_dir, 'manifest.json')).st_mode & 0777)
+
+    def test_publish_block_rerenders_page(self):
+        block = PageBlock.objects.get(pk=self.block.pk)
+        block.content = 'changed block'
+        block.save()
+        block.publish()
+        self.failUnless('changed block' in self._read('home', 'about'))
+
+    def test_unpublish_removes_file(self):
+        about = Page.objects.get(pk=self.about.pk)
+        about.unpublish()
+        self.failIf(os.path.exists(self._path('home', 'about')))
+        self.failIf(os.path.exists(os.path.join(self.output_dir, 'home', 'about')))
+        self.failUnless(os.path.exists(self._path('home')))
+        self.failUnlessEqual(1, len(self.exporter.load_manifest()))
+
+    def test_published_deletion_removes_files(self):
+        home = Page.objects.get(pk=self.home.pk)
+        home.delete()
+        home.publish()
+        self.failUnlessEqual(['manifest.json'], os.listdir(self.output_dir))
+        self.failUnlessEqual({}, self.exporter.load_manifest())
+
+    def test_deleted_block_rerenders_page(self):
+        block = PageBlock.objects.get(pk=self.block.pk)
+        block.delete()
+        block.publish()
+        self.failUnlessEqual(0, PageBlock.objects.published().count())
+        self.failIf('about block' in self._read('home', 'about'))
+
+    def test_moved_page_moves_descendants(self):
+        home = Page.objects.get(pk=self.home.pk)
+        home.slug = 'start'
+        home.save()
+        home.publish()
+        self.failUnless('about block' in self._read('start', 'about'))
+        self.failIf(os.path.exists(os.path.join(self.output_dir, 'home')))
+
+
+class TestPageDetail(TransactionTestCase):
+
+    def setUp(self):
+        super(TestPageDetail, self).setUp()
+        self.page = Page.objects.create(title='Home', slug='home')
+        self.block = PageBlock.objects.create(page=self.page, content='home block')
+        self.page.publish()
+
+    def _get(self):
+        return page_detail(RequestFactory().get('/home'), 'home', Page.objects.published()).content
+
+    def test_published_changes_shown(self):
+        self.failUnless('home block' in self._get())
+        page = Page.objects.get(pk=self.page.pk)
+        page.title = 'Changed'
+        page.save()
+        block = PageBlock.objects.get(pk=self.block.pk)
+        block.content = 'changed block'
+        block.save()
+        page.publish()
+        content = self._get()
+        self.failUnless('Changed' in content)
+        self.failUnless('changed block' in content)
+
+
+class TestPagePath(TransactionTestCase):
+
+    def setUp(self):
+        super(TestPagePath, self).setUp()
+        self.home = Page.objects.create(title='Home', slug='home')
+        self.child = Page.objects.create(title='Child', slug='c' * 100, parent=self.home)
+        self.grandchild = Page.objects.create(title='Grandchild', slug='g' * 100, parent=self.child)
+
+    def test_long_path_rejected(self):
+        page = Page(title='Too deep', slug='x' * 100, parent=self.grandchild)
+        self.failUnlessRaises(ValidationError, page.clean)
+
+    def test_move_lengthening_descendant_rejected(self):
+        self.home.slug = 'h' * 60
+        self.failUnlessRaises(ValidationError, self.home.clean)
+        self.home.slug = 'homepage'
+        self.home.clean()
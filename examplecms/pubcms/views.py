@@ -1,7 +1,27 @@
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
+from django.template.loader import render_to_string
+
+from publish.models import get_publish_version, versioning_cache, PUBLISH_VERSION_TIMEOUT
+from publish.conditional import conditional_response
 
 from models import Page
 
+def _render_public_page(page):
+    if not versioning_cache():
+        # nothing gives the page a new version when it's published
+        return render_to_response("pubcms/page_detail.html", { 'page': page })
+    # public pages only change when they (or something they show) are
+    # published, which gives them a new version - so the cached copy
+    # never needs to expire
+    key = 'pubcms:page_detail:%d:%s' % (page.pk, get_publish_version(page))
+    content = cache.get(key)
+    if content is None:
+        content = render_to_string("pubcms/page_detail.html", { 'page': page })
+        cache.set(key, content, PUBLISH_VERSION_TIMEOUT)
+    return HttpResponse(content)
+
 def page_detail(request, page_url, queryset):
     parts = page_url.split('/')
     parts.reverse()
@@ -12,4 +32,6 @@ def page_detail(request, page_url, queryset):
         field = 'parent__%s' % field
     page = get_object_or_404(queryset,**filter_params)
     
+    if page.is_public:
+        return conditional_response(request, page, lambda: _render_public_page(page))
     return render_to_response("pubcms/page_detail.html", { 'page': page })
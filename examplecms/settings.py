@@ -46,6 +46,22 @@ MEDIA_ROOT = os.path.join(PROJECT_PATH, 'media')
 # Examples: "http://media.lawrence.com"
 MEDIA_URL = '/media/'
 
+# Directory published pages are exported to as static files
+# (see pubcms/export.py). Leave unset to disable exporting.
+# PUBCMS_EXPORT_ROOT = os.path.join(PROJECT_PATH, 'static_export')
+
+# Directory sitemaps are written to (see pubcms/sitemaps.py), the
+# site's url and where the sitemap files are served from.  Leave
+# PUBCMS_SITEMAP_ROOT unset to not write sitemaps.
+# PUBCMS_SITEMAP_ROOT = os.path.join(MEDIA_ROOT, 'sitemaps')
+# PUBCMS_SITEMAP_BASE_URL = 'http://localhost:8000'
+# PUBCMS_SITEMAP_URL = 'http://localhost:8000/media/sitemaps'
+
+# uncomment to cache public page renders until the page (or
+# something on it) is published again - see pubcms/views.py
+# PUBLISH_CACHE_VERSIONS = True
+# PUBLISH_TRACK_DEPENDENCIES = True
+
 # URL prefix for admin media -- CSS, JavaScript and images. Make sure to use a
 # trailing slash.
 # Examples: "http://foo.com/media/", "/media/".
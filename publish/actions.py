@@ -12,8 +12,9 @@ from django.utils.text import capfirst
 from django.utils.translation import ugettext as _
 from django.contrib.admin.actions import delete_selected as django_delete_selected
 
-from models import Publishable
-from utils import NestedSet
+from models import Publishable, VersionedPublishable, _now
+from utils import NestedSet, CompactNestedSet
+from estimate import estimate_publish, _reachable_models
 
 def _get_change_view_url(app_label, object_name, pk, levels_to_root):
     return '%s%s/%s/%s/' % ('../'*levels_to_root, app_label,
@@ -64,6 +65,9 @@ def _to_html(admin_site, items):
     for value in items:
         if isinstance(value, Publishable):
             html_value = _get_publishable_html(admin_site, levels_to_root, value)
+        elif isinstance(value, type):
+            # a whole model (see _check_model_permissions)
+            html_value = escape(capfirst(value._meta.verbose_name_plural))
         else:
             html_value = _to_html(admin_site, value)
         html_list.append(html_value)
@@ -84,27 +88,81 @@ def _check_permissions(modeladmin, all_published, request, perms_needed):
                 perms_needed.append(instance)
 
 
+def _check_model_permissions(modeladmin, models, request, perms_needed):
+    # for a publish too big to visit every object first - check
+    # each model it could publish anything of instead
+    admin_site = modeladmin.admin_site
+
+    for model in models:
+        other_modeladmin = admin_site._registry.get(model,None)
+        if other_modeladmin:
+            if not other_modeladmin.has_publish_permission(request):
+                perms_needed.append(model)
+
+
 def _root_path(admin_site):
     # root_path attrib not present in Django 1.4
     return getattr(admin_site, 'root_path', None)
 
 
+def _lock_for_publish(modeladmin, queryset):
+    # versioned models detect concurrent changes themselves,
+    # so don't need to hold row locks while we publish
+    if issubclass(modeladmin.model, VersionedPublishable):
+        return queryset
+    return queryset.select_for_update()
+
+
+def _dry_run_bounded(modeladmin):
+    return modeladmin.dry_run_max_nodes is not None or modeladmin.dry_run_max_seconds is not None
+
+
+def _publish_in_background(modeladmin, request, queryset):
+    # the publish_scheduled command will pick these up
+    now = _now()
+    n = 0
+    for obj in queryset:
+        obj.publish_at(now)
+        modeladmin.log_publication(request, obj, message="Scheduled to be published")
+        n += 1
+    modeladmin.message_user(request, _("Scheduled %(count)d %(items)s to be published in the background.") % {
+        "count": n, "items": model_ngettext(modeladmin.opts, n)
+    })
+
+
 def publish_selected(modeladmin, request, queryset):
-    queryset = queryset.select_for_update()
     opts = modeladmin.model._meta
     app_label = opts.app_label
     
-    all_published = NestedSet()
-    for obj in queryset:
-        obj.publish(dry_run=True, all_published=all_published)
+    queryset = _lock_for_publish(modeladmin, queryset)
+
+    estimate = None
+    if _dry_run_bounded(modeladmin):
+        estimate = estimate_publish(queryset, modeladmin.dry_run_max_nodes,
+                                    modeladmin.dry_run_max_seconds, compact=modeladmin.compact_dry_run)
+        all_published = estimate.all_published
+    else:
+        if modeladmin.compact_dry_run:
+            all_published = CompactNestedSet()
+        else:
+            all_published = NestedSet()
+        for obj in queryset:
+            obj.publish(dry_run=True, all_published=all_published)
 
     perms_needed = []
     _check_permissions(modeladmin, all_published, request, perms_needed)
+    if estimate is not None and not estimate.complete:
+        # the objects the estimate didn't get to haven't been checked
+        _check_model_permissions(modeladmin, _reachable_models(modeladmin.model), request, perms_needed)
     
     if request.POST.get('post'):
         if perms_needed:
             raise PermissionDenied
 
+        if estimate is not None and not estimate.complete:
+            _publish_in_background(modeladmin, request, queryset)
+            return None
+
         n = queryset.count()
         if n:
             for object in all_published:
@@ -125,6 +183,7 @@ def publish_selected(modeladmin, request, queryset):
         "object_name": force_unicode(opts.verbose_name),
         "all_published": _convert_all_published_to_html(admin_site, all_published),
         "perms_lacking": _to_html(admin_site, perms_needed),
+        "estimate": estimate,
         'queryset': queryset,
         "opts": opts,
         "root_path": _root_path(admin_site),
@@ -141,7 +200,7 @@ def publish_selected(modeladmin, request, queryset):
 
 
 def unpublish_selected(modeladmin, request, queryset):
-    queryset = queryset.select_for_update()
+    queryset = _lock_for_publish(modeladmin, queryset)
 
     opts = modeladmin.model._meta
     app_label = opts.app_label
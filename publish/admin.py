@@ -4,8 +4,9 @@ from django.utils.encoding import force_unicode
 from django.http import Http404, HttpResponseRedirect
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse as reverse_url
+from django.db.models.query import QuerySet
 
-from .models import Publishable
+from .models import Publishable, _chunked
 from .actions import publish_selected, unpublish_selected, delete_selected, undelete_selected
 
 from publish.filters import register_filters
@@ -60,6 +61,14 @@ class PublishableAdmin(admin.ModelAdmin):
     publish_confirmation_template = None
     unpublish_confirmation_template = None
     deleted_form_template = None
+    # only keep keys (not instances) of the objects found
+    # during the dry run for the publish confirmation page
+    compact_dry_run = False
+    # stop the confirmation page's dry run after this many objects or
+    # seconds (None for no limit) - publishes too big to finish it are
+    # scheduled to happen in the background instead
+    dry_run_max_nodes = None
+    dry_run_max_seconds = None
     
     list_display = ['__unicode__', 'publish_state']
     list_filter = ['publish_state']
@@ -158,13 +167,38 @@ class PublishableBaseInlineFormSet(BaseInlineFormSet):
     # just marking them for deletion, as they are like
     # an edit to their parent
     
+    # (the deleted objects are removed together, in chunks this size)
+    delete_batch_size = 500
+
     def save_existing_objects(self, commit=True):
         saved_instances = super(PublishableBaseInlineFormSet, self).save_existing_objects(commit=commit)
-        for obj in self.deleted_objects:
-            if obj.pk is not None:
-                obj.delete(mark_for_deletion=False)
+        self.delete_existing_objects(self.deleted_objects)
         return saved_instances
 
+    def delete_existing(self, obj, commit=True):
+        # called for each deleted object by newer versions of django -
+        # they are all deleted together by save_existing_objects instead
+        pass
+
+    def save_existing(self, form, instance, commit=True):
+        obj = form.save(commit=False)
+        if commit:
+            # we know it exists, so skip django's check for it
+            obj.save(force_update=True)
+            form.save_m2m()
+        return obj
+
+    def delete_existing_objects(self, objects):
+        pks_by_db = {}
+        for obj in objects:
+            # django 1.4 has already deleted (or marked for deletion) each one
+            if obj.pk is not None:
+                pks_by_db.setdefault(obj._state.db, []).append(obj.pk)
+        for using, pks in pks_by_db.items():
+            for chunk in _chunked(pks, self.delete_batch_size):
+                # a plain queryset, so one delete (and collector pass) per chunk
+                QuerySet(self.model).using(using).filter(pk__in=chunk).delete()
+
 
 class PublishableStackedInline(admin.StackedInline):
     formset = PublishableBaseInlineFormSet
@@ -0,0 +1,87 @@
+'''
+Conditional GET support for public copies of TimestampedPublishable models.
+
+The ETag and Last-Modified values come from the publish_version and
+published_at fields of the (already loaded) object, so no extra queries
+are needed:
+
+    def page_detail(request, slug):
+        page = get_object_or_404(Page.objects.published(), slug=slug)
+        return conditional_response(request, page,
+                                    lambda: render_to_response('page.html', {'page': page}))
+'''
+from calendar import timegm
+
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+
+from models import TimestampedPublishable
+
+
+def _has_publish_info(obj):
+    return isinstance(obj, TimestampedPublishable) and obj.is_public and obj.published_at is not None
+
+def publish_etag(obj):
+    '''the (unquoted) ETag for a public object, or None'''
+    if not _has_publish_info(obj):
+        return None
+    opts = obj._meta
+    return '%s.%s-%s-%s' % (opts.app_label, opts.object_name.lower(), obj.pk, obj.publish_version)
+
+def publish_last_modified(obj):
+    '''when a public object was last published, as a timestamp, or None'''
+    if not _has_publish_info(obj):
+        return None
+    published_at = obj.published_at
+    if timezone.is_naive(published_at):
+        # stored in local time (USE_TZ is off)
+        published_at = timezone.make_aware(published_at, timezone.get_current_timezone())
+    return timegm(published_at.utctimetuple())
+
+def not_modified(request, obj):
+    '''
+    a 304 response if the client already has the current
+    version of obj, otherwise None
+    '''
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    etag = publish_etag(obj)
+    if etag is None:
+        return None
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if etag in etags or '*' in etags:
+            return set_publish_headers(HttpResponseNotModified(), obj)
+        # if the etag doesn't match the date doesn't matter
+        return None
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        if if_modified_since and publish_last_modified(obj) <= if_modified_since:
+            return set_publish_headers(HttpResponseNotModified(), obj)
+    return None
+
+def set_publish_headers(response, obj):
+    '''add ETag and Last-Modified headers for obj to the response'''
+    etag = publish_etag(obj)
+    if etag is not None:
+        if not response.has_header('ETag'):
+            response['ETag'] = quote_etag(etag)
+        if not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_date(publish_last_modified(obj))
+    return response
+
+def conditional_response(request, obj, render):
+    '''
+    return a 304 if the client's copy of obj is current, otherwise
+    call render() for the response - either way with ETag and
+    Last-Modified headers for obj
+    '''
+    response = not_modified(request, obj)
+    if response is None:
+        response = set_publish_headers(render(), obj)
+    return response
@@ -0,0 +1,194 @@
+'''
+Bounded dry runs.
+
+A dry run visits everything a publish would, which for a big graph can
+take as long as the publish itself.  estimate_publish() does the dry run
+within a budget of objects and/or seconds.  If it finishes in time the
+counts are exact, otherwise the objects of each model that it didn't get
+to are estimated from count queries (of the drafts that have changes to
+publish) - for the related models those count the whole table, so are
+upper bounds.  Either way it predicts how many queries the real publish will
+run and how long it will take:
+
+    estimate = estimate_publish(Page.objects.filter(pk__in=ids), max_nodes=1000, max_seconds=2)
+    if estimate.complete:
+        ...
+'''
+import time
+
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.fields.related import RelatedField
+from django.contrib.contenttypes.models import ContentType
+
+from models import Publishable
+from utils import NestedSet, CompactNestedSet
+from metrics import _QueryCounter
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class _BudgetMixin(object):
+    # stops the dry run (by raising BudgetExceeded) when
+    # another object would take it over budget
+
+    max_nodes = None
+    deadline = None
+
+    def add(self, item, parent=None):
+        if self.max_nodes is not None and len(self) >= self.max_nodes:
+            raise BudgetExceeded()
+        if self.deadline is not None and time.time() > self.deadline:
+            raise BudgetExceeded()
+        super(_BudgetMixin, self).add(item, parent=parent)
+
+
+class BudgetedNestedSet(_BudgetMixin, NestedSet):
+    pass
+
+
+class BudgetedCompactNestedSet(_BudgetMixin, CompactNestedSet):
+    pass
+
+
+def _reachable_models(model):
+    '''
+    the publishable models a publish of model can reach
+    (through foreign keys, many-to-many and reverse fields)
+    '''
+    models, pending = [], [model]
+    while pending:
+        current = pending.pop()
+        if current in models or not (isinstance(current, type) and issubclass(current, Publishable)):
+            continue
+        models.append(current)
+        excluded_fields = current.PublishMeta.excluded_fields()
+        for field in current._meta.fields + current._meta.many_to_many:
+            if field.name in excluded_fields or field.name == 'public':
+                continue
+            if isinstance(field, RelatedField):
+                pending.append(field.rel.to)
+                through = getattr(field.rel, 'through', None)
+                if through is not None and not isinstance(through, basestring):
+                    pending.append(through)
+        reverse_fields = current.PublishMeta.reverse_fields_to_publish()
+        for related in current._meta.get_all_related_objects():
+            if related.get_accessor_name() in reverse_fields:
+                pending.append(related.model)
+    return models
+
+
+def _needs_publishing(queryset):
+    return queryset.filter(is_public=False).filter(
+        Q(publish_state__in=(Publishable.PUBLISH_CHANGED, Publishable.PUBLISH_DELETE)) |
+        Q(public__isnull=True))
+
+
+def _count_by_model(all_published):
+    counts = {}
+    if hasattr(all_published, 'keys'):
+        for content_type_id, pk in all_published.keys():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            counts[model] = counts.get(model, 0) + 1
+    else:
+        for item in all_published:
+            counts[item.__class__] = counts.get(item.__class__, 0) + 1
+    return counts
+
+
+class DryRunEstimate(object):
+    '''
+    the result of estimate_publish.  models is a list of (model, count,
+    exact) and all_published holds the objects the dry run got to - which
+    is everything if it is complete.  the counts of the models in
+    upper_bounds (and so changed) may be too high
+    '''
+    # a publish runs roughly this many more queries than a dry run for
+    # each object with changes (saving the public and draft copies)
+    write_queries_per_node = 4
+
+    def __init__(self, all_published, complete, models, dry_run_queries, dry_run_seconds, changed,
+                 upper_bounds=()):
+        self.all_published = all_published
+        self.complete = complete
+        self.models = models
+        self.dry_run_queries = dry_run_queries
+        self.dry_run_seconds = dry_run_seconds
+        self.changed = changed
+        self.upper_bounds = set(upper_bounds)
+
+    @property
+    def nodes(self):
+        return sum(count for model, count, exact in self.models)
+
+    @property
+    def model_counts(self):
+        '''(verbose_name_plural, count, exact, upper_bound) for each model - for templates'''
+        return [(model._meta.verbose_name_plural, count, exact, model in self.upper_bounds)
+                for model, count, exact in self.models]
+
+    @property
+    def queries(self):
+        '''the number of queries the publish is expected to run'''
+        visited = len(self.all_published) or 1
+        read_queries = self.dry_run_queries * self.nodes / float(visited)
+        return int(round(read_queries + self.write_queries_per_node * self.changed))
+
+    @property
+    def seconds(self):
+        '''how long the publish is expected to take'''
+        if not self.dry_run_queries:
+            return self.dry_run_seconds
+        return self.queries * self.dry_run_seconds / self.dry_run_queries
+
+
+def estimate_publish(queryset, max_nodes=None, max_seconds=None, compact=False):
+    '''
+    dry run publishing the (draft) objects in queryset, stopping once
+    max_nodes objects have been visited or max_seconds have passed
+    '''
+    if compact:
+        all_published = BudgetedCompactNestedSet()
+    else:
+        all_published = BudgetedNestedSet()
+    all_published.max_nodes = max_nodes
+    started = time.time()
+    if max_seconds is not None:
+        all_published.deadline = started + max_seconds
+
+    counter = _QueryCounter()
+    complete = True
+    try:
+        for obj in queryset:
+            obj.publish(dry_run=True, all_published=all_published)
+    except BudgetExceeded:
+        complete = False
+    finally:
+        dry_run_queries = counter.stop()
+    dry_run_seconds = time.time() - started
+    all_published.max_nodes = all_published.deadline = None
+
+    visited = _count_by_model(all_published)
+    upper_bounds = []
+    if complete:
+        models = [(model, count, True) for model, count in visited.items()]
+        changed = sum(1 for obj in all_published if obj._changes_need_publishing()
+                                                    or obj.publish_state == Publishable.PUBLISH_DELETE)
+    else:
+        models, changed = [], 0
+        for model in _reachable_models(queryset.model):
+            if model is queryset.model:
+                pending = _needs_publishing(QuerySet(model).filter(pk__in=queryset.values('pk'))).count()
+            else:
+                # could be any of them
+                pending = _needs_publishing(QuerySet(model)).count()
+                upper_bounds.append(model)
+            changed += pending
+            count = max(pending, visited.get(model, 0))
+            if count:
+                models.append((model, count, False))
+
+    models.sort(key=lambda m: (m[0]._meta.app_label, m[0]._meta.object_name))
+    return DryRunEstimate(all_published, complete, models, dry_run_queries, dry_run_seconds, changed, upper_bounds)
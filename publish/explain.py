@@ -0,0 +1,196 @@
+'''
+Query plans for slow publishes.
+
+Set PUBLISH_EXPLAIN_THRESHOLD (in seconds) and every SQL statement run
+inside a publish run or unpublish is recorded.  Once the run has finished
+any statement that took longer than the threshold is EXPLAINed and a
+QueryReport, with the statements grouped by the table they touched, is
+logged to the "publish.explain" logger and kept (the last few per process)
+for recent_reports():
+
+    from publish.explain import recent_reports
+    print recent_reports()[-1].as_text()
+
+This is a debugging aid - recording statements and explaining them
+afterwards makes publishing slower.
+'''
+import re
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.db.backends.util import CursorDebugWrapper
+
+
+logger = logging.getLogger('publish.explain')
+logger.addHandler(logging.NullHandler())
+
+REPORTS_KEPT = 20
+_reports = deque(maxlen=REPORTS_KEPT)
+
+
+def get_explain_threshold():
+    '''
+    statements taking longer than this many seconds are explained, or
+    None (the default) to not record statements at all
+    '''
+    return getattr(settings, 'PUBLISH_EXPLAIN_THRESHOLD', None)
+
+
+_table_re = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+["`]?([\w.]+)', re.IGNORECASE)
+
+def _table(sql):
+    match = _table_re.search(sql)
+    return match.group(1) if match else None
+
+
+class Statement(object):
+
+    def __init__(self, alias, sql, params, duration, many=False):
+        self.alias = alias
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.many = many
+        self.table = _table(sql)
+        self.plan = None
+
+    def explain(self, connection):
+        '''
+        fetch the query plan for this statement, where the
+        backend can explain it without running it
+        '''
+        vendor = connection.vendor
+        verb = self.sql.lstrip().split(None, 1)[0].upper()
+        if self.many or verb not in ('SELECT', 'UPDATE', 'DELETE'):
+            return
+        if vendor == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        elif vendor == 'postgresql' or (vendor == 'mysql' and verb == 'SELECT'):
+            prefix = 'EXPLAIN '
+        else:
+            return
+        cursor = connection.cursor()
+        try:
+            cursor.execute(prefix + self.sql, self.params)
+            self.plan = '\n'.join(' '.join(unicode(c) for c in row) for row in cursor.fetchall())
+        except DatabaseError, e:
+            self.plan = 'could not explain: %s' % e
+
+
+class QueryReport(object):
+    '''
+    the statements run by one publish run (or unpublish)
+    '''
+
+    def __init__(self, model, action, threshold):
+        self.model = model
+        self.action = action
+        self.threshold = threshold
+        self.statements = []
+        self.failed = False
+        self.duration = 0.0
+
+    @property
+    def slow_statements(self):
+        return [s for s in self.statements if s.duration > self.threshold]
+
+    def by_table(self):
+        '''the statements, as a list of (table, statements) - slowest total first'''
+        tables = {}
+        for statement in self.statements:
+            tables.setdefault(statement.table, []).append(statement)
+        return sorted(tables.items(), key=lambda item: -sum(s.duration for s in item[1]))
+
+    def explain(self):
+        for statement in self.slow_statements:
+            statement.explain(connections[statement.alias])
+
+    def as_text(self):
+        opts = self.model._meta
+        lines = ['%s of %s.%s: %d statements in %.3fs%s (explaining those over %.3fs)' %
+                 (self.action, opts.app_label, opts.object_name, len(self.statements),
+                  self.duration, ' - failed' if self.failed else '', self.threshold)]
+        for table, statements in self.by_table():
+            lines.append('')
+            lines.append('%s: %d statements in %.3fs' % (table, len(statements), sum(s.duration for s in statements)))
+            for statement in statements:
+                lines.append('  (%.3fs) [%s] %s; args=%r' % (statement.duration, statement.alias,
+                                                             statement.sql, statement.params))
+                if statement.plan:
+                    lines.extend('      ' + line for line in statement.plan.splitlines())
+        return '\n'.join(lines) + '\n'
+
+
+def recent_reports():
+    '''the most recent QueryReports made in this process, oldest first'''
+    return list(_reports)
+
+
+class _RecordingCursor(CursorDebugWrapper):
+
+    def __init__(self, cursor, db, statements):
+        super(_RecordingCursor, self).__init__(cursor, db)
+        self.statements = statements
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return super(_RecordingCursor, self).execute(sql, params)
+        finally:
+            self.statements.append(Statement(self.db.alias, sql, params, time.time() - start))
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(_RecordingCursor, self).executemany(sql, param_list)
+        finally:
+            self.statements.append(Statement(self.db.alias, sql, param_list, time.time() - start, many=True))
+
+
+_local = threading.local()
+
+@contextmanager
+def explained_run(model, action='publish', enabled=True):
+    '''
+    record the statements run inside the with block and report on
+    them.  does nothing if PUBLISH_EXPLAIN_THRESHOLD isn't set or a run
+    is already being recorded
+    '''
+    threshold = get_explain_threshold()
+    if not enabled or threshold is None or getattr(_local, 'report', None) is not None:
+        yield None
+        return
+    report = _local.report = QueryReport(model, action, threshold)
+    patched = []
+    for connection in connections.all():
+        patched.append((connection, connection.use_debug_cursor, len(connection.queries)))
+        connection.use_debug_cursor = True
+        connection.make_debug_cursor = \
+            lambda cursor, connection=connection: _RecordingCursor(cursor, connection, report.statements)
+    started = time.time()
+    try:
+        yield report
+    except:
+        report.failed = True
+        raise
+    finally:
+        report.duration = time.time() - started
+        for connection, use_debug_cursor, start in patched:
+            del connection.make_debug_cursor
+            connection.use_debug_cursor = use_debug_cursor
+            if not (use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)):
+                del connection.queries[start:]
+        _local.report = None
+        if not report.failed:
+            # a failed run may have left the transaction unusable
+            report.explain()
+        _reports.append(report)
+        if report.slow_statements:
+            logger.warning(report.as_text())
+        else:
+            logger.debug(report.as_text())
@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson as json
+
+from publish.models import PublishEvent
+
+
+class Command(BaseCommand):
+    args = '<consumer>'
+    help = ('Write the publish events the named consumer has not seen yet to stdout '
+            '(one JSON object per line), moving its cursor on as each batch is written.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of events to fetch at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Please give the name of the consumer')
+        batch_size = options.get('batch_size') or 500
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        for batch in PublishEvent.objects.consume(args[0], batch_size=batch_size):
+            lines = []
+            for event in batch:
+                content_type = ContentType.objects.get_for_id(event.content_type_id)
+                lines.append(json.dumps({
+                    'id': event.pk,
+                    'model': '%s.%s' % (content_type.app_label, content_type.model),
+                    'pk': event.object_id,
+                    'action': event.action,
+                    'version': event.version,
+                    'timestamp': event.created.isoformat(),
+                }))
+            self.stdout.write('\n'.join(lines) + '\n')
+            self.stdout.flush()
@@ -0,0 +1,118 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction, DEFAULT_DB_ALIAS
+
+from publish.models import Publishable, PublishCursor, publish_run
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Publish all pending changes and deletions, committing after each chunk. ' \
+           'An interrupted run will resume where it stopped.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=100,
+            help='Number of objects to publish per transaction.'),
+        make_option('--restart', dest='restart', action='store_true', default=False,
+            help='Ignore any saved cursor and start from the beginning.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Database to publish in. Defaults to the "default" database.'),
+    )
+
+    def handle(self, *model_labels, **options):
+        self.chunk_size = options.get('chunk_size') or 100
+        self.using = options.get('database') or DEFAULT_DB_ALIAS
+        self.verbosity = int(options.get('verbosity', 1))
+        restart = options.get('restart', False)
+
+        if self.chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        total = 0
+        started = time.time()
+        for model in self._get_models(model_labels):
+            for phase in ('changed', 'deleted'):
+                total += self._publish_phase(model, phase, restart)
+
+        self._report('Published %d objects in total %s' % (total, self._rate(total, started)))
+
+    def _get_models(self, model_labels):
+        if not model_labels:
+            return [m for m in models.get_models() if issubclass(m, Publishable)]
+
+        found = []
+        for label in model_labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Models should be given as app_label.ModelName, not "%s"' % label)
+            model = models.get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model: %s' % label)
+            if not issubclass(model, Publishable):
+                raise CommandError('%s is not a Publishable model' % label)
+            found.append(model)
+        return found
+
+    def _cursor_name(self, model, phase):
+        opts = model._meta
+        return 'publish_pending:%s.%s:%s' % (opts.app_label, opts.object_name.lower(), phase)
+
+    def _publish_phase(self, model, phase, restart):
+        opts = model._meta
+        label = '%s.%s %s' % (opts.app_label, opts.object_name, phase)
+        queryset = getattr(model._default_manager.using(self.using), phase)()
+
+        cursor, created = PublishCursor.objects.using(self.using) \
+                                 .get_or_create(name=self._cursor_name(model, phase),
+                                                defaults={'last_pk': ''})
+        if restart:
+            cursor.last_pk = ''
+        elif cursor.last_pk:
+            self._report('%s: resuming after pk %s' % (label, cursor.last_pk))
+
+        remaining = self._pending(queryset, opts, cursor).count()
+        published = 0
+        started = time.time()
+
+        while True:
+            # post_publish_run is sent for each chunk once it's committed
+            with publish_run(model) as all_published:
+                with transaction.commit_on_success(using=self.using):
+                    chunk = self._pending(queryset, opts, cursor).order_by('pk')[:self.chunk_size]
+                    count = 0
+                    for obj in chunk.iterator():
+                        # publishing a deletion clears the pk, so grab it first
+                        pk = obj.pk
+                        obj.publish(all_published=all_published)
+                        cursor.last_pk = unicode(pk)
+                        count += 1
+                    if count:
+                        cursor.save(using=self.using)
+
+            published += count
+            if count:
+                self._report('%s: %d/%d %s' % (label, published, remaining, self._rate(published, started)))
+            if count < self.chunk_size:
+                break
+
+        # finished, so next run should start from the beginning
+        cursor.delete()
+        return published
+
+    def _pending(self, queryset, opts, cursor):
+        if cursor.last_pk:
+            return queryset.filter(pk__gt=opts.pk.to_python(cursor.last_pk))
+        return queryset
+
+    def _rate(self, count, started):
+        elapsed = time.time() - started
+        if elapsed > 0:
+            return '(%.1f objects/s)' % (count / elapsed)
+        return ''
+
+    def _report(self, message):
+        if self.verbosity > 0:
+            self.stdout.write('%s\n' % message)
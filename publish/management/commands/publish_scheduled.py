@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from publish.models import PublishSchedule
+
+
+class Command(BaseCommand):
+    help = 'Publish/unpublish all objects whose scheduled time has passed.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of scheduled items to process per transaction.'),
+    )
+
+    def handle(self, **options):
+        batch_size = options.get('batch_size') or 100
+        verbosity = int(options.get('verbosity', 1))
+
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        total = 0
+        started = time.time()
+        while True:
+            processed = PublishSchedule.objects.run_due(batch_size=batch_size)
+            total += processed
+            if processed < batch_size:
+                break
+
+        if verbosity > 0:
+            self.stdout.write('Processed %d scheduled items in %.1fs\n' % (total, time.time() - started))
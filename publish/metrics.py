@@ -0,0 +1,292 @@
+'''
+Metrics for publish runs.
+
+Set PUBLISH_METRICS to the dotted path of a PublishMetrics subclass and
+every publish run (publishing an object and everything it pulls in, a
+queryset or a subtree) and unpublish is measured and handed to it once
+finished:
+
+    PUBLISH_METRICS = 'publish.metrics.InMemoryMetrics'
+
+InMemoryMetrics keeps counters and histograms for the current process,
+which metrics_view exposes in the Prometheus text format:
+
+    urlpatterns += patterns('', url(r'^metrics$', 'publish.metrics.metrics_view'))
+'''
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+from django.http import HttpResponse, Http404
+from django.utils.importlib import import_module
+
+
+class PublishRun(object):
+    '''
+    what happened during one run: nodes is every object visited, of
+    which skipped needed no changes, rows_written counts the public rows
+    saved or deleted and model_seconds how long each object of a model
+    took (including anything it pulled in)
+    '''
+
+    def __init__(self, model, action):
+        self.model = model
+        self.action = action
+        self.nodes = 0
+        self.skipped = 0
+        self.rows_written = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.failed = False
+        self.model_seconds = {}
+
+
+class PublishMetrics(object):
+    '''
+    the interface for metrics backends - subclasses should
+    override run_finished, which is passed each PublishRun
+    '''
+
+    def run_finished(self, run):
+        pass
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            yield bound, total
+
+
+class InMemoryMetrics(PublishMetrics):
+    '''
+    counters and histograms kept in memory, so they are per process
+    '''
+    duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+    size_buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+    # (name, type, help, histogram buckets)
+    metrics = [
+        ('publish_runs_total', 'counter', 'Publish runs finished', None),
+        ('publish_run_failures_total', 'counter', 'Publish runs that raised an exception', None),
+        ('publish_rows_written_total', 'counter', 'Public rows saved or deleted', None),
+        ('publish_skipped_total', 'counter', 'Objects visited that had no changes to publish', None),
+        ('publish_run_duration_seconds', 'histogram', 'Time taken by each publish run', duration_buckets),
+        ('publish_run_nodes', 'histogram', 'Objects visited by each publish run', size_buckets),
+        ('publish_run_queries', 'histogram', 'Queries run by each publish run', size_buckets),
+        ('publish_object_duration_seconds', 'histogram',
+         'Time taken to publish each object (including anything it pulled in)', duration_buckets),
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._values = dict((name, {}) for name, type, help, buckets in self.metrics)
+        self._buckets = dict((name, buckets) for name, type, help, buckets in self.metrics)
+
+    def _inc(self, name, labels, amount=1):
+        values = self._values[name]
+        values[labels] = values.get(labels, 0) + amount
+
+    def _observe(self, name, labels, value):
+        values = self._values[name]
+        if labels not in values:
+            values[labels] = _Histogram(self._buckets[name])
+        values[labels].observe(value)
+
+    def run_finished(self, run):
+        labels = (('model', _label(run.model)), ('action', run.action))
+        with self._lock:
+            self._inc('publish_runs_total', labels)
+            if run.failed:
+                self._inc('publish_run_failures_total', labels)
+            self._inc('publish_rows_written_total', labels, run.rows_written)
+            self._inc('publish_skipped_total', labels, run.skipped)
+            self._observe('publish_run_duration_seconds', labels, run.duration)
+            self._observe('publish_run_nodes', labels, run.nodes)
+            self._observe('publish_run_queries', labels, run.queries)
+            for model, seconds in run.model_seconds.items():
+                for value in seconds:
+                    self._observe('publish_object_duration_seconds', (('model', _label(model)),), value)
+
+    def value(self, name, **labels):
+        '''the value of a counter (or a histogram's count)'''
+        with self._lock:
+            for key, value in self._values[name].items():
+                if dict(key) == labels:
+                    return value.count if isinstance(value, _Histogram) else value
+        return 0
+
+    def render(self):
+        '''the metrics in the Prometheus text exposition format'''
+        lines = []
+        with self._lock:
+            for name, type, help, buckets in self.metrics:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                for labels, value in sorted(self._values[name].items()):
+                    if type == 'counter':
+                        lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                        continue
+                    for bound, count in value.cumulative():
+                        bucket_labels = labels + (('le', _format_value(bound)),)
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(bucket_labels), count))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(value.sum)))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{%s}' % ','.join('%s="%s"' % label for label in escaped)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+_backends = {}
+
+def get_metrics():
+    '''
+    the metrics backend named by PUBLISH_METRICS (one instance
+    per process), or None if publish runs aren't measured
+    '''
+    path = getattr(settings, 'PUBLISH_METRICS', None)
+    if not path:
+        return None
+    if path not in _backends:
+        module_name, class_name = path.rsplit('.', 1)
+        _backends[path] = getattr(import_module(module_name), class_name)()
+    return _backends[path]
+
+
+class _CountingCursor(CursorWrapper):
+    # counts the statements run through the cursor it wraps
+
+    def __init__(self, cursor, db, counter):
+        super(_CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.counter.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+class _QueryCounter(object):
+    # counts the queries run on every connection (as assertNumQueries
+    # would) by wrapping its cursors - the statements themselves are only
+    # kept in connection.queries if they would have been anyway
+
+    def __init__(self):
+        self.queries = 0
+        self._connections = []
+        for connection in connections.all():
+            self._connections.append((connection, connection.use_debug_cursor,
+                                      connection.__dict__.get('make_debug_cursor')))
+            if connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG):
+                make_cursor = connection.make_debug_cursor
+            else:
+                make_cursor = lambda cursor, connection=connection: CursorWrapper(cursor, connection)
+            # so every cursor goes through make_debug_cursor
+            connection.use_debug_cursor = True
+            connection.make_debug_cursor = lambda cursor, connection=connection, make_cursor=make_cursor: \
+                _CountingCursor(make_cursor(cursor), connection, self)
+
+    def stop(self):
+        for connection, use_debug_cursor, make_debug_cursor in self._connections:
+            connection.use_debug_cursor = use_debug_cursor
+            if make_debug_cursor is None:
+                del connection.make_debug_cursor
+            else:
+                connection.make_debug_cursor = make_debug_cursor
+        self._connections = []
+        return self.queries
+
+
+_local = threading.local()
+
+def current_run():
+    '''the PublishRun being measured in this thread, or None'''
+    return getattr(_local, 'run', None)
+
+
+@contextmanager
+def metered_run(model, action='publish', enabled=True):
+    '''
+    measure the run inside the with block.  does nothing if
+    there's no metrics backend or a run is already being measured
+    '''
+    metrics = get_metrics()
+    if not enabled or metrics is None or current_run() is not None:
+        yield None
+        return
+    run = _local.run = PublishRun(model, action)
+    counter = _QueryCounter()
+    started = time.time()
+    try:
+        yield run
+    except:
+        run.failed = True
+        raise
+    finally:
+        run.duration = time.time() - started
+        run.queries = counter.stop()
+        _local.run = None
+        metrics.run_finished(run)
+
+
+def record_node(model, started, skipped=False, rows_written=0):
+    '''
+    note that an object of model has been visited by the current run,
+    having started at the given time.time()
+    '''
+    run = current_run()
+    if run is None:
+        return
+    run.nodes += 1
+    if skipped:
+        run.skipped += 1
+    run.rows_written += rows_written
+    run.model_seconds.setdefault(model, []).append(time.time() - started)
+
+
+def metrics_view(request):
+    '''
+    the metrics in the Prometheus text format, if the
+    backend keeps them in memory (see InMemoryMetrics)
+    '''
+    metrics = get_metrics()
+    if not hasattr(metrics, 'render'):
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
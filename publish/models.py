@@ -1,11 +1,32 @@
 from django.db import models
 from django.db.models.query import QuerySet, Q
 from django.db.models.base import ModelBase
-from django.db.models.fields.related import RelatedField
+from django.db.models.fields.related import RelatedField, \
+    ReverseSingleRelatedObjectDescriptor, SingleRelatedObjectDescriptor
+from django.db import router, connections, DatabaseError
+from django.db.backends.util import truncate_name
+from django.db import transaction
+from django.core.cache import get_cache
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes import generic
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson as json
+from django.utils import timezone
 from django.conf import settings
 
+import sys
+import time
+import uuid
+import operator
+import traceback
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
 from utils import NestedSet
-from signals import pre_publish, post_publish
+from signals import pre_publish, post_publish, post_publish_run, post_unpublish
+from metrics import metered_run, record_node
+from explain import explained_run
 
 # this takes some inspiration from the publisher stuff in
 # django-cms 2.0
@@ -20,7 +41,259 @@ class PublishException(Exception):
 class UnpublishException(Exception):
     pass
 
+class VersionConflict(PublishException):
+    '''
+    raised when a versioned model has been changed (saved or
+    published) by someone else since it was loaded
+    '''
+    pass
+
+
+def _now():
+    # the current time - timezone aware if USE_TZ is on
+    return timezone.now()
+
+
+def get_public_database():
+    '''
+    the database alias public copies are published to (and read from), or
+    None if they are kept in the same database as the drafts
+    '''
+    return getattr(settings, 'PUBLISH_PUBLIC_DATABASE', None)
+
+
+def logging_events():
+    '''
+    whether publishing appends to the PublishEvent log
+    '''
+    return getattr(settings, 'PUBLISH_EVENT_LOG', False)
+
+
+def _log_event(public, action):
+    if logging_events():
+        PublishEvent.objects.record(public, action)
+
+
+def versioning_cache():
+    '''
+    whether publishing bumps the per-object versions
+    used by get_publish_version()
+    '''
+    return getattr(settings, 'PUBLISH_CACHE_VERSIONS', False)
+
+
+def tracking_dependencies():
+    '''
+    whether publishing records which public objects depend on
+    which others (see PublishDependency)
+    '''
+    return getattr(settings, 'PUBLISH_TRACK_DEPENDENCIES', False)
+
+
+def get_coalesce_window():
+    '''
+    seconds within which repeated publishes of the same object are
+    merged by publish_coalesced(), or None to always publish
+    '''
+    return getattr(settings, 'PUBLISH_COALESCE_WINDOW', None)
+
+
+def _coalesce_cache():
+    return get_cache(getattr(settings, 'PUBLISH_COALESCE_CACHE', 'default'))
+
+
+@contextmanager
+def _instrumented_run(model, action='publish', enabled=True):
+    # the queries are explained once the run has finished,
+    # so explained_run goes outside the metrics' query count
+    with explained_run(model, action, enabled):
+        with metered_run(model, action, enabled):
+            yield
+
+
+@contextmanager
+def publish_run(sender, action='publish'):
+    '''
+    publish several objects as one run: pass the NestedSet this yields
+    as all_published to each publish() and, once the with block has
+    finished, post_publish_run is sent for all of them
+    '''
+    all_published = NestedSet()
+    with _instrumented_run(sender, action):
+        yield all_published
+    if all_published:
+        post_publish_run.send(sender=sender, all_published=all_published)
+
+
+class _Result(object):
+    '''
+    yielded by a publish step to finish it and hand a value
+    back to the step that yielded it (see _run_steps)
+    '''
+    def __init__(self, value):
+        self.value = value
+
+
+def _call_step(method, **kw):
+    # a step that just calls a (subclass's) publish method
+    yield _Result(method(**kw))
+
+
+def _overrides(obj, name):
+    # whether obj's class has overridden one of Publishable's publish methods
+    return getattr(obj.__class__, name).im_func is not getattr(Publishable, name).im_func
+
+
+def _run_steps(steps):
+    '''
+    run a publish task (a generator of steps) to completion.
+
+    a step may yield another generator, which is run before it carries
+    on (and gets sent the result), or a _Result to finish.  the
+    generators are kept on an explicit stack rather than being called
+    recursively, so the depth of the graph we can publish is only limited
+    by memory - not by Python's recursion limit.
+    '''
+    stack = [steps]
+    value, error = None, None
+    while stack:
+        current = stack[-1]
+        try:
+            if error is not None:
+                exc_info, error = error, None
+                step = current.throw(*exc_info)
+            else:
+                step = current.send(value)
+        except StopIteration:
+            stack.pop()
+            value = None
+            continue
+        except Exception:
+            stack.pop()
+            if not stack:
+                raise
+            # pass the error up to the step that is waiting on this one
+            error = sys.exc_info()
+            continue
+
+        if isinstance(step, _Result):
+            current.close()
+            stack.pop()
+            value = step.value
+        else:
+            stack.append(step)
+            value = None
+    return value
+
+
+def _levels(rows):
+    # (pk, depth) ordered by depth -> list of lists of pks
+    levels, seen = [], set()
+    for pk, depth in rows:
+        if pk in seen:
+            raise PublishException("The tree has a cycle (through %r)" % pk)
+        seen.add(pk)
+        if depth == len(levels):
+            levels.append([])
+        levels[depth].append(pk)
+    return levels
+
+
+_publishing_parents_cache = {}
+
+def _publishing_parents(model):
+    # (parent model, foreign key on model) for each parent that publishes
+    # model as one of its publish_reverse_fields and wants to be marked
+    # as changed along with it
+    if model not in _publishing_parents_cache:
+        parents = []
+        for field in model._meta.fields:
+            if not isinstance(field, RelatedField) or field.name == 'public':
+                continue
+            parent_model = field.rel.to
+            if not (isinstance(parent_model, type) and issubclass(parent_model, Publishable)):
+                continue
+            if not parent_model.PublishMeta.publish_propagate_changes:
+                continue
+            if field.related.get_accessor_name() in parent_model.PublishMeta.reverse_fields_to_publish():
+                parents.append((parent_model, field))
+        _publishing_parents_cache[model] = parents
+    return _publishing_parents_cache[model]
+
+
+def _mark_parents_changed(pending):
+    '''
+    mark the (draft) parents that publish the children in pending - a list
+    of (model, queryset or list of objects) - through their
+    publish_reverse_fields as changed, if they asked to be with
+    publish_propagate_changes, and their parents in turn.  one UPDATE per
+    parent model at each level
+    '''
+    seen = set()
+    while pending:
+        model, children = pending.pop()
+        for parent_model, field in _publishing_parents(model):
+            if (parent_model, field) in seen:
+                continue
+            seen.add((parent_model, field))
+            if isinstance(children, QuerySet):
+                parent_ids = children.values(field.attname)
+            else:
+                parent_ids = set(getattr(child, field.attname) for child in children) - set([None])
+                if not parent_ids:
+                    continue
+            parents = QuerySet(parent_model).filter(pk__in=parent_ids, is_public=False)
+            parents.filter(publish_state=Publishable.PUBLISH_DEFAULT) \
+                   .update(publish_state=Publishable.PUBLISH_CHANGED)
+            pending.append((parent_model, parents))
+
+
+def _tree_field(model, parent_field=None):
+    # the foreign key a model uses to point to its parent
+    if parent_field is not None:
+        return model._meta.get_field(parent_field)
+    fields = [f for f in model._meta.fields
+              if isinstance(f, RelatedField) and f.rel.to == model and f.name != 'public']
+    if len(fields) != 1:
+        raise PublishException("Please give the parent field of %s" % model._meta.object_name)
+    return fields[0]
+
+
+def _serialize_object(obj):
+    data = serializers.serialize('python', [obj])[0]
+    fields = data['fields']
+    if isinstance(obj, Publishable):
+        for name in ('is_public', 'publish_state', 'public', obj.PublishMeta.publish_snapshot_field):
+            fields.pop(name, None)
+    fields['id'] = obj.pk
+    return fields
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class PublishableQuerySet(QuerySet):
+    _with_public = False
+    pair_chunk_size = 500
+
+    def _clone(self, *arg, **kw):
+        c = super(PublishableQuerySet, self)._clone(*arg, **kw)
+        c._with_public = self._with_public
+        return c
+
+    def iterator(self):
+        objects = super(PublishableQuerySet, self).iterator()
+        if self._with_public:
+            return self._iter_with_public(objects)
+        return objects
 
     def changed(self):
         '''all draft objects that have not been published yet'''
@@ -39,14 +312,296 @@ class PublishableQuerySet(QuerySet):
  
     def published(self):
         '''all public/published objects'''
-        return self.filter(Publishable.Q_PUBLISHED)
+        queryset = self.filter(Publishable.Q_PUBLISHED)
+        public_database = get_public_database()
+        if public_database and self._db is None:
+            queryset = queryset.using(public_database)
+        return queryset
+
+    def with_public(self):
+        '''
+        load the other (draft or public) copy of each object as well, so
+        that draft.public and public.draft don't need a query each
+        '''
+        if get_public_database():
+            # can't join across databases, so the other copies
+            # get loaded a chunk at a time instead
+            queryset = self._clone()
+        else:
+            queryset = self.select_related('public', 'draft')
+        queryset._with_public = True
+        return queryset
+
+    def pairs(self, chunk_size=None):
+        '''
+        iterate over (draft, public) tuples for the drafts in this
+        queryset - public will be None if the draft isn't published.
+        objects are streamed, rather than all held in memory at once
+        '''
+        queryset = self.filter(is_public=False).with_public()
+        if chunk_size is not None:
+            queryset.pair_chunk_size = chunk_size
+        for draft in queryset.iterator():
+            yield draft, draft.public
+
+    def _iter_with_public(self, objects):
+        model = self.model
+        public_cache, draft_cache = model.public.cache_name, model.draft.cache_name
+        public_database = get_public_database()
+
+        for chunk in _chunked(objects, self.pair_chunk_size):
+            if public_database:
+                self._load_other_copies(chunk, public_database)
+
+            for obj in chunk:
+                # cache the object on its pair too
+                if obj.is_public:
+                    draft = getattr(obj, draft_cache, None)
+                    if draft is not None:
+                        setattr(draft, public_cache, obj)
+                else:
+                    public = getattr(obj, public_cache, None)
+                    if public is not None:
+                        setattr(public, draft_cache, obj)
+                yield obj
+
+    def _load_other_copies(self, chunk, public_database):
+        model = self.model
+        public_cache, draft_cache = model.public.cache_name, model.draft.cache_name
+
+        public_ids = [obj.public_id for obj in chunk if not obj.is_public and obj.public_id is not None]
+        if public_ids:
+            public_versions = QuerySet(model).using(public_database).in_bulk(public_ids)
+            for obj in chunk:
+                if not obj.is_public and obj.public_id in public_versions:
+                    setattr(obj, public_cache, public_versions[obj.public_id])
+
+        public_pks = [obj.pk for obj in chunk if obj.is_public]
+        if public_pks:
+            drafts = QuerySet(model).using(router.db_for_read(model)).filter(public__in=public_pks)
+            drafts = dict((draft.public_id, draft) for draft in drafts)
+            for obj in chunk:
+                if obj.is_public and obj.pk in drafts:
+                    setattr(obj, draft_cache, drafts[obj.pk])
 
     def publish(self, all_published=None):
         '''publish all models in this queryset'''
-        if all_published is None:
+        started_run = all_published is None
+        if started_run:
             all_published = NestedSet()
-        for p in self:
-            p.publish(all_published=all_published)
+        with _instrumented_run(self.model, enabled=started_run):
+            for p in self:
+                p.publish(all_published=all_published)
+        if started_run and all_published:
+            post_publish_run.send(sender=self.model, all_published=all_published)
+
+    def update(self, mark_changed=True, **kw):
+        '''
+        update the objects in this queryset, marking the drafts as changed
+        (and their parents, as save() does).  drafts marked for deletion
+        are left alone.  pass mark_changed=False (or set publish_state
+        yourself) for a plain update of every object.
+
+        like QuerySet.update no signals are sent, but the tree closure
+        is kept up to date if the tree field is updated
+        '''
+        model = self.model
+        if not mark_changed or 'publish_state' in kw:
+            rows = self._update_tree(self, kw)
+            if rows is None:
+                rows = super(PublishableQuerySet, self).update(**kw)
+            return rows
+
+        drafts = self.filter(is_public=False).exclude(publish_state=Publishable.PUBLISH_DELETE)
+        draft_pks = None
+        if _publishing_parents(model):
+            draft_pks = list(drafts.values_list('pk', flat=True))
+        with transaction.commit_on_success(using=self.db):
+            public_rows = self._update_tree(self.filter(is_public=True), kw)
+            if public_rows is None:
+                public_rows = QuerySet.update(self.filter(is_public=True), **kw)
+            draft_kw = dict(kw, publish_state=Publishable.PUBLISH_CHANGED)
+            draft_rows = self._update_tree(drafts, draft_kw)
+            if draft_rows is None:
+                draft_rows = QuerySet.update(drafts, **draft_kw)
+            if draft_pks:
+                for chunk in _chunked(draft_pks, self.pair_chunk_size):
+                    _mark_parents_changed([(model, QuerySet(model).using(self.db).filter(pk__in=chunk))])
+        return public_rows + draft_rows
+    update.alters_data = True
+
+    def _update_tree(self, queryset, kw):
+        # update queryset, moving the objects in the tree closure
+        # too - or None if this isn't the tree field changing
+        model = self.model
+        if not model.PublishMeta.publish_tree_field:
+            return None
+        field = _tree_field(model, model.PublishMeta.publish_tree_field)
+        if field.name not in kw and field.attname not in kw:
+            return None
+        parent = kw.get(field.name, kw.get(field.attname))
+        parent_id = parent.pk if isinstance(parent, models.Model) else parent
+        with transaction.commit_on_success(using=self.db):
+            pks = list(queryset.values_list('pk', flat=True))
+            PublishTreeClosure.objects.check_parent(model, self.db, pks, parent_id)
+            rows = QuerySet.update(queryset, **kw)
+            for chunk in _chunked(pks, self.pair_chunk_size):
+                for obj in QuerySet(model).using(self.db).filter(pk__in=chunk):
+                    PublishTreeClosure.objects.node_saved(obj)
+        return rows
+
+    def bulk_create(self, objs):
+        '''
+        insert objs (as QuerySet.bulk_create), with the drafts marked as
+        changed (and their parents, as save() does).
+
+        like QuerySet.bulk_create no signals are sent - for tree models
+        the objs need their primary keys set, so they can be added to the
+        tree closure
+        '''
+        model = self.model
+        tree = model.PublishMeta.publish_tree_field
+        drafts = []
+        for obj in objs:
+            if tree and obj.pk is None:
+                raise PublishException("Please set the primary key of tree models before bulk creating them")
+            if not obj.is_public:
+                if obj.publish_state == Publishable.PUBLISH_DELETE:
+                    raise PublishException("Attempting to save model marked for deletion")
+                obj.publish_state = Publishable.PUBLISH_CHANGED
+                drafts.append(obj)
+        with transaction.commit_on_success(using=self.db):
+            created = super(PublishableQuerySet, self).bulk_create(objs)
+            if drafts:
+                _mark_parents_changed([(model, drafts)])
+            if tree:
+                for obj in objs:
+                    obj._state.db = self.db
+                    PublishTreeClosure.objects.node_saved(obj)
+        return created
+
+    def bulk_create_and_publish(self, objs):
+        '''
+        bulk_create the (draft) objs and publish them straight away,
+        returning the drafts (with their public copies).
+
+        bulk_create can't tell us the ids it gives new rows, so only
+        objs with their primary key set are inserted in bulk - any
+        others are saved one at a time
+        '''
+        objs = list(objs)
+        for obj in objs:
+            if obj.is_public:
+                raise PublishException("Cannot publish public model - bulk create drafts instead")
+        self.bulk_create([obj for obj in objs if obj.pk is not None])
+        for obj in objs:
+            if obj.pk is None:
+                obj.save()
+
+        drafts = []
+        all_published = NestedSet()
+        with _instrumented_run(self.model):
+            for chunk in _chunked([obj.pk for obj in objs], self.pair_chunk_size):
+                for draft in QuerySet(self.model).using(self._db).filter(pk__in=chunk):
+                    draft.publish(all_published=all_published)
+                    drafts.append(draft)
+        if all_published:
+            post_publish_run.send(sender=self.model, all_published=all_published)
+        return drafts
+
+    # subtrees deeper than this raise PublishException, as do
+    # cycles (which would otherwise go on forever)
+    subtree_max_depth = 1000
+
+    def subtree_levels(self, root, parent_field=None):
+        '''
+        the pks of the (draft) root and everything below it, as a list of
+        levels - root first.  uses a single recursive query on databases
+        that support it (SQLite and PostgreSQL), otherwise one per level
+        '''
+        field = _tree_field(self.model, parent_field)
+        if root.is_public:
+            raise PublishException("Subtrees should be found from the draft model")
+        using = self._db or router.db_for_read(self.model)
+        connection = connections[using]
+        if self.model.PublishMeta.publish_tree_field == field.name:
+            rows = PublishTreeClosure.objects._rows(self.model, using).filter(ancestor_id=root.pk)
+            return _levels(rows.values_list('descendant_id', 'depth').order_by('depth'))
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            return self._subtree_levels_by_level(root, field, using)
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        sql = ('WITH RECURSIVE subtree (id, depth) AS ('
+               ' SELECT %(pk)s, 0 FROM %(table)s WHERE %(pk)s = %%s'
+               ' UNION ALL'
+               ' SELECT t.%(pk)s, s.depth + 1 FROM %(table)s t JOIN subtree s ON t.%(parent)s = s.id'
+               ' WHERE t.%(is_public)s = %%s AND s.depth <= %%s'
+               ') SELECT id, depth FROM subtree ORDER BY depth' % {
+                   'pk': qn(opts.pk.column), 'table': qn(opts.db_table),
+                   'parent': qn(field.column), 'is_public': qn(opts.get_field('is_public').column)})
+        cursor = connection.cursor()
+        # going one level too deep shows up a cycle (or a tree that's too deep)
+        cursor.execute(sql, [root.pk, False, self.subtree_max_depth])
+        return self._check_depth(_levels(cursor.fetchall()))
+
+    def _check_depth(self, levels):
+        if len(levels) > self.subtree_max_depth + 1:
+            raise PublishException("The tree is more than %d levels deep" % self.subtree_max_depth)
+        return levels
+
+    def _subtree_levels_by_level(self, root, field, using):
+        levels = [[root.pk]]
+        drafts = QuerySet(self.model).using(using).filter(is_public=False)
+        seen = set([root.pk])
+        while len(levels) <= self.subtree_max_depth + 1:
+            children = list(drafts.filter(**{'%s__in' % field.name: levels[-1]}).values_list('pk', flat=True))
+            if not children:
+                return levels
+            if seen.intersection(children):
+                raise PublishException("The tree has a cycle (through %r)" % seen.intersection(children).pop())
+            seen.update(children)
+            levels.append(children)
+        return self._check_depth(levels)
+
+    def publish_subtree(self, root, parent_field=None, dry_run=False, all_published=None):
+        '''
+        publish the (draft) root and everything below it, a level at a
+        time so parents are always published before their children.  each
+        level is loaded with a single query (per chunk), but each object is
+        still published on its own - publish() does too much per object
+        (reverse relations, publish functions, signals...) to copy a whole
+        level with one statement
+        '''
+        field = _tree_field(self.model, parent_field)
+        started_run = all_published is None
+        if started_run:
+            all_published = NestedSet()
+        published = {}
+        with _instrumented_run(self.model, enabled=started_run and not dry_run):
+            for level in self.subtree_levels(root, parent_field):
+                for chunk in _chunked(level, self.pair_chunk_size):
+                    for obj in self.filter(pk__in=chunk):
+                        parent = published.get(getattr(obj, field.attname))
+                        if parent is not None:
+                            # saves loading the parent again
+                            setattr(obj, field.get_cache_name(), parent)
+                        obj.publish(dry_run=dry_run, all_published=all_published)
+                        published[obj.pk] = obj
+        if started_run and all_published and not dry_run:
+            post_publish_run.send(sender=self.model, all_published=all_published)
+        return all_published
+
+    def snapshots(self):
+        '''
+        the snapshots of these (public) objects, fetched
+        without loading the objects themselves
+        '''
+        snapshot_field = self.model.PublishMeta.publish_snapshot_field
+        if not snapshot_field:
+            raise PublishException("%s has no publish_snapshot_field" % self.model._meta.object_name)
+        for value in self.values_list(snapshot_field, flat=True).iterator():
+            yield value and json.loads(value) or None
 
     def delete(self, mark_for_deletion=True):
         '''
@@ -81,6 +636,57 @@ class PublishableManager(models.Manager):
         '''all public/published objects'''
         return self.get_query_set().published()
 
+    def with_public(self):
+        '''load the other (draft or public) copy of each object too'''
+        return self.get_query_set().with_public()
+
+    def pairs(self, chunk_size=None):
+        '''iterate over (draft, public) tuples'''
+        return self.get_query_set().pairs(chunk_size=chunk_size)
+
+    def bulk_create_and_publish(self, objs):
+        '''bulk_create the (draft) objs and publish them straight away'''
+        return self.get_query_set().bulk_create_and_publish(objs)
+
+    def publish_subtree(self, root, parent_field=None, dry_run=False, all_published=None):
+        '''publish the (draft) root and everything below it'''
+        return self.get_query_set().publish_subtree(root, parent_field=parent_field,
+                                                    dry_run=dry_run, all_published=all_published)
+
+
+class PublicObjectDescriptor(ReverseSingleRelatedObjectDescriptor):
+    '''
+    draft.public - which may live in a separate public database
+    '''
+
+    def get_query_set(self, **db_hints):
+        public_database = get_public_database()
+        if public_database:
+            return QuerySet(self.field.rel.to).using(public_database)
+        return super(PublicObjectDescriptor, self).get_query_set(**db_hints)
+
+    def __set__(self, instance, value):
+        if value is not None and instance._state.db and value._state.db \
+                and instance._state.db != value._state.db and get_public_database():
+            # draft and public copy are (deliberately) in different
+            # databases, so skip django's cross-database check
+            setattr(instance, self.field.attname, value.pk)
+            setattr(instance, self.cache_name, value)
+        else:
+            super(PublicObjectDescriptor, self).__set__(instance, value)
+
+
+class DraftObjectDescriptor(SingleRelatedObjectDescriptor):
+    '''
+    public.draft - which may live in a different database to the public copy
+    '''
+
+    def get_query_set(self, **db_hints):
+        if get_public_database():
+            # drafts are always in the normal database for the model
+            return self.related.model._base_manager.using(router.db_for_read(self.related.model))
+        return super(DraftObjectDescriptor, self).get_query_set(**db_hints)
+
 
 class PublishableBase(ModelBase):
     
@@ -93,6 +699,12 @@ class PublishableBase(ModelBase):
         code = u'publish_%s' % opts.object_name.lower()
         opts.permissions = tuple(opts.permissions) + ((code, name), )
         opts.get_publish_permission = lambda: code
+
+        if not opts.abstract:
+            # public/draft copies may be in different databases
+            public_field = opts.get_field('public')
+            new_class.public = PublicObjectDescriptor(public_field)
+            new_class.draft = DraftObjectDescriptor(public_field.related)
         
         return new_class
     
@@ -124,6 +736,11 @@ class Publishable(models.Model):
         publish_exclude_fields = ['id', 'is_public', 'publish_state', 'public', 'draft']
         publish_reverse_fields = []
         publish_functions = {}        
+        publish_public_indexes = []
+        publish_snapshot_field = None
+        publish_snapshot_related = []
+        publish_tree_field = None
+        publish_propagate_changes = False
 
         @classmethod
         def _combined_fields(cls, field_name):
@@ -140,6 +757,14 @@ class Publishable(models.Model):
         def reverse_fields_to_publish(cls):
             return cls._combined_fields('publish_reverse_fields')
 
+        @classmethod
+        def public_indexes(cls):
+            return cls._combined_fields('publish_public_indexes')
+
+        @classmethod
+        def snapshot_related(cls):
+            return cls._combined_fields('publish_snapshot_related')
+
         @classmethod
         def find_publish_function(cls, field_name, default_function):
             '''
@@ -158,6 +783,20 @@ class Publishable(models.Model):
     def is_marked_for_deletion(self):
         return self.publish_state == Publishable.PUBLISH_DELETE
 
+    def _excluded_fields(self):
+        excluded_fields = self.PublishMeta.excluded_fields()
+        if self.PublishMeta.publish_snapshot_field:
+            excluded_fields.append(self.PublishMeta.publish_snapshot_field)
+        return excluded_fields
+
+    def _claim_version(self, using=None):
+        # see VersionedPublishable
+        pass
+
+    def _mark_published(self):
+        # see TimestampedPublishable
+        pass
+
     def get_public_absolute_url(self):
         if self.public:
             get_absolute_url = getattr(self.public, 'get_absolute_url', None)
@@ -172,17 +811,89 @@ class Publishable(models.Model):
             self.publish_state = Publishable.PUBLISH_CHANGED
 
         super(Publishable, self).save(*arg, **kw)
+        if not self.is_public and mark_changed:
+            self._mark_parents_changed()
     
     def delete(self, mark_for_deletion=True):
         if self.public and mark_for_deletion:
             self.publish_state = Publishable.PUBLISH_DELETE
             self.save(mark_changed=False)
+            self._mark_parents_changed()
         else:
             super(Publishable, self).delete()
 
     def undelete(self):
         self.publish_state = Publishable.PUBLISH_CHANGED
         self.save(mark_changed=False)
+        self._mark_parents_changed()
+
+    def _mark_parents_changed(self):
+        _mark_parents_changed([(self.__class__, QuerySet(self.__class__).filter(pk=self.pk))])
+
+    def publish_at(self, when):
+        '''
+        schedule this (draft) model to be published at the given time
+        (by the publish_scheduled command)
+        '''
+        return PublishSchedule.objects.schedule(self, PublishSchedule.ACTION_PUBLISH, when)
+
+    def unpublish_at(self, when):
+        '''
+        schedule this (draft) model to be unpublished at the given time
+        '''
+        return PublishSchedule.objects.schedule(self, PublishSchedule.ACTION_UNPUBLISH, when)
+
+    def cancel_schedule(self, action=None):
+        '''
+        remove any scheduled publish/unpublish (or just those for action)
+        '''
+        PublishSchedule.objects.for_object(self, action=action).delete()
+
+    def publish_coalesced(self, window=None):
+        '''
+        publish, unless this object was already published in the last
+        window seconds (PUBLISH_COALESCE_WINDOW by default) - in which case
+        the request is merged and a publish is scheduled for the end of the
+        window, to pick up the changes (see publish_at).  returns
+        (public_version, merged): public_version is None if this request was
+        merged, merged is the number of merged requests this publish covers
+        (or the number now waiting if it was merged)
+        '''
+        if window is None:
+            window = get_coalesce_window()
+        if not window:
+            return self.publish(), 0
+
+        cache = _coalesce_cache()
+        key = self._coalesce_key()
+        merged_key = key + ':merged'
+        # the key acts as a lock - only the first request in the window
+        # gets it, and holds when the window ends
+        window_end = _now() + timedelta(seconds=window)
+        if not cache.add(key, window_end, window):
+            cache.add(merged_key, 0)
+            merged = cache.incr(merged_key)
+            # the first request merged into this window schedules the publish
+            if cache.add(key + ':trailing', True, window):
+                when = cache.get(key) or window_end
+                if not PublishSchedule.objects.for_object(self, action=PublishSchedule.ACTION_PUBLISH) \
+                                              .filter(due__lte=when).exists():
+                    self.publish_at(when)
+            return None, merged
+
+        merged = cache.get(merged_key) or 0
+        if merged:
+            cache.decr(merged_key, merged)
+        try:
+            public_version = self.publish()
+        except:
+            # let the next request try again straight away
+            cache.delete(key)
+            raise
+        return public_version, merged
+
+    def _coalesce_key(self):
+        return 'publish-coalesce:%s.%s:%s' % (self._meta.app_label, self._meta.object_name, self.pk)
 
     def _pre_publish(self, dry_run, all_published, deleted=False):
         if not dry_run:
@@ -206,16 +917,32 @@ class Publishable(models.Model):
         public models will be examined to see if they need deleting
         and deleted if so.
         '''
+        return self._publish_run(self._publish_steps, dry_run, all_published, parent)
+
+    def _publish_run(self, steps, dry_run, all_published, parent):
+        # the first object published creates all_published, so
+        # it lets everyone know when the whole run is finished
+        started_run = all_published is None
+        if started_run:
+            all_published = NestedSet()
+        with _instrumented_run(self.__class__, enabled=started_run and not dry_run):
+            result = _run_steps(steps(dry_run, all_published, parent))
+        if started_run and all_published and not dry_run:
+            post_publish_run.send(sender=self.__class__, all_published=all_published)
+        return result
+
+    def _publish_steps(self, dry_run, all_published, parent):
         if self.is_public:
             raise PublishException("Cannot publish public model - publish should be called from draft model")
         if self.pk is None:
             raise PublishException("Please save model before publishing")
          
         if self.publish_state == Publishable.PUBLISH_DELETE:
-            self.publish_deletions(dry_run=dry_run, all_published=all_published, parent=parent)
-            return None
+            yield self._nested_steps('publish_deletions', self._publish_deletions_steps, dry_run, all_published, parent)
         else:
-            return self.publish_changes(dry_run=dry_run, all_published=all_published, parent=parent)
+            public_version = yield self._nested_steps('publish_changes', self._publish_changes_steps,
+                                                      dry_run, all_published, parent)
+            yield _Result(public_version)
 
     def unpublish(self, dry_run=False):
         '''
@@ -229,17 +956,37 @@ class Publishable(models.Model):
         public_model = self.public
 
         if public_model and not dry_run:
-            self.public = None
-            self.save()
-            public_model.delete(mark_for_deletion=False)
+            with _instrumented_run(self.__class__, 'unpublish'):
+                started = time.time()
+                _log_event(public_model, PublishEvent.ACTION_UNPUBLISH)
+                public_model._delete_logged = True
+                self.public = None
+                self.save()
+                public_model.delete(mark_for_deletion=False)
+                record_node(self.__class__, started, rows_written=1)
+            post_unpublish.send(sender=self.__class__, instance=self)
         return public_model
 
-    def _get_public_or_publish(self, *arg, **kw):
+    def _get_public_or_publish(self, dry_run=False, all_published=None, parent=None):
+        return _run_steps(self._get_public_or_publish_steps(dry_run, all_published, parent))
+
+    def _get_public_or_publish_steps(self, dry_run, all_published, parent):
         # only publish if we don't yet have an id for the
         # public model
         if self.public:
-            return self.public
-        return self.publish(*arg, **kw)
+            yield _Result(self.public)
+        else:
+            public_version = yield self._nested_steps('publish', self._publish_steps, dry_run, all_published, parent)
+            yield _Result(public_version)
+
+    def _nested_steps(self, name, steps, dry_run, all_published, parent):
+        '''
+        the steps to publish this object as part of a bigger publish - which
+        calls the method called name instead, if a subclass overrides it
+        '''
+        if _overrides(self, name):
+            return _call_step(getattr(self, name), dry_run=dry_run, all_published=all_published, parent=parent)
+        return steps(dry_run, all_published, parent)
 
     def _get_through_model(self, field_object):
         '''
@@ -266,7 +1013,9 @@ class Publishable(models.Model):
         the all_published value one can therefore get information about what other models
         would be affected by this function
         '''
+        return self._publish_run(self._publish_changes_steps, dry_run, all_published, parent)
 
+    def _publish_changes_steps(self, dry_run, all_published, parent):
         assert not self.is_public, "Cannot publish public model - publish should be called from draft model"
         assert self.pk is not None, "Please save model before publishing"
 
@@ -275,9 +1024,11 @@ class Publishable(models.Model):
             all_published = NestedSet()
 
         if self in all_published:
-            return all_published.original(self).public
+            yield _Result(all_published.original(self).public)
+            return
 
         all_published.add(self, parent=parent)        
+        started = time.time()
 
         self._pre_publish(dry_run, all_published)
 
@@ -285,34 +1036,58 @@ class Publishable(models.Model):
         if not public_version:
             public_version = self.__class__(is_public=True)
         
-        excluded_fields = self.PublishMeta.excluded_fields()
+        excluded_fields = self._excluded_fields()
         reverse_fields_to_publish = self.PublishMeta.reverse_fields_to_publish()
+        public_database = get_public_database()
         
-        if self._changes_need_publishing():
+        changed = self._changes_need_publishing()
+        # whether this publish rewrote the public version, or just its children
+        self._public_rewritten = changed and not dry_run
+        self._public_children_rewritten = False
+        if changed:
+            if not dry_run:
+                # make sure nobody has changed the draft since we loaded it
+                self._claim_version()
+
             # copy over regular fields
             for field in self._meta.fields:
                 if field.name in excluded_fields:
                     continue
                 
-                value = getattr(self, field.name)
+                publish_function = self.PublishMeta.find_publish_function(field.name, None)
+                name = field.name
+                if isinstance(field, RelatedField) and public_database and publish_function is None \
+                        and not issubclass(field.rel.to, Publishable):
+                    # the related object stays in the draft database,
+                    # so we can only copy its id across
+                    name = field.attname
+                value = getattr(self, name)
                 if isinstance(field, RelatedField):
                     related = field.rel.to
                     if issubclass(related, Publishable):
                         if value is not None:
-                            value = value._get_public_or_publish(dry_run=dry_run, all_published=all_published, parent=self)
+                            value = yield value._nested_steps('_get_public_or_publish', value._get_public_or_publish_steps,
+                                                              dry_run, all_published, self)
                 
                 if not dry_run:
-                    publish_function = self.PublishMeta.find_publish_function(field.name, setattr)
-                    publish_function(public_version, field.name, value)
+                    if publish_function is None:
+                        setattr(public_version, name, value)
+                    else:
+                        publish_function(public_version, field.name, value)
         
             # save the public version and update
             # state so we know everything is up-to-date
             if not dry_run:
-                public_version.save()
+                public_version._mark_published()
+                public_version.save(using=public_database)
                 self.public = public_version
                 self.publish_state = Publishable.PUBLISH_DEFAULT
                 self.save(mark_changed=False)
+                _log_event(public_version, PublishEvent.ACTION_PUBLISH)
         
+        # public objects the public version depends on
+        dependencies = []
+
         # copy over many-to-many fields
         for field in self._meta.many_to_many:
             name = field.name
@@ -341,13 +1116,20 @@ class Publishable(models.Model):
 
             related = field_object.rel.to
             if issubclass(related, Publishable):
-                public_objs = [p._get_public_or_publish(dry_run=dry_run, all_published=all_published, parent=self) for p in public_objs]
+                draft_objs, public_objs = public_objs, []
+                for p in draft_objs:
+                    public_objs.append((yield p._nested_steps('_get_public_or_publish', p._get_public_or_publish_steps,
+                                                              dry_run, all_published, self)))
+                dependencies.extend(public_objs)
             
             if not dry_run:
+                # add by id, as non-publishable objects may be in a
+                # different database to the public version
+                public_ids = [p.pk for p in public_objs]
                 public_m2m_manager = getattr(public_version, name)
-                old_objs = public_m2m_manager.exclude(pk__in=[p.pk for p in public_objs])
+                old_objs = public_m2m_manager.exclude(pk__in=public_ids)
                 public_m2m_manager.remove(*old_objs)
-                public_m2m_manager.add(*public_objs)
+                public_m2m_manager.add(*public_ids)
 
         # one-to-many and one-to-one reverse relations
         for obj in self._meta.get_all_related_objects():
@@ -366,23 +1148,110 @@ class Publishable(models.Model):
                         related_items = []
 
                 for related_item in related_items:
-                    related_item.publish(dry_run=dry_run, all_published=all_published, parent=self)
+                    public_item = yield related_item._nested_steps('publish', related_item._publish_steps,
+                                                                   dry_run, all_published, self)
+                    if public_item is not None:
+                        dependencies.append(public_item)
+                    if not dry_run and (getattr(related_item, '_public_rewritten', False) or
+                                        getattr(related_item, '_public_children_rewritten', False)):
+                        # the public version shows its children, so has changed too
+                        self._public_children_rewritten = True
                 
                 # make sure we tidy up anything that needs deleting
                 if self.public and not dry_run:
                     if obj.field.rel.multiple:
                         public_ids = [r.public_id for r in related_items]
-                        deleted_items = getattr(self.public, name).exclude(pk__in=public_ids)
-                        deleted_items.delete(mark_for_deletion=False)
+                        deleted_items = list(getattr(self.public, name).exclude(pk__in=public_ids))
+                        for deleted_item in deleted_items:
+                            deleted_item.delete(mark_for_deletion=False)
+                        if deleted_items:
+                            self._public_children_rewritten = True
+
+        if not dry_run and tracking_dependencies():
+            PublishDependency.objects.record(public_version, self._foreign_key_dependencies(public_version) + dependencies)
+
+        if not dry_run and self.PublishMeta.publish_snapshot_field:
+            public_version._update_snapshot()
         
         self._post_publish(dry_run, all_published)
-
-        return public_version
+        record_node(self.__class__, started, skipped=not changed, rows_written=int(changed))
+
+        yield _Result(public_version)
+
+    def _update_snapshot(self):
+        # serialize this (public) object and the related objects
+        # listed in publish_snapshot_related into its snapshot field
+        data = _serialize_object(self)
+        for name in self.PublishMeta.snapshot_related():
+            related = self._snapshot_related(name)
+            if hasattr(related, 'all'):
+                data[name] = [_serialize_object(r) for r in related.all()]
+            elif related is not None:
+                data[name] = _serialize_object(related)
+            else:
+                data[name] = None
+        snapshot_field = self.PublishMeta.publish_snapshot_field
+        value = json.dumps(data, cls=DjangoJSONEncoder)
+        setattr(self, snapshot_field, value)
+        QuerySet(self.__class__).using(self._state.db).filter(pk=self.pk).update(**{snapshot_field: value})
+
+    def _snapshot_related(self, name):
+        # what name refers to - non-publishable objects stay in the draft
+        # database (see PUBLISH_PUBLIC_DATABASE), so are read from there
+        if get_public_database() and name in self._meta.get_all_field_names():
+            field, model, direct, m2m = self._meta.get_field_by_name(name)
+            if direct and isinstance(field, RelatedField) and not issubclass(field.rel.to, Publishable):
+                related_model = field.rel.to
+                related = QuerySet(related_model).using(router.db_for_read(related_model))
+                if m2m:
+                    ids = QuerySet(field.rel.through).using(self._state.db) \
+                        .filter(**{field.m2m_field_name(): self.pk}) \
+                        .values_list(field.m2m_reverse_field_name(), flat=True)
+                    return related.filter(pk__in=list(ids))
+                related_id = getattr(self, field.attname)
+                if related_id is None:
+                    return None
+                try:
+                    return related.get(pk=related_id)
+                except related_model.DoesNotExist:
+                    return None
+        return getattr(self, name, None)
+
+    def get_snapshot(self):
+        '''
+        the data stored in the snapshot field when this (public)
+        object was published, or None
+        '''
+        snapshot_field = self.PublishMeta.publish_snapshot_field
+        value = snapshot_field and getattr(self, snapshot_field)
+        if not value:
+            return None
+        return json.loads(value)
+
+    def _foreign_key_dependencies(self, public_version):
+        # (model, pk) of publishable objects the public version refers to -
+        # apart from a parent that publishes it through publish_reverse_fields,
+        # which already depends on it (and the two would depend on each other)
+        dependencies = []
+        excluded_fields = self._excluded_fields()
+        for field in self._meta.fields:
+            if field.name in excluded_fields or not isinstance(field, RelatedField):
+                continue
+            if issubclass(field.rel.to, Publishable):
+                if field.related.get_accessor_name() in field.rel.to.PublishMeta.reverse_fields_to_publish():
+                    continue
+                pk = getattr(public_version, field.attname)
+                if pk is not None:
+                    dependencies.append((field.rel.to, pk))
+        return dependencies
     
     def publish_deletions(self, all_published=None, parent=None, dry_run=False):
         '''
         actually delete models that have been marked for deletion
         '''
+        return self._publish_run(self._publish_deletions_steps, dry_run, all_published, parent)
+
+    def _publish_deletions_steps(self, dry_run, all_published, parent):
         if self.publish_state != Publishable.PUBLISH_DELETE:
             return  
 
@@ -393,6 +1262,7 @@ class Publishable(models.Model):
             return
         
         all_published.add(self, parent=parent)
+        started = time.time()
 
         self._pre_publish(dry_run, all_published, deleted=True)
 
@@ -400,22 +1270,847 @@ class Publishable(models.Model):
             if not issubclass(related.model, Publishable):
                 continue
             name = related.get_accessor_name()
-            if name in self.PublishMeta.excluded_fields():
+            if name in self._excluded_fields():
                 continue
             try:
                 instances = getattr(self, name).all()
             except AttributeError:
                 instances = [getattr(self, name)]
             for instance in instances:
-                instance.publish_deletions(all_published=all_published, parent=self, dry_run=dry_run)
+                yield instance._nested_steps('publish_deletions', instance._publish_deletions_steps,
+                                             dry_run, all_published, self)
         
         if not dry_run:
             public = self.public
+            if public:
+                if tracking_dependencies():
+                    # the records go with the public copy, so look them up now
+                    self._public_dependents = PublishDependency.objects.dependent_keys(public)
             self.delete(mark_for_deletion=False)
             if public:
                 public.delete(mark_for_deletion=False)
 
         self._post_publish(dry_run, all_published, deleted=True)
+        record_node(self.__class__, started, rows_written=int(bool(public)) if not dry_run else 0)
+
+
+class VersionedPublishable(Publishable):
+    '''
+    Publishable with a version counter for optimistic concurrency.
+
+    every save (including those done when publishing) writes the row and
+    bumps the version in one UPDATE, conditional on the version being the
+    one this instance was loaded with - if the row has been changed since
+    VersionConflict is raised instead of silently overwriting the other
+    change.  so no row locks need to be held between loading an object and
+    saving or publishing it.
+    '''
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def _excluded_fields(self):
+        # the public copy keeps its own count
+        return super(VersionedPublishable, self)._excluded_fields() + ['version']
+
+    def _version_conflict(self):
+        return VersionConflict("%s %r has been changed by someone else (expected version %d)" %
+                               (self._meta.object_name, self.pk, self.version))
+
+    def _claim_version(self, using=None):
+        # done before publishing, so a stale draft isn't published
+        if self.pk is None:
+            return
+        using = using or router.db_for_write(self.__class__, instance=self)
+        rows = self.__class__._base_manager.using(using).filter(pk=self.pk)
+        if rows.filter(version=self.version).update(version=models.F('version') + 1):
+            self.version += 1
+        elif rows.exists():
+            raise self._version_conflict()
+
+    def save_base(self, raw=False, cls=None, origin=None, force_insert=False, force_update=False, using=None):
+        meta = self._meta
+        if raw or force_insert or self.pk is None or meta.proxy or meta.parents \
+                or cls not in (None, self.__class__):
+            return super(VersionedPublishable, self).save_base(raw=raw, cls=cls, origin=origin,
+                                                               force_insert=force_insert,
+                                                               force_update=force_update, using=using)
+        using = using or router.db_for_write(self.__class__, instance=self)
+        models.signals.pre_save.send(sender=self.__class__, instance=self, raw=raw, using=using)
+
+        values = dict((f.name, f.pre_save(self, False)) for f in meta.local_fields
+                      if not f.primary_key and f.name != 'version')
+        rows = self.__class__._base_manager.using(using).filter(pk=self.pk)
+        updated = rows.filter(version=self.version).update(version=models.F('version') + 1, **values)
+        if updated:
+            self.version += 1
+        elif rows.exists():
+            raise self._version_conflict()
+        elif force_update:
+            raise DatabaseError("Forced update did not affect any rows.")
+        else:
+            # there's no row with this pk yet
+            self.__class__._base_manager._insert([self], fields=meta.local_fields, using=using)
+        transaction.commit_unless_managed(using=using)
+
+        self._state.db = using
+        self._state.adding = False
+        models.signals.post_save.send(sender=self.__class__, instance=self, created=not updated,
+                                      raw=raw, using=using)
+
+
+class TimestampedPublishable(Publishable):
+    '''
+    Publishable that records when its public copy was last published, and
+    a count of how many times - for Last-Modified and ETag headers (see
+    publish.conditional).  with dependency tracking on, public copies that
+    depend on something that gets published are stamped too.
+    '''
+    published_at = models.DateTimeField(null=True, editable=False)
+    publish_version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def _excluded_fields(self):
+        # these belong to the public copy
+        return super(TimestampedPublishable, self)._excluded_fields() + ['published_at', 'publish_version']
+
+    def _mark_published(self):
+        self.published_at = _now()
+        self.publish_version += 1
+
+
+class PublishCursor(models.Model):
+    '''
+    records how far a long running publish (e.g. the publish_pending
+    command) has got, so an interrupted run can carry on where it stopped
+    '''
+    name = models.CharField(max_length=255, unique=True)
+    last_pk = models.CharField(max_length=255)
+    # ids skipped over that may still turn up - see PublishEventManager.consume
+    gaps = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.last_pk)
+
+
+class PublishEventManager(models.Manager):
+
+    def record(self, obj, action):
+        '''
+        append an event for the (public) object
+        '''
+        return self.create(content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk,
+                           action=action, version=getattr(obj, 'publish_version', None))
+
+    def after(self, event_id):
+        '''events that came after the given event id, oldest first'''
+        return self.filter(pk__gt=event_id or 0).order_by('pk')
+
+    # how long (in seconds) to keep looking for events with ids a consumer
+    # has gone past - they were most likely logged by a transaction that
+    # hadn't committed yet, so should be longer than any publish takes
+    gap_timeout = 600
+
+    def consume(self, consumer, batch_size=100):
+        '''
+        iterate over lists of (at most batch_size) events the named consumer
+        has not seen yet.  the consumer's cursor only moves past a batch when
+        the next one is asked for, so if it stops part way through a batch
+        that batch will be handed out again next time.
+
+        ids are handed out as events are logged, not as they are committed,
+        so ids missing below the newest event seen are looked for again
+        (and handed out once they turn up) for gap_timeout seconds
+        '''
+        cursor, created = PublishCursor.objects.get_or_create(name='publish_events:%s' % consumer,
+                                                              defaults={'last_pk': '0'})
+        last_id = int(cursor.last_pk)
+        now = time.time()
+        gaps = [gap for gap in _parse_gaps(cursor.gaps) if now - gap[2] < self.gap_timeout]
+        while True:
+            batch = []
+            if gaps:
+                late = reduce(operator.or_, [Q(pk__range=(lo, hi)) for lo, hi, seen in gaps])
+                batch = list(self.filter(late).order_by('pk')[:batch_size])
+            new = list(self.after(last_id)[:batch_size - len(batch)])
+            batch.extend(new)
+            if not batch:
+                break
+            yield batch
+
+            gaps = _remove_from_gaps(gaps, set(event.pk for event in batch))
+            for event in new:
+                if event.pk > last_id + 1:
+                    gaps.append((last_id + 1, event.pk - 1, now))
+                last_id = event.pk
+            cursor.last_pk = str(last_id)
+            cursor.gaps = _format_gaps(gaps)
+            cursor.save()
+            if len(batch) < batch_size:
+                return
+        if cursor.gaps != _format_gaps(gaps):
+            # some gaps have timed out
+            cursor.gaps = _format_gaps(gaps)
+            cursor.save()
+
+
+def _parse_gaps(value):
+    # "lo-hi@seen" for each gap
+    gaps = []
+    for gap in value.split():
+        ids, seen = gap.split('@')
+        lo, hi = ids.split('-')
+        gaps.append((int(lo), int(hi), int(seen)))
+    return gaps
+
+def _format_gaps(gaps):
+    return ' '.join('%d-%d@%d' % (lo, hi, seen) for lo, hi, seen in gaps)
+
+def _remove_from_gaps(gaps, ids):
+    remaining = []
+    for lo, hi, seen in gaps:
+        start = lo
+        for id in sorted(id for id in ids if lo <= id <= hi):
+            if id > start:
+                remaining.append((start, id - 1, seen))
+            start = id + 1
+        if start <= hi:
+            remaining.append((start, hi, seen))
+    return remaining
+
+
+class PublishEvent(models.Model):
+    '''
+    append-only log of what was published, for other systems (e.g. search
+    indexes) to catch up from - see PublishEventManager.consume()
+    '''
+    ACTION_PUBLISH = 'publish'
+    ACTION_DELETE = 'delete'
+    ACTION_UNPUBLISH = 'unpublish'
+    ACTION_CHOICES = ((ACTION_PUBLISH, 'Publish'), (ACTION_DELETE, 'Delete'), (ACTION_UNPUBLISH, 'Unpublish'))
+
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    # the public object's id
+    object_id = models.PositiveIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    version = models.PositiveIntegerField(null=True)
+    created = models.DateTimeField(default=datetime.now)
+
+    objects = PublishEventManager()
+
+    def __unicode__(self):
+        return u'%s %s:%s' % (self.action, self.content_type_id, self.object_id)
+
+
+def _log_public_deleted(sender, instance, **kw):
+    # public copies deleted by publishing a deletion, tidied up or deleted
+    # along with something else all need an event
+    if isinstance(instance, Publishable) and instance.is_public \
+            and not getattr(instance, '_delete_logged', False):
+        _log_event(instance, PublishEvent.ACTION_DELETE)
+
+models.signals.post_delete.connect(_log_public_deleted)
+
+
+class PublishDependencyManager(models.Manager):
+
+    def _key(self, obj):
+        if isinstance(obj, tuple):
+            model, pk = obj
+        else:
+            model, pk = obj.__class__, obj.pk
+        return (ContentType.objects.get_for_model(model).id, pk)
+
+    def record(self, source, targets):
+        '''
+        record that the (public) source depends on the given targets
+        (instances or (model, pk) tuples), replacing what it depended on before
+        '''
+        source_type_id, source_id = self._key(source)
+        wanted = set(self._key(target) for target in targets)
+        wanted.discard((source_type_id, source_id))
+
+        existing = {}
+        for dependency in self.filter(source_type=source_type_id, source_id=source_id):
+            existing[(dependency.target_type_id, dependency.target_id)] = dependency.id
+
+        stale = [id for key, id in existing.items() if key not in wanted]
+        if stale:
+            self.filter(id__in=stale).delete()
+
+        new = [PublishDependency(source_type_id=source_type_id, source_id=source_id,
+                                 target_type_id=target_type_id, target_id=target_id)
+               for target_type_id, target_id in wanted if (target_type_id, target_id) not in existing]
+        if new:
+            self.bulk_create(new)
+
+    def remove(self, obj):
+        '''
+        forget everything to do with obj (e.g. when it's deleted)
+        '''
+        type_id, pk = self._key(obj)
+        self.filter(Q(source_type=type_id, source_id=pk) | Q(target_type=type_id, target_id=pk)).delete()
+
+    def dependent_keys(self, obj, transitive=True):
+        '''
+        (content type id, pk) of the public objects that depend on obj.
+        each level of the graph is a single (indexed) query on the targets
+        '''
+        if isinstance(obj, Publishable) and not obj.is_public:
+            obj = obj.public
+            if obj is None:
+                return set()
+
+        start = self._key(obj)
+        found = set()
+        frontier = set([start])
+        while frontier:
+            by_type = {}
+            for type_id, pk in frontier:
+                by_type.setdefault(type_id, []).append(pk)
+            q = reduce(operator.or_, [Q(target_type=type_id, target_id__in=pks)
+                                      for type_id, pks in by_type.items()])
+
+            frontier = set()
+            for key in self.filter(q).values_list('source_type', 'source_id'):
+                if key not in found and key != start:
+                    found.add(key)
+                    frontier.add(key)
+            if not transitive:
+                break
+        return found
+
+    def dependents(self, obj, transitive=True):
+        '''
+        the public objects that depend on obj (public or draft),
+        loaded with one query per model
+        '''
+        return list(_load_keys(self.dependent_keys(obj, transitive=transitive)))
+
+
+def _load_keys(keys):
+    pks_by_type = {}
+    for type_id, pk in keys:
+        pks_by_type.setdefault(type_id, []).append(pk)
+    for type_id, pks in pks_by_type.items():
+        model = ContentType.objects.get_for_id(type_id).model_class()
+        queryset = model._default_manager.all()
+        if issubclass(model, Publishable):
+            queryset = queryset.published()
+        for obj in queryset.filter(pk__in=pks):
+            yield obj
+
+
+class PublishDependency(models.Model):
+    '''
+    records that the public object "source" depends on the
+    public object "target" (it refers to it, or has it as
+    a published child), so we can find what to update when
+    target changes without walking the whole graph
+    '''
+    source_type = models.ForeignKey(ContentType, related_name='+')
+    source_id = models.PositiveIntegerField()
+    target_type = models.ForeignKey(ContentType, related_name='+')
+    target_id = models.PositiveIntegerField(db_index=True)
+
+    objects = PublishDependencyManager()
+
+    class Meta:
+        unique_together = [('source_type', 'source_id', 'target_type', 'target_id')]
+
+    def __unicode__(self):
+        return u'%s:%s -> %s:%s' % (self.source_type_id, self.source_id, self.target_type_id, self.target_id)
+
+
+def _remove_dependencies(sender, instance, **kw):
+    if isinstance(instance, Publishable) and instance.is_public and tracking_dependencies():
+        PublishDependency.objects.remove(instance)
+
+models.signals.post_delete.connect(_remove_dependencies)
+
+
+# long enough to count as "never expires" (the memcached
+# backend converts anything over 30 days to a timestamp)
+PUBLISH_VERSION_TIMEOUT = 60 * 60 * 24 * 365
+
+
+def _version_cache():
+    return get_cache(getattr(settings, 'PUBLISH_VERSION_CACHE', 'default'))
+
+
+def _version_key(key):
+    return 'publish-version:%s:%s' % key
+
+
+def get_publish_version(obj):
+    '''
+    a token for the (public) object that changes whenever it, or anything
+    it depends on, is published - for use in cache keys.  needs
+    PUBLISH_CACHE_VERSIONS (and PUBLISH_TRACK_DEPENDENCIES for the
+    dependencies) to be set
+    '''
+    cache = _version_cache()
+    key = _version_key(PublishDependency.objects._key(obj))
+    version = cache.get(key)
+    if version is None:
+        # never seen (or evicted), so anything cached under
+        # an older version must not be used
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, PUBLISH_VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_publish_versions(keys):
+    '''
+    give the objects with the given (content type id, pk) keys new versions
+    '''
+    _version_cache().set_many(dict((_version_key(key), uuid.uuid4().hex) for key in keys),
+                              PUBLISH_VERSION_TIMEOUT)
+
+
+def _stamp_dependents(keys):
+    # the public copies that depend on something that was
+    # published have effectively changed too
+    pks_by_type = {}
+    for type_id, pk in keys:
+        pks_by_type.setdefault(type_id, []).append(pk)
+    now = _now()
+    for type_id, pks in pks_by_type.items():
+        model = ContentType.objects.get_for_id(type_id).model_class()
+        if not issubclass(model, TimestampedPublishable):
+            continue
+        using = get_public_database() or router.db_for_write(model)
+        QuerySet(model).using(using).filter(pk__in=pks) \
+            .update(published_at=now, publish_version=models.F('publish_version') + 1)
+
+
+def _publish_run_finished(sender, all_published, **kw):
+    versioning, tracking = versioning_cache(), tracking_dependencies()
+    published, rewritten, dependents = set(), set(), set()
+    for instance in all_published:
+        if instance.pk is None:
+            # deleted, so whatever depended on it has changed
+            dependents.update(getattr(instance, '_public_dependents', ()))
+            continue
+        if not (versioning or tracking or isinstance(instance, TimestampedPublishable)):
+            # only its own stamp could need updating
+            continue
+        public = instance if instance.is_public else instance.public
+        if public is None:
+            continue
+        key = PublishDependency.objects._key(public)
+        published.add(key)
+        if getattr(instance, '_public_rewritten', True):
+            rewritten.add(key)
+        elif getattr(instance, '_public_children_rewritten', False):
+            dependents.add(key)
+        else:
+            continue
+        if tracking:
+            dependents.update(PublishDependency.objects.dependent_keys(public))
+    # the rewritten copies were stamped as they were saved - anything else
+    # (even if this run visited it) that depends on them needs stamping
+    dependents -= rewritten
+    if dependents:
+        _stamp_dependents(dependents)
+    if versioning and (published or dependents):
+        bump_publish_versions(published | dependents)
+
+post_publish_run.connect(_publish_run_finished)
+
+
+def public_index_sql(model, connection):
+    '''
+    CREATE INDEX statements for the model's publish_public_indexes.
+
+    on PostgreSQL these are partial indexes that only contain the public
+    copies.  other databases can't use a partial index when is_public is
+    passed as a query parameter, so there the index leads with is_public
+    instead - lookups on the public copies still never touch the drafts
+    '''
+    return [sql for index_name, sql in _public_indexes(model, connection)]
+
+
+def _public_indexes(model, connection):
+    # (index name, CREATE INDEX statement) for each of the model's public indexes
+    qn = connection.ops.quote_name
+    opts = model._meta
+    is_public = opts.get_field('is_public').column
+    indexes = []
+    for names in model.PublishMeta.public_indexes():
+        if isinstance(names, basestring):
+            names = [names]
+        columns = [opts.get_field(name).column for name in names]
+        index_name = truncate_name('%s_%s_public' % (opts.db_table, '_'.join(columns)),
+                                   connection.ops.max_name_length())
+        if connection.vendor == 'postgresql':
+            where = ' WHERE %s' % qn(is_public)
+        else:
+            columns = [is_public] + columns
+            where = ''
+        indexes.append((index_name, 'CREATE INDEX %s ON %s (%s)%s;' % (qn(index_name), qn(opts.db_table),
+                                                                       ', '.join(qn(c) for c in columns), where)))
+    return indexes
+
+
+def _existing_index_names(connection, cursor, table):
+    '''
+    the names of the indexes on table, or None if we
+    don't know how to find out for this database
+    '''
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % connection.ops.quote_name(table))
+        return set(row[1] for row in cursor.fetchall())
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+        return set(row[0] for row in cursor.fetchall())
+    if connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return set(row[2] for row in cursor.fetchall())
+    return None
+
+
+def _create_public_indexes(sender, created_models, db=None, **kw):
+    # sent once per app, but created_models covers every app
+    connection = connections[db or 'default']
+    app_models = models.get_models(sender)
+    for model in created_models:
+        if model not in app_models or not issubclass(model, Publishable) \
+                or not router.allow_syncdb(connection.alias, model):
+            continue
+        cursor = connection.cursor()
+        # flush sends post_syncdb for every model, so the
+        # indexes may well exist already
+        existing = _existing_index_names(connection, cursor, model._meta.db_table)
+        for index_name, sql in _public_indexes(model, connection):
+            if existing is not None:
+                if index_name not in existing:
+                    cursor.execute(sql)
+                continue
+            # no way to list the indexes, so only ignore the
+            # error saying the index is already there
+            sid = transaction.savepoint(using=connection.alias)
+            try:
+                cursor.execute(sql)
+            except DatabaseError, e:
+                transaction.savepoint_rollback(sid, using=connection.alias)
+                if 'exist' not in str(e).lower():
+                    raise
+            else:
+                transaction.savepoint_commit(sid, using=connection.alias)
+        transaction.commit_unless_managed(using=connection.alias)
+
+models.signals.post_syncdb.connect(_create_public_indexes)
+
+
+class PublishTreeManager(models.Manager):
+
+    def _rows(self, model, using):
+        return self.using(using).filter(content_type=ContentType.objects.get_for_model(model))
+
+    def _link(self, model, using, pairs):
+        # pairs of (ancestor, descendant, depth)
+        content_type = ContentType.objects.get_for_model(model)
+        self.using(using).bulk_create([
+            PublishTreeClosure(content_type=content_type, ancestor_id=a, descendant_id=d, depth=depth)
+            for a, d, depth in pairs])
+
+    def check_parent(self, model, using, pks, parent_id):
+        '''
+        raise PublishException if giving the objects with the given pks
+        the parent parent_id would make a cycle (i.e. it's one of them,
+        or below one of them)
+        '''
+        if parent_id is None or not pks:
+            return
+        if parent_id in pks or self._rows(model, using).filter(ancestor_id__in=pks, descendant_id=parent_id).exists():
+            raise PublishException("Cannot move %s under itself" % model._meta.object_name)
+
+    def node_saving(self, obj):
+        '''
+        raise PublishException if obj (which already exists) is about to
+        be moved under itself.  the links node_saved needs are fetched by
+        the same query
+        '''
+        model, using = obj.__class__, obj._state.db or router.db_for_write(obj.__class__)
+        parent_id = getattr(obj, _tree_field(model, model.PublishMeta.publish_tree_field).attname)
+        existing = {}
+        for ancestor_id, descendant_id, depth in self._rows(model, using) \
+                .filter(Q(descendant_id=obj.pk, depth__lte=1) | Q(ancestor_id=obj.pk, descendant_id=parent_id)) \
+                .values_list('ancestor_id', 'descendant_id', 'depth'):
+            if ancestor_id == obj.pk and descendant_id == parent_id:
+                raise PublishException("Cannot move %s under itself" % model._meta.object_name)
+            if descendant_id == obj.pk and depth <= 1:
+                existing[depth] = ancestor_id
+        obj._tree_links = existing
+
+    def node_saved(self, obj):
+        '''
+        update the closure table for obj, which may be new or have a new parent
+        '''
+        model, using = obj.__class__, obj._state.db
+        rows = self._rows(model, using)
+        parent_id = getattr(obj, _tree_field(model, model.PublishMeta.publish_tree_field).attname)
+
+        existing = getattr(obj, '_tree_links', None)
+        obj._tree_links = None
+        if existing is None:
+            existing = dict((depth, a) for a, depth in
+                            rows.filter(descendant_id=obj.pk, depth__lte=1).values_list('ancestor_id', 'depth'))
+        if 0 in existing and existing.get(1) == parent_id:
+            return
+
+        if 0 in existing:
+            # moved, so detach the whole subtree from its old ancestors
+            subtree = list(rows.filter(ancestor_id=obj.pk).values_list('descendant_id', 'depth'))
+            subtree_ids = [d for d, depth in subtree]
+            rows.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        else:
+            subtree = [(obj.pk, 0)]
+            self._link(model, using, [(obj.pk, obj.pk, 0)])
+
+        if parent_id is not None:
+            ancestors = list(rows.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth'))
+            self._link(model, using, [(a, d, a_depth + d_depth + 1)
+                                      for a, a_depth in ancestors
+                                      for d, d_depth in subtree])
+
+    def node_deleted(self, obj):
+        self._rows(obj.__class__, obj._state.db).filter(Q(descendant_id=obj.pk) | Q(ancestor_id=obj.pk)).delete()
+
+    def rebuild(self, model, using=None):
+        '''
+        recreate the closure table for every (draft and public) object of
+        model - e.g. after turning on publish_tree_field for existing data
+        '''
+        using = using or router.db_for_write(model)
+        field = _tree_field(model, model.PublishMeta.publish_tree_field)
+        parents = dict(QuerySet(model).using(using).values_list('pk', field.attname))
+        pairs = []
+        for pk in parents:
+            ancestor, depth, seen = pk, 0, set()
+            while ancestor is not None:
+                if ancestor in seen:
+                    raise PublishException("Cycle in %s tree at %s" % (model._meta.object_name, pk))
+                seen.add(ancestor)
+                pairs.append((ancestor, pk, depth))
+                ancestor, depth = parents.get(ancestor), depth + 1
+        self._rows(model, using).delete()
+        for chunk in _chunked(pairs, 500):
+            self._link(model, using, chunk)
+
+    def _related(self, obj, join_column, match_column, include_self, descending):
+        model = obj.__class__
+        connection = connections[obj._state.db or router.db_for_read(model)]
+        qn = connection.ops.quote_name
+        closure, table = qn(PublishTreeClosure._meta.db_table), qn(model._meta.db_table)
+        where = ['%s.%s = %s.%s' % (closure, join_column, table, qn(model._meta.pk.column)),
+                 '%s.content_type_id = %%s' % closure,
+                 '%s.%s = %%s' % (closure, match_column)]
+        if not include_self:
+            where.append('%s.depth > 0' % closure)
+        return QuerySet(model).using(connection.alias).extra(
+            tables=[PublishTreeClosure._meta.db_table], where=where,
+            params=[ContentType.objects.get_for_model(model).id, obj.pk],
+            select={'tree_depth': '%s.depth' % closure},
+            order_by=[descending and '-tree_depth' or 'tree_depth'])
+
+    def ancestors(self, obj, include_self=False):
+        '''
+        obj's ancestors (in the same - draft or public - tree), root first
+        '''
+        return self._related(obj, 'ancestor_id', 'descendant_id', include_self, True)
+
+    def descendants(self, obj, include_self=False):
+        '''
+        everything below obj, nearest first
+        '''
+        return self._related(obj, 'descendant_id', 'ancestor_id', include_self, False)
+
+
+class PublishTreeClosure(models.Model):
+    '''
+    closure table for models with a PublishMeta.publish_tree_field: a row
+    for every (ancestor, descendant) pair in each tree - including every
+    object with itself, at depth 0 - so that ancestors and descendants can
+    be found with one query (see PublishTreeManager)
+    '''
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    ancestor_id = models.PositiveIntegerField()
+    descendant_id = models.PositiveIntegerField(db_index=True)
+    depth = models.PositiveIntegerField()
+
+    objects = PublishTreeManager()
+
+    class Meta:
+        unique_together = [('content_type', 'ancestor_id', 'descendant_id')]
+
+    def __unicode__(self):
+        return u'%s:%s -> %s (%d)' % (self.content_type_id, self.ancestor_id, self.descendant_id, self.depth)
+
+
+def _is_tree(instance):
+    return isinstance(instance, Publishable) and instance.PublishMeta.publish_tree_field
+
+def _tree_node_saving(sender, instance, raw=False, **kw):
+    # refuse to move a draft under itself, before it's saved
+    if _is_tree(instance) and not instance.is_public and not raw and instance.pk is not None:
+        PublishTreeClosure.objects.node_saving(instance)
+
+def _tree_node_saved(sender, instance, **kw):
+    if _is_tree(instance):
+        PublishTreeClosure.objects.node_saved(instance)
+
+def _tree_node_deleted(sender, instance, **kw):
+    if _is_tree(instance):
+        PublishTreeClosure.objects.node_deleted(instance)
+
+models.signals.pre_save.connect(_tree_node_saving)
+models.signals.post_save.connect(_tree_node_saved)
+models.signals.post_delete.connect(_tree_node_deleted)
+
+
+class PublishScheduleManager(models.Manager):
+
+    def for_object(self, obj, action=None):
+        content_type = ContentType.objects.get_for_model(obj)
+        queryset = self.filter(content_type=content_type, object_id=obj.pk)
+        if action is not None:
+            queryset = queryset.filter(action=action)
+        return queryset
+
+    def schedule(self, obj, action, when):
+        if obj.is_public:
+            raise PublishException("Cannot schedule public model - schedule the draft model instead")
+        if obj.pk is None:
+            raise PublishException("Please save model before scheduling it")
+
+        content_type = ContentType.objects.get_for_model(obj)
+        scheduled, created = self.get_or_create(content_type=content_type, object_id=obj.pk,
+                                                action=action, defaults={'due': when})
+        if not created and (scheduled.due != when or scheduled.attempts):
+            scheduled.due = when
+            scheduled.attempts = 0
+            scheduled.last_error = ''
+            scheduled.save()
+        return scheduled
+
+    # a failed item is tried again after retry_delay, until
+    # it has failed max_attempts times
+    retry_delay = timedelta(minutes=5)
+    max_attempts = 5
+
+    def due(self, now=None):
+        '''
+        scheduled items that are due, oldest first.
+        this is a range scan over the index on "due"
+        '''
+        if now is None:
+            now = _now()
+        return self.filter(due__lte=now, attempts__lt=self.max_attempts).order_by('due', 'id')
+
+    def failed(self):
+        '''items that have given up after failing max_attempts times'''
+        return self.filter(attempts__gte=self.max_attempts)
+
+    def run_due(self, batch_size=100, now=None):
+        '''
+        publish/unpublish a batch of due items, locking the schedule
+        rows while we do so.  returns the number of items processed.
+
+        an item that fails is rolled back (to a savepoint, where the
+        database supports them), has the error recorded and is moved
+        back by retry_delay - so it doesn't hold up the others
+        '''
+        if now is None:
+            now = _now()
+        runs = []
+        with transaction.commit_on_success(using=self.db):
+            batch = list(self.due(now).select_for_update()[:batch_size])
+            if not batch:
+                return 0
+
+            objects = self._load_objects(batch)
+            done = []
+            for scheduled in batch:
+                obj = objects.get((scheduled.content_type_id, scheduled.object_id))
+                if obj is None:
+                    done.append(scheduled.id)
+                    continue
+                savepoint = transaction.savepoint(using=self.db)
+                try:
+                    all_published = NestedSet()
+                    with _instrumented_run(obj.__class__, scheduled.action):
+                        scheduled.run(obj, all_published)
+                except Exception:
+                    transaction.savepoint_rollback(savepoint, using=self.db)
+                    self.filter(id=scheduled.id).update(attempts=models.F('attempts') + 1,
+                                                        last_error=traceback.format_exc(),
+                                                        due=now + self.retry_delay)
+                else:
+                    transaction.savepoint_commit(savepoint, using=self.db)
+                    done.append(scheduled.id)
+                    if all_published:
+                        runs.append((obj.__class__, all_published))
+            self.filter(id__in=done).delete()
+
+        # now everything is committed
+        for sender, all_published in runs:
+            post_publish_run.send(sender=sender, all_published=all_published)
+        return len(batch)
+
+    def _load_objects(self, batch):
+        # one query per model, rather than one per scheduled item
+        object_ids = {}
+        for scheduled in batch:
+            object_ids.setdefault(scheduled.content_type_id, []).append(scheduled.object_id)
+
+        objects = {}
+        for content_type_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                continue
+            for pk, obj in model._default_manager.in_bulk(ids).items():
+                objects[(content_type_id, pk)] = obj
+        return objects
+
+
+class PublishSchedule(models.Model):
+    '''
+    a publish or unpublish that should happen at a set time
+    '''
+    ACTION_PUBLISH   = 'publish'
+    ACTION_UNPUBLISH = 'unpublish'
+
+    ACTION_CHOICES = ((ACTION_PUBLISH, 'Publish'), (ACTION_UNPUBLISH, 'Unpublish'))
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    due = models.DateTimeField(db_index=True)
+    # how many times running this has failed, and the last error
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = PublishScheduleManager()
+
+    class Meta:
+        ordering = ['due']
+        unique_together = [('content_type', 'object_id', 'action')]
+
+    def __unicode__(self):
+        return u'%s %s at %s' % (self.get_action_display(), self.content_object, self.due)
+
+    def run(self, obj, all_published=None):
+        if self.action == PublishSchedule.ACTION_UNPUBLISH:
+            return obj.unpublish()
+        return obj.publish(all_published=all_published)
 
 
 if getattr(settings, 'TESTING_PUBLISH', False):
@@ -437,6 +2132,9 @@ if getattr(settings, 'TESTING_PUBLISH', False):
 
         class Meta:
             ordering = ['url']
+
+        class PublishMeta(Publishable.PublishMeta):
+            publish_public_indexes = ['url']
         
         def get_absolute_url(self):
             if self.is_public:
@@ -510,4 +2208,62 @@ if getattr(settings, 'TESTING_PUBLISH', False):
         page_tag=models.ForeignKey(Tag)
         tag_order=models.IntegerField()
 
+    class Article(VersionedPublishable):
+        title = models.CharField(max_length=200)
+        content = models.TextField(blank=True)
+
+    class Folder(Publishable):
+        name = models.CharField(max_length=100)
+        parent = models.ForeignKey('self', null=True, blank=True)
+
+        class PublishMeta(Publishable.PublishMeta):
+            publish_tree_field = 'parent'
+
+    class Gallery(Publishable):
+        title = models.CharField(max_length=200)
+        site = models.ForeignKey(Site, null=True, blank=True)
+        snapshot = models.TextField(blank=True, editable=False)
+
+        class PublishMeta(Publishable.PublishMeta):
+            publish_reverse_fields = ['galleryimage_set']
+            publish_snapshot_field = 'snapshot'
+            publish_snapshot_related = ['galleryimage_set', 'site']
+            publish_propagate_changes = True
+
+    class GalleryImage(Publishable):
+        gallery = models.ForeignKey(Gallery)
+        caption = models.CharField(max_length=200)
+
+    class Slideshow(Publishable):
+        title = models.CharField(max_length=200)
+
+        class PublishMeta(Publishable.PublishMeta):
+            publish_reverse_fields = ['slide_set']
+
+    class Slide(Publishable):
+        # overrides publish, to check nested publishes go through it
+        slideshow = models.ForeignKey(Slideshow)
+        caption = models.CharField(max_length=200)
+
+        published = []
+
+        def publish(self, dry_run=False, all_published=None, parent=None):
+            Slide.published.append((self.caption, parent))
+            return super(Slide, self).publish(dry_run=dry_run, all_published=all_published, parent=parent)
+
+        def publish_deletions(self, all_published=None, parent=None, dry_run=False):
+            Slide.published.append(('deleted ' + self.caption, parent))
+            return super(Slide, self).publish_deletions(all_published=all_published, parent=parent, dry_run=dry_run)
+
+    class Note(TimestampedPublishable):
+        gallery = models.ForeignKey(Gallery, null=True, blank=True)
+        text = models.TextField(blank=True)
+
+        class PublishMeta(Publishable.PublishMeta):
+            publish_reverse_fields = ['noteattachment_set']
+
+    class NoteAttachment(Publishable):
+        note = models.ForeignKey(Note)
+        name = models.CharField(max_length=100)
+
 
@@ -4,3 +4,12 @@ import django.dispatch
 # was being deleted (rather than changed)
 pre_publish  = django.dispatch.Signal(providing_args=['instance', 'deleted'])
 post_publish = django.dispatch.Signal(providing_args=['instance', 'deleted'])
+
+# sent once a whole publish run (e.g. publishing an object and everything
+# it pulled in, or a whole queryset) has finished.  all_published is the
+# NestedSet of every (draft) object that was published
+post_publish_run = django.dispatch.Signal(providing_args=['all_published'])
+
+# sent once an object has been unpublished (its public version deleted).
+# instance is the draft object
+post_unpublish = django.dispatch.Signal(providing_args=['instance'])
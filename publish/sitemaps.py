@@ -0,0 +1,259 @@
+'''
+Sitemaps for large numbers of published objects.
+
+Rather than loading every object (as django.contrib.sitemaps does) the
+published rows are streamed in primary key order, a chunk at a time,
+fetching just a precomputed location (e.g. a path field) and last
+modified time.  Each section gets as many child files as it needs,
+and an index file lists all of them:
+
+    sitemap = StreamingSitemap('/var/www/sitemaps', 'http://example.com', [
+        SitemapSection('pages', Page, 'path', lastmod_field='published_at'),
+    ])
+    sitemap.generate()
+
+connect() marks the sections whose models get published (or unpublished)
+as dirty, rather than rewriting them there and then, and
+generate_dirty() - run it regularly, outside of any request - rewrites
+just those sections:
+
+    sitemap.connect()
+    ...
+    sitemap.generate_dirty()
+'''
+import os
+import re
+import errno
+import tempfile
+from itertools import islice
+from xml.sax.saxutils import escape
+
+from signals import post_publish_run, post_unpublish
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _file_mode():
+    # the permissions open() would give a new file - mkstemp's are
+    # only readable by us (and the umask can only be read by setting it)
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+class _AtomicFile(object):
+    # writes to a temp file alongside path, which is moved into place
+    # once closed - so nobody ever sees a half-written sitemap
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        _makedirs(directory)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.sitemap-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        self.file.write(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.chmod(self.tmp_path, _file_mode())
+            os.rename(self.tmp_path, self.path)
+        else:
+            os.unlink(self.tmp_path)
+
+
+class SitemapSection(object):
+    '''
+    the published objects of one model.  location_field should hold the
+    object's path (or anything location() can turn into a path) so no
+    other rows need loading to work out the URL
+    '''
+    changefreq = None
+    priority = None
+
+    def __init__(self, name, model, location_field, lastmod_field=None, queryset=None, chunk_size=1000):
+        self.name = name
+        self.model = model
+        self.location_field = location_field
+        self.lastmod_field = lastmod_field
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+
+    def get_queryset(self):
+        if self.queryset is not None:
+            return self.queryset.published()
+        return self.model._default_manager.published()
+
+    def rows(self):
+        '''
+        stream (location, lastmod) for each published object, paging
+        through by primary key so only one chunk is held at a time
+        '''
+        fields = ['pk', self.location_field]
+        if self.lastmod_field:
+            fields.append(self.lastmod_field)
+        queryset = self.get_queryset().order_by('pk').values_list(*fields)
+        last_pk = None
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            count = 0
+            for row in chunk[:self.chunk_size].iterator():
+                count += 1
+                last_pk = row[0]
+                yield self.location(row[1]), row[2] if self.lastmod_field else None
+            if count < self.chunk_size:
+                break
+
+    def location(self, value):
+        '''the path of an object, given its location_field'''
+        return value
+
+
+class StreamingSitemap(object):
+    index_name = 'sitemap.xml'
+    # the most urls the sitemap protocol allows per file
+    limit = 50000
+
+    def __init__(self, output_dir, base_url, sections, sitemap_url=None):
+        self.output_dir = output_dir
+        self.base_url = base_url.rstrip('/')
+        self.sections = sections
+        # where the sitemap files themselves are served from
+        self.sitemap_url = (sitemap_url or self.base_url).rstrip('/')
+
+    def connect(self):
+        post_publish_run.connect(self._publish_run, dispatch_uid='publish-sitemap-%d' % id(self))
+        post_unpublish.connect(self._unpublished, dispatch_uid='publish-sitemap-%d' % id(self))
+
+    def disconnect(self):
+        post_publish_run.disconnect(dispatch_uid='publish-sitemap-%d' % id(self))
+        post_unpublish.disconnect(dispatch_uid='publish-sitemap-%d' % id(self))
+
+    def _file_name(self, section, number):
+        return '%s-%d.xml' % (section.name, number)
+
+    def _section_files(self, section):
+        pattern = re.compile(r'^%s-(\d+)\.xml$' % re.escape(section.name))
+        try:
+            names = os.listdir(self.output_dir)
+        except OSError:
+            return []
+        numbered = []
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                numbered.append((int(match.group(1)), name))
+        return [name for number, name in sorted(numbered)]
+
+    def _url_entry(self, location, lastmod, section):
+        parts = [u'<url><loc>%s</loc>' % escape(self.base_url + location)]
+        if lastmod is not None:
+            parts.append(u'<lastmod>%s</lastmod>' % lastmod.strftime('%Y-%m-%d'))
+        if section.changefreq:
+            parts.append(u'<changefreq>%s</changefreq>' % section.changefreq)
+        if section.priority is not None:
+            parts.append(u'<priority>%.1f</priority>' % section.priority)
+        parts.append(u'</url>\n')
+        return u''.join(parts)
+
+    def write_section(self, section):
+        '''
+        (re)write the child files for a section, returning how many there are
+        '''
+        rows = iter(section.rows())
+        number = 0
+        for location, lastmod in rows:
+            number += 1
+            with _AtomicFile(os.path.join(self.output_dir, self._file_name(section, number))) as out:
+                out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+                out.write(self._url_entry(location, lastmod, section))
+                # carry on with the same rows, up to the limit for this file
+                for location, lastmod in islice(rows, self.limit - 1):
+                    out.write(self._url_entry(location, lastmod, section))
+                out.write('</urlset>\n')
+
+        # tidy up files left from when the section was bigger
+        keep = set(self._file_name(section, n) for n in range(1, number + 1))
+        for name in self._section_files(section):
+            if name not in keep:
+                os.unlink(os.path.join(self.output_dir, name))
+        return number
+
+    def write_index(self):
+        with _AtomicFile(os.path.join(self.output_dir, self.index_name)) as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for section in self.sections:
+                for name in self._section_files(section):
+                    out.write(u'<sitemap><loc>%s</loc></sitemap>\n' % escape('%s/%s' % (self.sitemap_url, name)))
+            out.write('</sitemapindex>\n')
+
+    def generate(self, sections=None):
+        '''
+        write the given sections (by default all of them) and the index
+        '''
+        if sections is None:
+            sections = self.sections
+        for section in sections:
+            # cleared first, so a publish while we write marks it again
+            self._clear_dirty(section)
+            self.write_section(section)
+        self.write_index()
+
+    def sections_for(self, all_published):
+        '''the sections that contain a model that was published'''
+        models = set(instance.__class__ for instance in all_published)
+        return [section for section in self.sections if section.model in models]
+
+    def _dirty_marker(self, section):
+        return os.path.join(self.output_dir, '.%s.dirty' % section.name)
+
+    def mark_dirty(self, sections):
+        '''
+        note that sections need rewriting by generate_dirty() - with a
+        file, so it works whichever process does the publishing
+        '''
+        for section in sections:
+            _makedirs(self.output_dir)
+            open(self._dirty_marker(section), 'a').close()
+
+    def _clear_dirty(self, section):
+        try:
+            os.unlink(self._dirty_marker(section))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def dirty_sections(self):
+        return [section for section in self.sections if os.path.exists(self._dirty_marker(section))]
+
+    def generate_dirty(self):
+        '''
+        write the sections marked dirty (and the index), returning them
+        '''
+        sections = self.dirty_sections()
+        if sections:
+            self.generate(sections)
+        return sections
+
+    def _publish_run(self, sender, all_published, **kw):
+        self.mark_dirty(self.sections_for(all_published))
+
+    def _unpublished(self, sender, instance, **kw):
+        self.mark_dirty(self.sections_for([instance]))
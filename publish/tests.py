@@ -1,25 +1,57 @@
 from django.conf import settings
  
 if getattr(settings, 'TESTING_PUBLISH', False):
+    import os
+    import sys
+    import time
+    import shutil
+    import inspect
+    import tempfile
     import unittest
+    import warnings
+    from datetime import datetime, timedelta
+    from StringIO import StringIO
+
     from django.test import TransactionTestCase
+    from django.test.client import RequestFactory
     from django.contrib.admin.sites import AdminSite
+    from django.contrib.admin.models import LogEntry
     from django.contrib.auth.models import User
-    from django.forms.models import ModelChoiceField, ModelMultipleChoiceField
+    from django.contrib.contenttypes.models import ContentType
+    from django.forms.models import ModelChoiceField, ModelMultipleChoiceField, inlineformset_factory
     from django.conf.urls.defaults import *
+    from django.core.cache import cache
     from django.core.exceptions import PermissionDenied
-    from django.http import Http404
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+    from django.core.signals import request_started
+    from django.db import connection, connections, reset_queries, DEFAULT_DB_ALIAS
+    from django.db.models import get_app
+    from django.db.models.query import QuerySet
+    from django.db.models.signals import pre_save
+    from django.http import Http404, HttpResponse
+    from django.utils.http import http_date
     
     from publish.models import Publishable, FlatPage, Site, Page, PageBlock, \
                                Author, AuthorProfile, Tag, PageTagOrder, Comment, update_pub_date, \
-                               PublishException, UnpublishException
+                               PublishException, UnpublishException, Article, VersionConflict, \
+                               Gallery, GalleryImage, Note, NoteAttachment, Slideshow, Slide, Folder, \
+                               PublishCursor, PublishSchedule, PublishDependency, PublishEvent, PublishTreeClosure, \
+                               get_public_database, get_publish_version, bump_publish_versions, public_index_sql, \
+                               _now, _run_steps, _Result, _create_public_indexes, _existing_index_names
                                
-    from publish.admin import PublishableAdmin, PublishableStackedInline
+    from publish.admin import PublishableAdmin, PublishableStackedInline, PublishableBaseInlineFormSet
     from publish.actions import publish_selected, unpublish_selected, delete_selected, \
-                                _convert_all_published_to_html, undelete_selected
-    from publish.utils import NestedSet
-    from publish.signals import pre_publish, post_publish
+                                _convert_all_published_to_html, undelete_selected, _lock_for_publish
+    from publish.utils import NestedSet, CompactNestedSet
+    from publish.signals import pre_publish, post_publish, post_publish_run
     from publish.filters import PublishableRelatedFieldListFilter
+    from publish.conditional import publish_etag, publish_last_modified, conditional_response
+    from publish.sitemaps import StreamingSitemap, SitemapSection
+    from publish.metrics import get_metrics, metrics_view, _QueryCounter
+    from publish.explain import recent_reports
+    from publish.estimate import estimate_publish
+    from publish.management.commands import publish_pending
 
     
     def _get_rendered_content(response):
@@ -29,6 +61,97 @@ if getattr(settings, 'TESTING_PUBLISH', False):
         return response.content
 
 
+    def _create_flat_pages(count, url='/page%d'):
+        return [FlatPage.objects.create(url=url % i, title='Page %d' % i) for i in range(count)]
+
+
+    def _create_page_graph(blocks=1):
+        '''
+            a page with a parent, an author and some blocks - returned
+            as (parent, page, author, block, ...)
+        '''
+        parent = Page.objects.create(slug='parent', title='Parent')
+        page = Page.objects.create(slug='page', title='Page', parent=parent)
+        author = Author.objects.create(name='author')
+        page.authors.add(author)
+        return (parent, page, author) + tuple(PageBlock.objects.create(page=page, content='block')
+                                              for i in range(blocks))
+
+
+    def _admin_site(*models):
+        '''
+            an admin site with models registered (as PublishableAdmins)
+            and its urls in use, for the admin actions to render with
+        '''
+        admin_site = AdminSite('Test Admin')
+        for model in models:
+            admin_site.register(model, PublishableAdmin)
+        settings.ROOT_URLCONF = patterns('',
+            ('^admin/', include(admin_site.urls)),
+        )
+        return admin_site
+
+
+    def _dummy_request(post=None, denied=()):
+        '''
+            a request for the admin actions, from a user with every
+            permission except those denied.  messages sent to the user
+            (when posting) are kept in request.messages
+        '''
+        class dummy_request(object):
+            META = {}
+            POST = post or {}
+            messages = []
+
+            class user(object):
+                pk = 1
+
+                @classmethod
+                def is_authenticated(cls):
+                    return True
+
+                @classmethod
+                def has_perm(cls, perm):
+                    return perm not in denied
+
+                @classmethod
+                def get_and_delete_messages(cls):
+                    return []
+
+                class message_set(object):
+                    @classmethod
+                    def create(cls, message=None):
+                        pass
+
+        if post:
+            class _messages(object):
+                @classmethod
+                def add(cls, *message):
+                    dummy_request.messages.append(message)
+            dummy_request._messages = _messages
+        return dummy_request
+
+
+    class SettingsTestCase(TransactionTestCase):
+        '''
+            settings changed with set_setting are put back
+            as they were once the test has finished
+        '''
+
+        def setUp(self):
+            super(SettingsTestCase, self).setUp()
+            self._old_settings = []
+
+        def tearDown(self):
+            for name, value in reversed(self._old_settings):
+                setattr(settings, name, value)
+            super(SettingsTestCase, self).tearDown()
+
+        def set_setting(self, name, value):
+            self._old_settings.append((name, getattr(settings, name, None)))
+            setattr(settings, name, value)
+
+
     class TestNestedSet(unittest.TestCase):
         
         def setUp(self):
@@ -1623,3 +1746,2196 @@ if getattr(settings, 'TESTING_PUBLISH', False):
             pk, label = lookup_choices[0]
             self.failUnlessEqual(self.author.id, pk)
 
+
+    class _QueryBudgetContext(object):
+        '''
+            like django's assertNumQueries, but reports the
+            SQL that was run (marking any queries over budget)
+            so it's easy to see what crept in
+        '''
+
+        def __init__(self, test_case, budget, connection, description=None):
+            self.test_case = test_case
+            self.budget = budget
+            self.connection = connection
+            self.description = description
+
+        def __enter__(self):
+            self.old_debug_cursor = self.connection.use_debug_cursor
+            self.connection.use_debug_cursor = True
+            self.starting_queries = len(self.connection.queries)
+            request_started.disconnect(reset_queries)
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self.connection.use_debug_cursor = self.old_debug_cursor
+            request_started.connect(reset_queries)
+            if exc_type is not None:
+                return
+
+            self.captured = self.connection.queries[self.starting_queries:]
+            executed = len(self.captured)
+            if executed != self.budget:
+                self.test_case.fail(self._format_failure(executed))
+
+        def _format_failure(self, executed):
+            lines = ['%s ran %d queries, budget is %d (%+d):' % (
+                        self.description or 'Block', executed, self.budget, executed - self.budget)]
+            for i, query in enumerate(self.captured):
+                marker = '+' if i >= self.budget else ' '
+                lines.append('%s %3d. %s' % (marker, i + 1, query['sql']))
+            if executed < self.budget:
+                lines.append('- (%d fewer queries than budgeted - lower the budget)' % (self.budget - executed))
+            return '\n'.join(lines)
+
+
+    class QueryBudgetTestCase(TransactionTestCase):
+
+        def assertQueryBudget(self, budget, func=None, *args, **kwargs):
+            using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+            description = kwargs.pop('description', None)
+            if description is None and func is not None:
+                description = getattr(func, '__name__', None)
+
+            context = _QueryBudgetContext(self, budget, connections[using], description)
+            if func is None:
+                return context
+
+            with context:
+                func(*args, **kwargs)
+
+
+    class TestQueryBudgetHelper(QueryBudgetTestCase):
+
+        def test_within_budget(self):
+            self.assertQueryBudget(1, FlatPage.objects.count)
+
+        def test_over_budget_lists_queries(self):
+            try:
+                with self.assertQueryBudget(1, description='Two counts'):
+                    FlatPage.objects.count()
+                    Page.objects.count()
+            except AssertionError as e:
+                message = str(e)
+                self.failUnless(message.startswith('Two counts ran 2 queries, budget is 1 (+1):'))
+                self.failUnless('publish_flatpage' in message)
+                self.failUnless('+   2. ' in message)
+            else:
+                self.fail('Query budget should have been exceeded')
+
+
+    class TestPublishQueryBudget(QueryBudgetTestCase):
+
+        def setUp(self):
+            super(TestPublishQueryBudget, self).setUp()
+            self.flat_page = FlatPage.objects.create(url='/budget', title='Budget')
+
+            self.parent, self.page, self.author, self.block1, self.block2 = _create_page_graph(blocks=2)
+
+        def _page(self):
+            return Page.objects.get(pk=self.page.pk)
+
+        def test_publish_flat_page(self):
+            self.assertQueryBudget(5, self.flat_page.publish)
+
+        def test_publish_flat_page_unchanged(self):
+            self.flat_page.publish()
+            flat_page = FlatPage.objects.get(pk=self.flat_page.pk)
+            self.assertQueryBudget(3, flat_page.publish)
+
+        def test_publish_page_graph(self):
+            self.assertQueryBudget(37, self._page().publish)
+
+        def test_republish_page_graph(self):
+            self._page().publish()
+            page = self._page()
+            page.title = 'Page (edited)'
+            page.save()
+            self.assertQueryBudget(18, page.publish)
+
+        def test_dry_run_page_graph(self):
+            self.assertQueryBudget(12, self._page().publish, dry_run=True)
+
+        def test_publish_deletions(self):
+            self._page().publish()
+            page = self._page()
+            page.delete()
+            self.assertQueryBudget(23, page.publish_deletions)
+
+        def test_unpublish(self):
+            self.flat_page.publish()
+            flat_page = FlatPage.objects.get(pk=self.flat_page.pk)
+            self.assertQueryBudget(6, flat_page.unpublish)
+
+        def test_publish_selected(self):
+            page_admin = PublishableAdmin(Page, _admin_site())
+            pages = Page.objects.draft().filter(pk__in=[self.parent.pk, self.page.pk])
+            self.assertQueryBudget(49, publish_selected, page_admin, _dummy_request({'post': True}), pages)
+
+        def test_unpublish_selected(self):
+            Page.objects.draft().publish()
+            page_admin = PublishableAdmin(Page, _admin_site())
+            pages = Page.objects.draft().filter(pk__in=[self.parent.pk, self.page.pk])
+            self.assertQueryBudget(32, unpublish_selected, page_admin, _dummy_request({'post': True}), pages)
+
+
+    class TestPublishPendingCommand(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishPendingCommand, self).setUp()
+            self.pages = _create_flat_pages(5)
+
+        def _call(self, *arg, **kw):
+            out = StringIO()
+            call_command('publish_pending', *arg, stdout=out, **kw)
+            return out.getvalue()
+
+        def test_publishes_changed_in_chunks(self):
+            output = self._call('publish.FlatPage', chunk_size=2)
+
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+            self.failUnlessEqual(5, FlatPage.objects.published().count())
+            self.failUnless('publish.FlatPage changed: 2/5' in output)
+            self.failUnless('publish.FlatPage changed: 4/5' in output)
+            self.failUnless('publish.FlatPage changed: 5/5' in output)
+            self.failUnless('Published 5 objects in total' in output)
+            # cursor is removed once a run is complete
+            self.failUnlessEqual(0, PublishCursor.objects.count())
+
+        def test_publishes_deletions(self):
+            FlatPage.objects.draft().publish()
+            for page in FlatPage.objects.draft()[:2]:
+                page.delete()
+            self.failUnlessEqual(2, FlatPage.objects.deleted().count())
+
+            self._call('publish.FlatPage', chunk_size=1)
+
+            self.failUnlessEqual(0, FlatPage.objects.deleted().count())
+            self.failUnlessEqual(3, FlatPage.objects.draft().count())
+            self.failUnlessEqual(3, FlatPage.objects.published().count())
+
+        def test_resumes_from_cursor(self):
+            PublishCursor.objects.create(name='publish_pending:publish.flatpage:changed',
+                                         last_pk=str(self.pages[2].pk))
+
+            output = self._call('publish.FlatPage', chunk_size=10)
+
+            self.failUnless('resuming after pk %d' % self.pages[2].pk in output)
+            self.failUnlessEqual(self.pages[:3], list(FlatPage.objects.changed()))
+            self.failUnlessEqual(0, PublishCursor.objects.count())
+
+        def test_restart_ignores_cursor(self):
+            PublishCursor.objects.create(name='publish_pending:publish.flatpage:changed',
+                                         last_pk=str(self.pages[2].pk))
+
+            self._call('publish.FlatPage', restart=True)
+
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+
+        def test_sends_post_publish_run_per_chunk(self):
+            runs = []
+            def handler(sender, all_published, **kw):
+                runs.append(sorted(p.url for p in all_published))
+            post_publish_run.connect(handler)
+            try:
+                self._call('publish.FlatPage', chunk_size=2, verbosity=0)
+            finally:
+                post_publish_run.disconnect(handler)
+            self.failUnlessEqual([['/page0', '/page1'], ['/page2', '/page3'], ['/page4']], runs)
+
+        def test_defaults_to_all_publishable_models(self):
+            page = Page.objects.create(slug='page', title='Page')
+
+            self._call(verbosity=0)
+
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+            self.failUnlessEqual([], list(Page.objects.changed()))
+
+        def test_rejects_non_publishable_model(self):
+            command = publish_pending.Command()
+            self.failUnlessEqual([FlatPage], command._get_models(['publish.FlatPage']))
+            self.assertRaises(CommandError, command._get_models, ['publish.Site'])
+            self.assertRaises(CommandError, command._get_models, ['publish.NoSuchModel'])
+            self.assertRaises(CommandError, command._get_models, ['publish'])
+
+
+    class TestPublishSchedule(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishSchedule, self).setUp()
+            self.now = datetime.now()
+            self.flat_page1 = FlatPage.objects.create(url='/fp1', title='FP1')
+            self.flat_page2 = FlatPage.objects.create(url='/fp2', title='FP2')
+
+        def test_publish_at(self):
+            scheduled = self.flat_page1.publish_at(self.now)
+            self.failUnlessEqual(self.flat_page1, scheduled.content_object)
+            self.failUnlessEqual(PublishSchedule.ACTION_PUBLISH, scheduled.action)
+
+            # rescheduling moves the existing entry
+            later = self.now + timedelta(hours=1)
+            self.flat_page1.publish_at(later)
+            self.failUnlessEqual([later], [s.due for s in PublishSchedule.objects.all()])
+
+        def test_cannot_schedule_public_or_unsaved(self):
+            self.flat_page1.publish()
+            self.assertRaises(PublishException, self.flat_page1.public.publish_at, self.now)
+            self.assertRaises(PublishException, FlatPage(url='/unsaved').publish_at, self.now)
+
+        def test_cancel_schedule(self):
+            self.flat_page1.publish_at(self.now)
+            self.flat_page1.unpublish_at(self.now)
+            self.flat_page1.cancel_schedule(PublishSchedule.ACTION_PUBLISH)
+            self.failUnlessEqual([PublishSchedule.ACTION_UNPUBLISH],
+                                 [s.action for s in PublishSchedule.objects.all()])
+            self.flat_page1.cancel_schedule()
+            self.failUnlessEqual(0, PublishSchedule.objects.count())
+
+        def test_due(self):
+            past = self.flat_page1.publish_at(self.now - timedelta(minutes=5))
+            future = self.flat_page2.publish_at(self.now + timedelta(minutes=5))
+            self.failUnlessEqual([past], list(PublishSchedule.objects.due(self.now)))
+
+        def test_run_due_publishes(self):
+            self.flat_page1.publish_at(self.now - timedelta(minutes=5))
+            self.flat_page2.publish_at(self.now + timedelta(minutes=5))
+
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(now=self.now))
+
+            self.failUnlessEqual([self.flat_page2], list(FlatPage.objects.changed()))
+            self.failUnlessEqual(1, FlatPage.objects.published().count())
+            # processed items are removed from the schedule
+            self.failUnlessEqual(1, PublishSchedule.objects.count())
+            self.failUnlessEqual(0, PublishSchedule.objects.run_due(now=self.now))
+
+        def test_run_due_unpublishes(self):
+            self.flat_page1.publish()
+            self.flat_page1.unpublish_at(self.now)
+
+            PublishSchedule.objects.run_due(now=self.now)
+
+            self.failUnlessEqual(0, FlatPage.objects.published().count())
+
+        def test_run_due_in_batches(self):
+            self.flat_page1.publish_at(self.now - timedelta(minutes=2))
+            self.flat_page2.publish_at(self.now - timedelta(minutes=1))
+
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(batch_size=1, now=self.now))
+            self.failUnlessEqual([self.flat_page2], list(FlatPage.objects.changed()))
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(batch_size=1, now=self.now))
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+
+        def test_run_due_skips_missing_objects(self):
+            self.flat_page1.publish_at(self.now)
+            self.flat_page1.delete()
+
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(now=self.now))
+            self.failUnlessEqual(0, PublishSchedule.objects.count())
+
+        def test_run_due_defaults_to_now(self):
+            self.flat_page1.publish_at(_now() - timedelta(minutes=1))
+            self.flat_page2.publish_at(_now() + timedelta(minutes=5))
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due())
+            self.failUnlessEqual([self.flat_page2], list(FlatPage.objects.changed()))
+
+        def test_run_due_given_now(self):
+            self.flat_page1.publish_at(self.now)
+            self.failUnlessEqual(0, PublishSchedule.objects.run_due(now=self.now - timedelta(seconds=1)))
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(now=self.now))
+
+        def test_run_due_sends_post_publish_run(self):
+            self.flat_page1.publish_at(self.now)
+            runs = []
+            def handler(sender, all_published, **kw):
+                runs.append(list(all_published))
+            post_publish_run.connect(handler)
+            try:
+                PublishSchedule.objects.run_due(now=self.now)
+            finally:
+                post_publish_run.disconnect(handler)
+            self.failUnlessEqual([[self.flat_page1]], runs)
+
+        def test_failed_item_does_not_block_queue(self):
+            self.flat_page1.publish_at(self.now - timedelta(minutes=2))
+            self.flat_page2.publish_at(self.now - timedelta(minutes=1))
+            def fail(sender, instance, **kw):
+                if instance.pk == self.flat_page1.pk:
+                    raise ValueError('broken')
+            pre_publish.connect(fail)
+            try:
+                self.failUnlessEqual(1, PublishSchedule.objects.run_due(batch_size=1, now=self.now))
+                self.failUnlessEqual(1, PublishSchedule.objects.run_due(batch_size=1, now=self.now))
+            finally:
+                pre_publish.disconnect(fail)
+
+            self.failUnlessEqual([self.flat_page1], list(FlatPage.objects.changed()))
+            scheduled = PublishSchedule.objects.get()
+            self.failUnlessEqual(1, scheduled.attempts)
+            self.failUnless('ValueError: broken' in scheduled.last_error)
+            self.failUnlessEqual(self.now + PublishSchedule.objects.retry_delay, scheduled.due)
+
+            # tried again once it's due
+            self.failUnlessEqual(0, PublishSchedule.objects.run_due(now=self.now))
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(now=scheduled.due))
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+
+        def test_gives_up_after_max_attempts(self):
+            scheduled = self.flat_page1.publish_at(self.now)
+            PublishSchedule.objects.filter(pk=scheduled.pk).update(attempts=PublishSchedule.objects.max_attempts)
+            self.failUnlessEqual([], list(PublishSchedule.objects.due(self.now)))
+            self.failUnlessEqual([scheduled], list(PublishSchedule.objects.failed()))
+            # rescheduling starts again
+            self.flat_page1.publish_at(self.now)
+            self.failUnlessEqual([scheduled], list(PublishSchedule.objects.due(self.now)))
+
+        def test_publish_scheduled_command(self):
+            self.flat_page1.publish_at(self.now - timedelta(minutes=1))
+            self.flat_page2.publish_at(self.now - timedelta(minutes=1))
+
+            out = StringIO()
+            call_command('publish_scheduled', batch_size=1, stdout=out)
+
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+            self.failUnless('Processed 2 scheduled items' in out.getvalue())
+
+
+    class TestRunSteps(unittest.TestCase):
+
+        def test_results_sent_to_waiting_step(self):
+            def child(n):
+                yield _Result(n * 2)
+
+            def parent():
+                a = yield child(1)
+                b = yield child(2)
+                yield _Result(a + b)
+
+            self.failUnlessEqual(6, _run_steps(parent()))
+
+        def test_finishing_without_result_gives_none(self):
+            def child():
+                if False:
+                    yield
+            def parent():
+                value = yield child()
+                yield _Result(value)
+
+            self.failUnlessEqual(None, _run_steps(parent()))
+
+        def test_errors_passed_to_waiting_step(self):
+            def child():
+                raise PublishException('failed')
+                yield
+
+            def parent():
+                try:
+                    yield child()
+                except PublishException:
+                    yield _Result('caught')
+
+            self.failUnlessEqual('caught', _run_steps(parent()))
+
+        def test_uncaught_errors_raised(self):
+            def child():
+                raise PublishException('failed')
+                yield
+
+            def parent():
+                yield child()
+
+            self.assertRaises(PublishException, _run_steps, parent())
+
+        def test_depth_not_limited_by_recursion(self):
+            def countdown(n):
+                if n == 0:
+                    yield _Result(0)
+                else:
+                    value = yield countdown(n - 1)
+                    yield _Result(value + 1)
+
+            depth = sys.getrecursionlimit() * 2
+            self.failUnlessEqual(depth, _run_steps(countdown(depth)))
+
+
+    class TestDeepPublish(TransactionTestCase):
+
+        def setUp(self):
+            super(TestDeepPublish, self).setUp()
+            self.depth = 200
+            parent = None
+            for i in range(self.depth):
+                parent = Page.objects.create(slug='p%d' % i, title='Page %d' % i, parent=parent)
+            self.deepest = parent
+
+        def test_publish_deep_parent_chain(self):
+            # publishing the deepest page publishes every ancestor first,
+            # which would need several frames per level if done recursively
+            old_limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(len(inspect.stack(0)) + 150)
+            try:
+                self.deepest.publish()
+            finally:
+                sys.setrecursionlimit(old_limit)
+
+            self.failUnlessEqual([], list(Page.objects.changed()))
+            self.failUnlessEqual(self.depth, Page.objects.published().count())
+
+            public = Page.objects.get(pk=self.deepest.pk).public
+            levels = 1
+            while public.parent_id is not None:
+                public = Page.objects.get(pk=public.parent_id)
+                self.failUnless(public.is_public)
+                levels += 1
+            self.failUnlessEqual(self.depth, levels)
+
+
+    class TestPublishOverrides(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishOverrides, self).setUp()
+            Slide.published = []
+            self.slideshow = Slideshow.objects.create(title='show')
+            self.slide = Slide.objects.create(slideshow=self.slideshow, caption='first')
+
+        def test_nested_publish_calls_override(self):
+            self.slideshow.publish()
+            self.failUnlessEqual([('first', self.slideshow)], Slide.published)
+            self.failUnlessEqual(1, Slide.objects.published().count())
+
+        def test_nested_publish_deletions_calls_override(self):
+            self.slideshow.publish()
+            Slide.published = []
+            self.slideshow.delete()
+            Slideshow.objects.get(pk=self.slideshow.pk).publish()
+            self.failUnlessEqual(['deleted first'], [caption for caption, parent in Slide.published])
+            self.failUnlessEqual(0, Slideshow.objects.count())
+
+        def test_dry_run_calls_override(self):
+            all_published = NestedSet()
+            self.slideshow.publish(dry_run=True, all_published=all_published)
+            self.failUnlessEqual([('first', self.slideshow)], Slide.published)
+            self.failUnless(self.slide in all_published)
+            self.failUnlessEqual(0, Slide.objects.published().count())
+
+
+    class TestCompactNestedSet(TransactionTestCase):
+
+        def setUp(self):
+            super(TestCompactNestedSet, self).setUp()
+            self.nested = CompactNestedSet()
+            self.page = Page.objects.create(slug='page', title='Page')
+            self.child = Page.objects.create(slug='child', title='Child', parent=self.page)
+            self.block = PageBlock.objects.create(page=self.page, content='block')
+
+        def test_stores_keys_only(self):
+            self.nested.add(self.page)
+            self.nested.add(self.block, parent=self.page)
+            for key in self.nested.keys():
+                self.failUnless(isinstance(key, tuple))
+                self.failIf(isinstance(key[1], Publishable))
+
+        def test_contains_and_len(self):
+            self.failIf(self.page in self.nested)
+            self.nested.add(self.page)
+            self.nested.add(self.block, parent=self.page)
+            self.failUnlessEqual(2, len(self.nested))
+            self.failUnless(Page.objects.get(pk=self.page.pk) in self.nested)
+            self.failUnless(self.block in self.nested)
+            # same pk, different model
+            self.failIf(self.child in self.nested)
+
+        def test_iter_loads_in_batches(self):
+            nested = CompactNestedSet(batch_size=1)
+            nested.add(self.page)
+            nested.add(self.child, parent=self.page)
+            nested.add(self.block, parent=self.page)
+
+            with self.assertNumQueries(3):
+                items = list(nested)
+            self.failUnlessEqual(set([self.page, self.child, self.block]), set(items))
+
+        def test_nested_items(self):
+            self.nested.add(self.page)
+            self.nested.add(self.child, parent=self.page)
+            self.nested.add(self.block, parent=self.child)
+            self.failUnlessEqual([self.page, [self.child, [self.block]]], self.nested.nested_items())
+
+        def test_dry_run(self):
+            all_published = NestedSet()
+            self.child.publish(dry_run=True, all_published=all_published)
+
+            compact = CompactNestedSet()
+            self.child.publish(dry_run=True, all_published=compact)
+
+            self.failUnlessEqual(set(all_published), set(compact))
+            self.failUnlessEqual(all_published.nested_items(), compact.nested_items())
+            self.failUnlessEqual(0, Page.objects.published().count())
+
+        def test_publish_selected_compact_dry_run(self):
+            page_admin = PublishableAdmin(Page, _admin_site(Page))
+            page_admin.compact_dry_run = True
+            response = publish_selected(page_admin, _dummy_request(), Page.objects.filter(pk=self.child.pk))
+            self.failUnlessEqual(200, response.status_code)
+            self.failUnless('Page: Page object' in response.content)
+            self.failUnlessEqual(0, Page.objects.published().count())
+
+
+    class TestPublicDatabase(SettingsTestCase):
+        multi_db = True
+
+        def setUp(self):
+            super(TestPublicDatabase, self).setUp()
+            self.set_setting('PUBLISH_PUBLIC_DATABASE', 'public')
+
+            self.parent, self.page, self.author, self.block = _create_page_graph()
+
+        def test_get_public_database(self):
+            self.failUnlessEqual('public', get_public_database())
+
+        def test_snapshot_reads_non_publishable_from_draft_database(self):
+            site = Site.objects.create(title='Site', domain='example.com')
+            gallery = Gallery.objects.create(title='Gallery', site=site)
+            GalleryImage.objects.create(gallery=gallery, caption='one')
+            gallery.publish()
+            snapshot = Gallery.objects.using('public').get(is_public=True).get_snapshot()
+            self.failUnlessEqual('example.com', snapshot['site']['domain'])
+            self.failUnlessEqual(['one'], [i['caption'] for i in snapshot['galleryimage_set']])
+
+        def test_publish_writes_to_public_database(self):
+            self.page.publish()
+
+            self.failUnlessEqual(0, Page.objects.using('default').filter(is_public=True).count())
+            self.failUnlessEqual(2, Page.objects.using('public').filter(is_public=True).count())
+            self.failUnlessEqual(0, Page.objects.using('public').filter(is_public=False).count())
+            self.failUnlessEqual(1, PageBlock.objects.using('public').count())
+
+        def test_published_reads_public_database(self):
+            self.page.publish()
+            published = list(Page.objects.published().order_by('slug'))
+            self.failUnlessEqual(['page', 'parent'], [p.slug for p in published])
+            for p in published:
+                self.failUnlessEqual('public', p._state.db)
+            # explicitly chosen database is left alone
+            self.failUnlessEqual(0, Page.objects.using('default').published().count())
+
+        def test_relations_remapped(self):
+            self.page.publish()
+            page = Page.objects.get(pk=self.page.pk)
+            public = page.public
+
+            self.failUnlessEqual('public', public._state.db)
+            self.failUnlessEqual(page, public.draft)
+            self.failUnlessEqual(Page.objects.get(pk=self.parent.pk).public, public.parent)
+            author = Author.objects.get(pk=self.author.pk)
+            self.failUnlessEqual([author.public], list(public.authors.all()))
+            self.failUnlessEqual(['block'], [b.content for b in public.pageblock_set.all()])
+
+        def test_republish(self):
+            self.page.publish()
+            page = Page.objects.get(pk=self.page.pk)
+            public_pk = page.public.pk
+
+            page.title = 'Page (changed)'
+            page.save()
+            page.authors.clear()
+            page.pageblock_set.all().delete(mark_for_deletion=False)
+            page.publish()
+
+            page = Page.objects.get(pk=self.page.pk)
+            self.failUnlessEqual(public_pk, page.public.pk)
+            self.failUnlessEqual('Page (changed)', page.public.title)
+            self.failUnlessEqual([], list(page.public.authors.all()))
+            self.failUnlessEqual([], list(page.public.pageblock_set.all()))
+
+        def test_unpublish(self):
+            self.parent.publish()
+            parent = Page.objects.get(pk=self.parent.pk)
+            parent.unpublish()
+            self.failUnlessEqual(0, Page.objects.published().count())
+            self.failUnlessEqual(None, Page.objects.get(pk=self.parent.pk).public)
+
+        def test_publish_deletions(self):
+            self.parent.publish()
+            parent = Page.objects.get(pk=self.parent.pk)
+            parent.delete()
+            parent.publish()
+            self.failUnlessEqual(0, Page.objects.published().count())
+            self.failIf(Page.objects.filter(pk=self.parent.pk).exists())
+
+        def test_non_publishable_relations_copied_by_id(self):
+            tag = Tag.objects.create(slug='tag', title='Tag')
+            Tag.objects.using('public').create(id=tag.id, slug='tag', title='Tag')
+            PageTagOrder.objects.create(tagged_page=self.page, page_tag=tag, tag_order=1)
+
+            self.page.publish()
+
+            public = Page.objects.get(pk=self.page.pk).public
+            self.failUnlessEqual([tag.id], [t.id for t in public.tags.all()])
+
+        def test_publish_function_given_field_name(self):
+            site = Site.objects.create(title='site', domain='example.com')
+            Site.objects.using('public').create(id=site.id, title='site', domain='example.com')
+            gallery = Gallery.objects.create(title='gallery', site=site)
+            called = []
+            def copy_site(public_version, field_name, value):
+                called.append((field_name, value))
+                public_version.site_id = value.id
+
+            Gallery.PublishMeta.publish_functions = {'site': copy_site}
+            try:
+                gallery.publish()
+            finally:
+                del Gallery.PublishMeta.publish_functions
+
+            self.failUnlessEqual([('site', site)], called)
+            self.failUnlessEqual(site.id, Gallery.objects.get(pk=gallery.pk).public.site_id)
+
+
+    class TestPostPublishRunSignal(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPostPublishRunSignal, self).setUp()
+            self.page1 = Page.objects.create(slug='page1', title='page 1')
+            self.child1 = Page.objects.create(parent=self.page1, slug='child1', title='Child 1')
+            self.runs = []
+            post_publish_run.connect(self._handler)
+
+        def tearDown(self):
+            post_publish_run.disconnect(self._handler)
+            super(TestPostPublishRunSignal, self).tearDown()
+
+        def _handler(self, sender, all_published, **kw):
+            self.runs.append((sender, set(all_published)))
+
+        def test_sent_once_per_run(self):
+            self.child1.publish()
+            self.failUnlessEqual([(Page, set([self.page1, self.child1]))], self.runs)
+
+        def test_sent_once_for_queryset(self):
+            Page.objects.draft().publish()
+            self.failUnlessEqual([(Page, set([self.page1, self.child1]))], self.runs)
+
+        def test_not_sent_for_nested_or_dry_run(self):
+            self.child1.publish(dry_run=True)
+            self.failUnlessEqual([], self.runs)
+
+            all_published = NestedSet()
+            self.child1.publish(all_published=all_published)
+            self.failUnlessEqual([], self.runs)
+
+        def test_sent_for_deletions(self):
+            self.page1.publish()
+            page1 = Page.objects.get(pk=self.page1.pk)
+            page1.delete()
+            self.runs = []
+            page1.publish()
+            self.failUnlessEqual(1, len(self.runs))
+
+
+    class TestPublishDependencies(SettingsTestCase):
+
+        def setUp(self):
+            super(TestPublishDependencies, self).setUp()
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+
+            self.parent, self.page, self.author, self.block = _create_page_graph()
+
+        def _get(self, obj):
+            return obj.__class__.objects.get(pk=obj.pk)
+
+        def test_not_tracked_by_default(self):
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', False)
+            self.page.publish()
+            self.failUnlessEqual(0, PublishDependency.objects.count())
+
+        def test_direct_dependents(self):
+            self.page.publish()
+            page, parent, author, block = [self._get(o) for o in (self.page, self.parent, self.author, self.block)]
+
+            # foreign key
+            self.failUnlessEqual([page.public], PublishDependency.objects.dependents(parent, transitive=False))
+            # many to many
+            self.failUnlessEqual([page.public], PublishDependency.objects.dependents(author.public, transitive=False))
+            # reverse relation - but not the block's own foreign key back to
+            # the page publishing it, or the two would depend on each other
+            self.failUnlessEqual([page.public], PublishDependency.objects.dependents(block, transitive=False))
+            self.failUnlessEqual([], PublishDependency.objects.dependents(page, transitive=False))
+
+        def test_transitive_dependents(self):
+            self.page.publish()
+            self.parent.publish()
+            parent, page, block = self._get(self.parent), self._get(self.page), self._get(self.block)
+            self.failUnlessEqual([page.public], PublishDependency.objects.dependents(self._get(self.author)))
+            self.failUnlessEqual([page.public], PublishDependency.objects.dependents(block.public))
+            self.failUnlessEqual([], PublishDependency.objects.dependents(page.public))
+
+        def test_transitive_query_count(self):
+            self.page.publish()
+            author = self._get(self.author)
+            # one query per level (plus one to stop), whatever the number of objects
+            with self.assertNumQueries(3):
+                PublishDependency.objects.dependent_keys(author.public)
+
+        def test_republish_updates_dependencies(self):
+            self.page.publish()
+            page = self._get(self.page)
+            page.authors.clear()
+            page.publish()
+
+            self.failUnlessEqual([], PublishDependency.objects.dependents(self._get(self.author)))
+
+        def test_unpublished_draft_has_no_dependents(self):
+            self.failUnlessEqual([], PublishDependency.objects.dependents(self.author))
+
+        def test_deleted_public_objects_removed(self):
+            self.page.publish()
+            page = self._get(self.page)
+            public_id = page.public.pk
+            page.delete()
+            page.publish()
+
+            page_type = ContentType.objects.get_for_model(Page)
+            self.failIf(PublishDependency.objects.filter(source_type=page_type, source_id=public_id).exists())
+            self.failIf(PublishDependency.objects.filter(target_type=page_type, target_id=public_id).exists())
+
+
+    class TestWithPublic(TransactionTestCase):
+
+        def setUp(self):
+            super(TestWithPublic, self).setUp()
+            self.pages = _create_flat_pages(5)
+            FlatPage.objects.filter(url__in=['/page0', '/page1', '/page2']).publish()
+            self.unpublished = FlatPage.objects.get(url='/page4')
+
+        def test_with_public_drafts(self):
+            with self.assertNumQueries(1):
+                drafts = list(FlatPage.objects.draft().with_public())
+                for draft in drafts:
+                    if draft.public is not None:
+                        self.failUnlessEqual(draft.url, draft.public.url)
+                        self.failUnless(draft.public.draft is draft)
+            self.failUnlessEqual(3, len([d for d in drafts if d.public is not None]))
+
+        def test_with_public_published(self):
+            with self.assertNumQueries(1):
+                published = list(FlatPage.objects.published().with_public())
+                for public in published:
+                    self.failUnlessEqual(public.url, public.draft.url)
+                    self.failUnless(public.draft.public is public)
+            self.failUnlessEqual(3, len(published))
+
+        def test_with_public_survives_clone(self):
+            queryset = FlatPage.objects.with_public()
+            with self.assertNumQueries(1):
+                draft = queryset.filter(url='/page0').draft()[0]
+                self.failUnlessEqual('/page0', draft.public.url)
+
+        def test_pairs(self):
+            with self.assertNumQueries(1):
+                pairs = list(FlatPage.objects.pairs())
+            self.failUnlessEqual(5, len(pairs))
+            for draft, public in pairs:
+                self.failIf(draft.is_public)
+                if draft.url in ('/page3', '/page4'):
+                    self.failUnless(public is None)
+                else:
+                    self.failUnlessEqual(draft.url, public.url)
+
+
+    class TestWithPublicSeparateDatabase(SettingsTestCase):
+        multi_db = True
+
+        def setUp(self):
+            super(TestWithPublicSeparateDatabase, self).setUp()
+            self.set_setting('PUBLISH_PUBLIC_DATABASE', 'public')
+            _create_flat_pages(5)
+            FlatPage.objects.draft().publish()
+
+        def test_pairs_in_chunks(self):
+            # one query for the drafts, then one per chunk for the public copies
+            with self.assertNumQueries(3, using='public'):
+                with self.assertNumQueries(1):
+                    pairs = list(FlatPage.objects.all().pairs(chunk_size=2))
+            self.failUnlessEqual(5, len(pairs))
+            for draft, public in pairs:
+                self.failUnlessEqual(draft.url, public.url)
+                self.failUnlessEqual('public', public._state.db)
+
+        def test_published_with_public(self):
+            with self.assertNumQueries(1):
+                with self.assertNumQueries(1, using='public'):
+                    published = list(FlatPage.objects.published().with_public())
+                    for public in published:
+                        self.failUnlessEqual(public.url, public.draft.url)
+
+
+    class TestVersionedPublishable(TransactionTestCase):
+
+        def setUp(self):
+            super(TestVersionedPublishable, self).setUp()
+            self.article = Article.objects.create(title='Article', content='first')
+
+        def test_save_increments_version(self):
+            self.failUnlessEqual(0, self.article.version)
+            self.article.save()
+            self.failUnlessEqual(1, self.article.version)
+            self.failUnlessEqual(1, Article.objects.get(pk=self.article.pk).version)
+
+        def test_stale_save_raises(self):
+            other = Article.objects.get(pk=self.article.pk)
+            other.content = 'second'
+            other.save()
+
+            self.article.content = 'overwritten'
+            self.failUnlessRaises(VersionConflict, self.article.save)
+            self.failUnlessEqual('second', Article.objects.get(pk=self.article.pk).content)
+
+        def test_interleaved_saves(self):
+            # the other writer saves once this save has started, but
+            # before it has written anything
+            def save_other(sender, instance, **kw):
+                if instance is self.article:
+                    other = Article.objects.get(pk=self.article.pk)
+                    other.content = 'second'
+                    other.save()
+            pre_save.connect(save_other, sender=Article)
+            try:
+                self.article.content = 'overwritten'
+                self.failUnlessRaises(VersionConflict, self.article.save)
+            finally:
+                pre_save.disconnect(save_other, sender=Article)
+            article = Article.objects.get(pk=self.article.pk)
+            self.failUnlessEqual('second', article.content)
+            self.failUnlessEqual(1, article.version)
+
+        def test_stale_publish_raises(self):
+            other = Article.objects.get(pk=self.article.pk)
+            other.content = 'second'
+            other.save()
+
+            self.failUnlessRaises(VersionConflict, self.article.publish)
+            self.failUnlessEqual(0, Article.objects.published().count())
+            self.failUnlessEqual(Publishable.PUBLISH_CHANGED, Article.objects.get(pk=self.article.pk).publish_state)
+
+            # publishing the latest copy works
+            other.publish()
+            public = Article.objects.published().get()
+            self.failUnlessEqual('second', public.content)
+
+        def test_publish_keeps_separate_public_version(self):
+            self.article.publish()
+            public = Article.objects.published().get()
+            self.failUnlessEqual(0, public.version)
+
+            self.article.content = 'second'
+            self.article.save()
+            self.article.publish()
+
+            public = Article.objects.published().get()
+            self.failUnlessEqual('second', public.content)
+            self.failUnlessEqual(1, public.version)
+            self.failUnless(Article.objects.get(pk=self.article.pk).version > public.version)
+
+        def test_concurrent_publish_of_public_copy(self):
+            self.article.publish()
+            self.article.content = 'second'
+            self.article.save()
+
+            # someone else publishes in the meantime
+            draft = Article.objects.get(pk=self.article.pk)
+            stale_public = draft.public
+            Article.objects.get(pk=self.article.pk).publish()
+
+            stale_public.content = 'stale'
+            self.failUnlessRaises(VersionConflict, stale_public.save)
+
+        def test_unversioned_models_unaffected(self):
+            page = Page.objects.create(slug='page', title='Page')
+            stale = Page.objects.get(pk=page.pk)
+            page.title = 'changed'
+            page.save()
+            stale.save()
+
+        def test_admin_actions_skip_row_locks(self):
+            admin_site = AdminSite('Test Admin')
+            queryset = Article.objects.all()
+            self.failIf(_lock_for_publish(PublishableAdmin(Article, admin_site), queryset).query.select_for_update)
+            self.failUnless(_lock_for_publish(PublishableAdmin(Page, admin_site), Page.objects.all()).query.select_for_update)
+
+
+    class TestPublishCoalesced(SettingsTestCase):
+
+        def setUp(self):
+            super(TestPublishCoalesced, self).setUp()
+            cache.clear()
+            self.flat_page = FlatPage.objects.create(url='/hot', title='Hot')
+
+        def tearDown(self):
+            cache.clear()
+            super(TestPublishCoalesced, self).tearDown()
+
+        def test_no_window_always_publishes(self):
+            public, merged = self.flat_page.publish_coalesced()
+            self.failUnlessEqual(0, merged)
+            self.failUnlessEqual(public, FlatPage.objects.published().get())
+
+            self.flat_page.title = 'Hotter'
+            self.flat_page.save()
+            public, merged = self.flat_page.publish_coalesced()
+            self.failUnlessEqual('Hotter', FlatPage.objects.published().get().title)
+
+        def test_requests_within_window_are_merged(self):
+            public, merged = self.flat_page.publish_coalesced(window=60)
+            self.failIf(public is None)
+            self.failUnlessEqual(0, merged)
+
+            for i, title in enumerate(['Hot 1', 'Hot 2']):
+                self.flat_page.title = title
+                self.flat_page.save()
+                public, merged = self.flat_page.publish_coalesced(window=60)
+                self.failUnless(public is None)
+                self.failUnlessEqual(i + 1, merged)
+
+            # changes are left pending
+            self.failUnlessEqual('Hot', FlatPage.objects.published().get().title)
+            self.failUnlessEqual([self.flat_page], list(FlatPage.objects.changed()))
+
+            # window expires, next request publishes everything
+            cache.delete(self.flat_page._coalesce_key())
+            public, merged = self.flat_page.publish_coalesced(window=60)
+            self.failUnlessEqual(2, merged)
+            self.failUnlessEqual('Hot 2', FlatPage.objects.published().get().title)
+
+        def test_change_mid_window_published_when_window_ends(self):
+            self.flat_page.publish_coalesced(window=60)
+            self.flat_page.title = 'Hotter'
+            self.flat_page.save()
+            public, merged = self.flat_page.publish_coalesced(window=60)
+            self.failUnless(public is None)
+
+            scheduled = PublishSchedule.objects.for_object(self.flat_page).get()
+            self.failUnlessEqual(PublishSchedule.ACTION_PUBLISH, scheduled.action)
+            self.failUnless(scheduled.due > _now() + timedelta(seconds=50))
+
+            # more requests in the same window don't schedule again
+            self.flat_page.publish_coalesced(window=60)
+            self.failUnlessEqual(1, PublishSchedule.objects.count())
+
+            self.failUnlessEqual(0, PublishSchedule.objects.run_due())
+            self.failUnlessEqual(1, PublishSchedule.objects.run_due(now=scheduled.due))
+            self.failUnlessEqual('Hotter', FlatPage.objects.published().get().title)
+            self.failUnlessEqual([], list(FlatPage.objects.changed()))
+
+        def test_earlier_scheduled_publish_kept(self):
+            self.flat_page.publish_at(_now())
+            self.flat_page.publish_coalesced(window=60)
+            self.flat_page.publish_coalesced(window=60)
+            scheduled = PublishSchedule.objects.for_object(self.flat_page).get()
+            self.failUnless(scheduled.due <= _now())
+
+        def test_window_from_settings(self):
+            self.set_setting('PUBLISH_COALESCE_WINDOW', 60)
+            self.flat_page.publish_coalesced()
+            public, merged = self.flat_page.publish_coalesced()
+            self.failUnless(public is None)
+            self.failUnlessEqual(1, merged)
+
+        def test_failed_publish_releases_lock(self):
+            public_page = self.flat_page.publish()
+            self.failUnlessRaises(PublishException, public_page.publish_coalesced, 60)
+            self.failUnlessRaises(PublishException, public_page.publish_coalesced, 60)
+
+
+    class TestPublicIndexes(TransactionTestCase):
+
+        def test_index_sql(self):
+            self.failUnlessEqual([], public_index_sql(Author, connection))
+            statements = public_index_sql(FlatPage, connection)
+            self.failUnlessEqual(1, len(statements))
+            self.failUnless('publish_flatpage_url_public' in statements[0])
+
+        def test_index_sql_postgresql(self):
+            class postgresql_connection(object):
+                vendor = 'postgresql'
+                class ops(object):
+                    @staticmethod
+                    def quote_name(name):
+                        return '"%s"' % name
+                    @staticmethod
+                    def max_name_length():
+                        return 63
+            self.failUnlessEqual(['CREATE INDEX "publish_flatpage_url_public" ON "publish_flatpage" ("url") WHERE "is_public";'],
+                                 public_index_sql(FlatPage, postgresql_connection))
+
+        def test_index_created_by_syncdb(self):
+            cursor = connection.cursor()
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = %s", ['publish_flatpage_url_public'])
+            row = cursor.fetchone()
+            self.failIf(row is None)
+            self.failUnless('"is_public", "url"' in row[0])
+
+        def test_existing_index_left_alone(self):
+            # as flush does, after the indexes were created by syncdb
+            _create_public_indexes(get_app('publish'), [FlatPage], db=connection.alias)
+            cursor = connection.cursor()
+            self.failUnless('publish_flatpage_url_public' in
+                            _existing_index_names(connection, cursor, FlatPage._meta.db_table))
+
+
+    class TestPublishSnapshot(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishSnapshot, self).setUp()
+            self.site = Site.objects.create(title='Site', domain='example.com')
+            self.gallery = Gallery.objects.create(title='Gallery', site=self.site)
+            GalleryImage.objects.create(gallery=self.gallery, caption='one')
+            GalleryImage.objects.create(gallery=self.gallery, caption='two')
+
+        def test_snapshot_on_publish(self):
+            self.gallery.publish()
+            public = Gallery.objects.published().get()
+
+            with self.assertNumQueries(0):
+                snapshot = public.get_snapshot()
+            self.failUnlessEqual('Gallery', snapshot['title'])
+            self.failUnlessEqual(public.pk, snapshot['id'])
+            self.failIf('is_public' in snapshot)
+            self.failIf('snapshot' in snapshot)
+            self.failUnlessEqual(['one', 'two'], sorted(i['caption'] for i in snapshot['galleryimage_set']))
+            self.failUnlessEqual('example.com', snapshot['site']['domain'])
+
+        def test_draft_has_no_snapshot(self):
+            self.gallery.publish()
+            draft = Gallery.objects.draft().get()
+            self.failUnless(draft.get_snapshot() is None)
+
+        def test_snapshot_updated_on_republish(self):
+            self.gallery.publish()
+            self.gallery.title = 'Changed'
+            self.gallery.save()
+            GalleryImage.objects.filter(caption='one').delete()
+            self.gallery.publish()
+
+            snapshot = Gallery.objects.published().get().get_snapshot()
+            self.failUnlessEqual('Changed', snapshot['title'])
+            self.failUnlessEqual(['two'], [i['caption'] for i in snapshot['galleryimage_set']])
+
+        def test_snapshots_single_query(self):
+            self.gallery.publish()
+            with self.assertNumQueries(1):
+                snapshots = list(Gallery.objects.published().snapshots())
+            self.failUnlessEqual(1, len(snapshots))
+            self.failUnlessEqual('Gallery', snapshots[0]['title'])
+
+        def test_snapshots_needs_field(self):
+            self.failUnlessRaises(PublishException, list, FlatPage.objects.published().snapshots())
+
+        def test_dry_run_writes_nothing(self):
+            self.gallery.publish(dry_run=True)
+            self.failUnlessEqual(0, Gallery.objects.published().count())
+
+
+    class TestPublishVersions(SettingsTestCase):
+
+        def setUp(self):
+            super(TestPublishVersions, self).setUp()
+            cache.clear()
+            self.set_setting('PUBLISH_CACHE_VERSIONS', True)
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+            self.page = Page.objects.create(slug='page', title='Page')
+            self.block = PageBlock.objects.create(page=self.page, content='block')
+            self.page.publish()
+            self.public_page = Page.objects.published().get()
+
+        def tearDown(self):
+            cache.clear()
+            super(TestPublishVersions, self).tearDown()
+
+        def test_version_is_stable(self):
+            version = get_publish_version(self.public_page)
+            with self.assertNumQueries(0):
+                self.failUnlessEqual(version, get_publish_version(self.public_page))
+
+        def test_publish_bumps_version(self):
+            version = get_publish_version(self.public_page)
+            Page.objects.get(pk=self.page.pk).publish()
+            self.failIfEqual(version, get_publish_version(self.public_page))
+
+        def test_publishing_dependency_bumps_version(self):
+            page_version = get_publish_version(self.public_page)
+            other = Page.objects.create(slug='other', title='Other')
+            other.publish()
+            self.failUnlessEqual(page_version, get_publish_version(self.public_page))
+
+            block = PageBlock.objects.get(pk=self.block.pk)
+            block.content = 'changed'
+            block.save()
+            block.publish()
+            self.failIfEqual(page_version, get_publish_version(self.public_page))
+
+        def test_not_bumped_unless_enabled(self):
+            self.set_setting('PUBLISH_CACHE_VERSIONS', False)
+            version = get_publish_version(self.public_page)
+            Page.objects.get(pk=self.page.pk).publish()
+            self.failUnlessEqual(version, get_publish_version(self.public_page))
+
+        def test_bump_publish_versions(self):
+            version = get_publish_version(self.public_page)
+            bump_publish_versions([(ContentType.objects.get_for_model(Page).id, self.public_page.pk)])
+            self.failIfEqual(version, get_publish_version(self.public_page))
+
+
+    class TestTimestampedPublishable(SettingsTestCase):
+
+        def setUp(self):
+            super(TestTimestampedPublishable, self).setUp()
+            self.gallery = Gallery.objects.create(title='Gallery')
+            self.note = Note.objects.create(text='note', gallery=self.gallery)
+
+        def test_publish_stamps_public_copy(self):
+            self.note.publish()
+            public = Note.objects.published().get()
+            self.failIf(public.published_at is None)
+            self.failUnlessEqual(1, public.publish_version)
+
+            draft = Note.objects.draft().get()
+            self.failUnless(draft.published_at is None)
+            self.failUnlessEqual(0, draft.publish_version)
+
+            self.note.text = 'changed'
+            self.note.save()
+            self.note.publish()
+            self.failUnlessEqual(2, Note.objects.published().get().publish_version)
+
+        def test_unchanged_publish_does_not_stamp(self):
+            self.note.publish()
+            Note.objects.get(pk=self.note.pk).publish()
+            self.failUnlessEqual(1, Note.objects.published().get().publish_version)
+
+        def test_dependents_stamped(self):
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+            self.note.publish()
+            gallery = Gallery.objects.get(pk=self.gallery.pk)
+            gallery.title = 'Changed'
+            gallery.save()
+            gallery.publish()
+            self.failUnlessEqual(2, Note.objects.published().get().publish_version)
+
+        def test_visited_dependents_stamped(self):
+            # the note itself hasn't changed, but its attachment has
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+            attachment = NoteAttachment.objects.create(note=self.note, name='one')
+            self.note.publish()
+            attachment = NoteAttachment.objects.get(pk=attachment.pk)
+            attachment.name = 'changed'
+            attachment.save()
+            Note.objects.get(pk=self.note.pk).publish()
+
+            public = Note.objects.published().get()
+            self.failUnlessEqual('changed', public.noteattachment_set.get().name)
+            self.failUnlessEqual(2, public.publish_version)
+
+        def test_deleted_dependency_stamps_dependents(self):
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+            attachment = NoteAttachment.objects.create(note=self.note, name='one')
+            self.note.publish()
+            attachment = NoteAttachment.objects.get(pk=attachment.pk)
+            attachment.delete()
+            attachment.publish()
+
+            public = Note.objects.published().get()
+            self.failUnlessEqual(0, public.noteattachment_set.count())
+            self.failUnlessEqual(2, public.publish_version)
+
+        def test_tidied_up_children_stamp_parent(self):
+            self.set_setting('PUBLISH_TRACK_DEPENDENCIES', True)
+            attachment = NoteAttachment.objects.create(note=self.note, name='one')
+            self.note.publish()
+            NoteAttachment.objects.get(pk=attachment.pk).delete(mark_for_deletion=False)
+            Note.objects.get(pk=self.note.pk).publish()
+
+            public = Note.objects.published().get()
+            self.failUnlessEqual(0, public.noteattachment_set.count())
+            self.failUnlessEqual(2, public.publish_version)
+
+        def test_changed_child_stamps_parent_without_tracking(self):
+            attachment = NoteAttachment.objects.create(note=self.note, name='one')
+            self.note.publish()
+            published_at = Note.objects.published().get().published_at
+            attachment = NoteAttachment.objects.get(pk=attachment.pk)
+            attachment.name = 'changed'
+            attachment.save()
+            Note.objects.get(pk=self.note.pk).publish()
+
+            public = Note.objects.published().get()
+            self.failUnlessEqual(2, public.publish_version)
+            self.failUnless(public.published_at >= published_at)
+
+        def test_unchanged_children_do_not_stamp(self):
+            NoteAttachment.objects.create(note=self.note, name='one')
+            self.note.publish()
+            Note.objects.get(pk=self.note.pk).publish()
+            self.failUnlessEqual(1, Note.objects.published().get().publish_version)
+
+
+    class TestConditionalResponse(TransactionTestCase):
+
+        def setUp(self):
+            super(TestConditionalResponse, self).setUp()
+            self.note = Note.objects.create(text='note')
+            self.note.publish()
+            self.public = Note.objects.published().get()
+            self.factory = RequestFactory()
+            self.rendered = []
+
+        def render(self):
+            self.rendered.append(True)
+            return HttpResponse('note')
+
+        def test_headers(self):
+            with self.assertNumQueries(0):
+                response = conditional_response(self.factory.get('/'), self.public, self.render)
+            self.failUnlessEqual(200, response.status_code)
+            self.failUnlessEqual('"publish.note-%d-1"' % self.public.pk, response['ETag'])
+            self.failUnlessEqual(http_date(publish_last_modified(self.public)), response['Last-Modified'])
+
+        def test_last_modified_from_local_time(self):
+            # published_at is in local time (USE_TZ is off) - not UTC
+            self.public.published_at = datetime(2012, 6, 1, 10, 30)
+            self.failUnlessEqual(int(time.mktime(self.public.published_at.timetuple())),
+                                 publish_last_modified(self.public))
+
+        def test_if_none_match(self):
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH='"%s"' % publish_etag(self.public))
+            response = conditional_response(request, self.public, self.render)
+            self.failUnlessEqual(304, response.status_code)
+            self.failIf(self.rendered)
+
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH='"something-else"')
+            response = conditional_response(request, self.public, self.render)
+            self.failUnlessEqual(200, response.status_code)
+
+        def test_if_modified_since(self):
+            last_modified = publish_last_modified(self.public)
+            request = self.factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(last_modified))
+            self.failUnlessEqual(304, conditional_response(request, self.public, self.render).status_code)
+
+            request = self.factory.get('/', HTTP_IF_MODIFIED_SINCE=http_date(last_modified - 60))
+            self.failUnlessEqual(200, conditional_response(request, self.public, self.render).status_code)
+
+        def test_drafts_and_posts_not_conditional(self):
+            request = self.factory.get('/', HTTP_IF_NONE_MATCH='*')
+            response = conditional_response(request, Note.objects.draft().get(), self.render)
+            self.failUnlessEqual(200, response.status_code)
+            self.failIf(response.has_header('ETag'))
+
+            request = self.factory.post('/', HTTP_IF_NONE_MATCH='*')
+            self.failUnlessEqual(200, conditional_response(request, self.public, self.render).status_code)
+
+
+    class TestStreamingSitemap(TransactionTestCase):
+
+        def setUp(self):
+            super(TestStreamingSitemap, self).setUp()
+            self.output_dir = tempfile.mkdtemp()
+            _create_flat_pages(5, url='/page%d/')
+            FlatPage.objects.draft().publish()
+            FlatPage.objects.create(url='/draft-only/', title='Draft')
+            self.sitemap = StreamingSitemap(self.output_dir, 'http://example.com/', [
+                SitemapSection('flatpages', FlatPage, 'url', chunk_size=2),
+            ], sitemap_url='http://example.com/sitemaps/')
+            self.sitemap.limit = 2
+
+        def tearDown(self):
+            self.sitemap.disconnect()
+            shutil.rmtree(self.output_dir)
+            super(TestStreamingSitemap, self).tearDown()
+
+        def _read(self, name):
+            return open(os.path.join(self.output_dir, name)).read()
+
+        def test_generate(self):
+            self.sitemap.generate()
+            self.failUnlessEqual(['flatpages-1.xml', 'flatpages-2.xml', 'flatpages-3.xml', 'sitemap.xml'],
+                                 sorted(os.listdir(self.output_dir)))
+            index = self._read('sitemap.xml')
+            self.failUnless('<loc>http://example.com/sitemaps/flatpages-3.xml</loc>' in index)
+
+            urls = ''.join(self._read('flatpages-%d.xml' % n) for n in (1, 2, 3))
+            for i in range(5):
+                self.failUnless('<loc>http://example.com/page%d/</loc>' % i in urls)
+            self.failIf('draft-only' in urls)
+            self.failUnlessEqual(2, self._read('flatpages-1.xml').count('<url>'))
+
+        def test_generated_files_readable(self):
+            umask = os.umask(022)
+            try:
+                self.sitemap.generate()
+            finally:
+                os.umask(umask)
+            for name in os.listdir(self.output_dir):
+                self.failUnlessEqual(0644, os.stat(os.path.join(self.output_dir, name)).st_mode & 0777)
+
+        def test_rows_are_paged(self):
+            # one query per chunk of two, plus one that finds nothing more
+            with self.assertNumQueries(3):
+                rows = list(self.sitemap.sections[0].rows())
+            self.failUnlessEqual(5, len(rows))
+
+        def test_leftover_files_removed(self):
+            self.sitemap.generate()
+            FlatPage.objects.draft()[0].unpublish()
+            FlatPage.objects.draft()[1].unpublish()
+            self.sitemap.generate()
+            self.failUnlessEqual(['flatpages-1.xml', 'flatpages-2.xml', 'sitemap.xml'],
+                                 sorted(os.listdir(self.output_dir)))
+            self.failIf('flatpages-3.xml' in self._read('sitemap.xml'))
+
+        def test_lastmod(self):
+            Note.objects.create(text='/note/').publish()
+            sitemap = StreamingSitemap(self.output_dir, 'http://example.com', [
+                SitemapSection('notes', Note, 'text', lastmod_field='published_at'),
+            ])
+            sitemap.generate()
+            public = Note.objects.published().get()
+            self.failUnless('<lastmod>%s</lastmod>' % public.published_at.strftime('%Y-%m-%d')
+                            in self._read('notes-1.xml'))
+
+        def test_regenerates_published_sections(self):
+            notes = SitemapSection('notes', Note, 'text')
+            self.sitemap.sections.append(notes)
+            self.sitemap.generate()
+            self.sitemap.connect()
+
+            self.failUnlessEqual([notes], self.sitemap.sections_for([Note()]))
+
+            note = Note.objects.create(text='/note/')
+            note.publish()
+            # only marked during the publish
+            self.failIf(os.path.exists(os.path.join(self.output_dir, 'notes-1.xml')))
+            self.failUnlessEqual([notes], self.sitemap.dirty_sections())
+
+            self.failUnlessEqual([notes], self.sitemap.generate_dirty())
+            self.failUnless('/note/' in self._read('notes-1.xml'))
+            self.failUnless('notes-1.xml' in self._read('sitemap.xml'))
+            self.failUnlessEqual([], self.sitemap.dirty_sections())
+            self.failUnlessEqual([], self.sitemap.generate_dirty())
+
+            Note.objects.get(pk=note.pk).unpublish()
+            self.failUnlessEqual([notes], self.sitemap.dirty_sections())
+            self.sitemap.generate_dirty()
+            self.failIf(os.path.exists(os.path.join(self.output_dir, 'notes-1.xml')))
+
+        def test_generate_clears_dirty(self):
+            self.sitemap.mark_dirty(self.sitemap.sections)
+            self.sitemap.generate()
+            self.failUnlessEqual([], self.sitemap.dirty_sections())
+
+
+    class TestPublishEvents(SettingsTestCase):
+
+        def setUp(self):
+            super(TestPublishEvents, self).setUp()
+            self.set_setting('PUBLISH_EVENT_LOG', True)
+
+        def _events(self):
+            return [(e.content_type.model_class(), e.object_id, e.action, e.version)
+                    for e in PublishEvent.objects.order_by('pk')]
+
+        def test_events_recorded(self):
+            note = Note.objects.create(text='note')
+            note.publish()
+            public = Note.objects.published().get()
+            self.failUnlessEqual([(Note, public.pk, 'publish', 1)], self._events())
+
+            # nothing changed, so nothing logged
+            Note.objects.get(pk=note.pk).publish()
+            self.failUnlessEqual(1, PublishEvent.objects.count())
+
+            note = Note.objects.get(pk=note.pk)
+            note.unpublish()
+            self.failUnlessEqual((Note, public.pk, 'unpublish', 1), self._events()[-1])
+
+        def test_deletion_events(self):
+            flat_page = FlatPage.objects.create(url='/events', title='Events')
+            flat_page.publish()
+            public_pk = FlatPage.objects.published().get().pk
+            flat_page = FlatPage.objects.get(pk=flat_page.pk)
+            flat_page.delete()
+            flat_page.publish()
+            self.failUnlessEqual([(FlatPage, public_pk, 'publish', None), (FlatPage, public_pk, 'delete', None)],
+                                 self._events())
+
+        def test_not_recorded_unless_enabled(self):
+            self.set_setting('PUBLISH_EVENT_LOG', False)
+            FlatPage.objects.create(url='/events', title='Events').publish()
+            self.failUnlessEqual(0, PublishEvent.objects.count())
+
+        def test_consume(self):
+            for i in range(5):
+                FlatPage.objects.create(url='/events%d' % i, title='Events').publish()
+
+            seen = []
+            for batch in PublishEvent.objects.consume('search', batch_size=2):
+                seen.append(len(batch))
+            self.failUnlessEqual([2, 2, 1], seen)
+            self.failUnlessEqual([], list(PublishEvent.objects.consume('search')))
+
+            # other consumers have their own cursor
+            self.failUnlessEqual(5, sum(len(b) for b in PublishEvent.objects.consume('cdn')))
+
+            FlatPage.objects.create(url='/events-new', title='Events').publish()
+            batches = list(PublishEvent.objects.consume('search'))
+            self.failUnlessEqual(1, len(batches))
+
+        def test_stopping_part_way_repeats_batch(self):
+            for i in range(3):
+                FlatPage.objects.create(url='/events%d' % i, title='Events').publish()
+
+            for batch in PublishEvent.objects.consume('search', batch_size=2):
+                first = [e.pk for e in batch]
+                break
+            batch = PublishEvent.objects.consume('search', batch_size=2).next()
+            self.failUnlessEqual(first, [e.pk for e in batch])
+
+        def test_late_events_handed_out(self):
+            content_type = ContentType.objects.get_for_model(FlatPage)
+            for id in (1, 2, 5):
+                PublishEvent.objects.create(id=id, content_type=content_type, object_id=id, action='publish')
+            self.failUnlessEqual([[1, 2, 5]], [[e.pk for e in b] for b in PublishEvent.objects.consume('search')])
+
+            # 3 and 4 were logged by transactions that committed later
+            for id in (4, 6, 3):
+                PublishEvent.objects.create(id=id, content_type=content_type, object_id=id, action='publish')
+            self.failUnlessEqual([[3, 4, 6]], [[e.pk for e in b] for b in PublishEvent.objects.consume('search')])
+            self.failUnlessEqual([], list(PublishEvent.objects.consume('search')))
+            self.failUnlessEqual('', PublishCursor.objects.get(name='publish_events:search').gaps)
+
+        def test_gaps_time_out(self):
+            content_type = ContentType.objects.get_for_model(FlatPage)
+            for id in (1, 3):
+                PublishEvent.objects.create(id=id, content_type=content_type, object_id=id, action='publish')
+            list(PublishEvent.objects.consume('search'))
+            cursor = PublishCursor.objects.get(name='publish_events:search')
+            self.failUnless(cursor.gaps.startswith('2-2@'))
+
+            cursor.gaps = '2-2@%d' % (time.time() - PublishEvent.objects.gap_timeout - 1)
+            cursor.save()
+            self.failUnlessEqual([], list(PublishEvent.objects.consume('search')))
+            self.failUnlessEqual('', PublishCursor.objects.get(name='publish_events:search').gaps)
+
+            # so a rolled back id isn't looked for forever
+            PublishEvent.objects.create(id=2, content_type=content_type, object_id=2, action='publish')
+            self.failUnlessEqual([], list(PublishEvent.objects.consume('search')))
+
+        def test_tidied_up_children_logged(self):
+            page = Page.objects.create(slug='page', title='Page')
+            block = PageBlock.objects.create(page=page, content='block')
+            page.publish()
+            public_block = PageBlock.objects.published().get()
+            PageBlock.objects.get(pk=block.pk).delete(mark_for_deletion=False)
+            Page.objects.get(pk=page.pk).publish()
+            self.failUnlessEqual((PageBlock, public_block.pk, 'delete', None), self._events()[-1])
+
+        def test_cascade_deletes_logged(self):
+            page = Page.objects.create(slug='page', title='Page')
+            PageBlock.objects.create(page=page, content='block')
+            page.publish()
+            public_page = Page.objects.published().get()
+            public_block = PageBlock.objects.published().get()
+            Page.objects.get(pk=page.pk).unpublish()
+
+            events = self._events()
+            self.failUnless((Page, public_page.pk, 'unpublish', None) in events)
+            self.failIf((Page, public_page.pk, 'delete', None) in events)
+            self.failUnless((PageBlock, public_block.pk, 'delete', None) in events)
+
+        def test_publish_events_command(self):
+            for i in range(3):
+                FlatPage.objects.create(url='/events%d' % i, title='Events').publish()
+            stdout = StringIO()
+            call_command('publish_events', 'search', batch_size=2, stdout=stdout)
+            lines = stdout.getvalue().splitlines()
+            self.failUnlessEqual(3, len(lines))
+            self.failUnless('"model": "publish.flatpage"' in lines[0])
+            self.failUnless('"action": "publish"' in lines[0])
+
+            stdout = StringIO()
+            call_command('publish_events', 'search', stdout=stdout)
+            self.failUnlessEqual('', stdout.getvalue())
+
+
+    class TestPublishSubtree(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishSubtree, self).setUp()
+            self.root = Page.objects.create(slug='root', title='Root')
+            self.a = Page.objects.create(slug='a', title='A', parent=self.root)
+            self.b = Page.objects.create(slug='b', title='B', parent=self.root)
+            self.c = Page.objects.create(slug='c', title='C', parent=self.a)
+            self.d = Page.objects.create(slug='d', title='D', parent=self.c)
+            self.other = Page.objects.create(slug='other', title='Other')
+
+        def test_subtree_levels(self):
+            with self.assertNumQueries(1):
+                levels = Page.objects.all().subtree_levels(self.root)
+            self.failUnlessEqual([[self.root.pk], sorted([self.a.pk, self.b.pk]), [self.c.pk], [self.d.pk]],
+                                 [sorted(level) for level in levels])
+            self.failUnlessEqual([[self.c.pk], [self.d.pk]], Page.objects.all().subtree_levels(self.c))
+
+        def test_subtree_levels_by_level(self):
+            field = Page._meta.get_field('parent')
+            self.failUnlessEqual(Page.objects.all().subtree_levels(self.root),
+                                 [sorted(level) for level in
+                                  Page.objects.all()._subtree_levels_by_level(self.root, field, 'default')])
+
+        def test_cycle_raises(self):
+            Page.objects.filter(pk=self.root.pk).update(parent=self.d.pk, mark_changed=False)
+            field = Page._meta.get_field('parent')
+            self.failUnlessRaises(PublishException, Page.objects.all().subtree_levels, self.a)
+            self.failUnlessRaises(PublishException, Page.objects.all()._subtree_levels_by_level,
+                                  self.a, field, 'default')
+            self.failUnlessRaises(PublishException, Page.objects.publish_subtree, self.a)
+
+        def test_max_depth(self):
+            field = Page._meta.get_field('parent')
+            queryset = Page.objects.all()
+            queryset.subtree_max_depth = 3
+            self.failUnlessEqual(4, len(queryset.subtree_levels(self.root)))
+            self.failUnlessEqual(4, len(queryset._subtree_levels_by_level(self.root, field, 'default')))
+            queryset.subtree_max_depth = 2
+            self.failUnlessRaises(PublishException, queryset.subtree_levels, self.root)
+            self.failUnlessRaises(PublishException, queryset._subtree_levels_by_level, self.root, field, 'default')
+
+        def test_publish_subtree(self):
+            published = []
+            def record(sender, instance, **kw):
+                published.append(instance.slug)
+            pre_publish.connect(record, sender=Page)
+            try:
+                Page.objects.publish_subtree(self.root)
+            finally:
+                pre_publish.disconnect(record, sender=Page)
+
+            self.failUnlessEqual(['root', 'a', 'b', 'c', 'd'], published)
+            self.failUnlessEqual(['a', 'b', 'c', 'd', 'root'], [p.slug for p in Page.objects.published()])
+
+            public_d = Page.objects.published().get(slug='d')
+            self.failUnlessEqual('c', public_d.parent.slug)
+            self.failUnless(public_d.parent.is_public)
+
+        def test_publish_subtree_only_publishes_once(self):
+            runs = []
+            def record(sender, all_published, **kw):
+                runs.append(len(all_published))
+            post_publish_run.connect(record)
+            try:
+                Page.objects.publish_subtree(self.a)
+            finally:
+                post_publish_run.disconnect(record)
+            # a, c, d and the root (as a's parent)
+            self.failUnlessEqual([4], runs)
+
+        def test_publish_subtree_dry_run(self):
+            all_published = Page.objects.publish_subtree(self.a, dry_run=True)
+            self.failUnlessEqual(0, Page.objects.published().count())
+            self.failUnlessEqual(set(['root', 'a', 'c', 'd']), set(p.slug for p in all_published))
+
+        def test_public_root(self):
+            self.root.publish()
+            public = Page.objects.published().get(slug='root')
+            self.failUnlessRaises(PublishException, Page.objects.publish_subtree, public)
+
+
+    class TestPublishTree(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishTree, self).setUp()
+            self.root = Folder.objects.create(name='root')
+            self.a = Folder.objects.create(name='a', parent=self.root)
+            self.b = Folder.objects.create(name='b', parent=self.root)
+            self.c = Folder.objects.create(name='c', parent=self.a)
+            self.d = Folder.objects.create(name='d', parent=self.c)
+
+        def _names(self, queryset):
+            return [f.name for f in queryset]
+
+        def test_ancestors(self):
+            with self.assertNumQueries(1):
+                self.failUnlessEqual(['root', 'a', 'c'], self._names(PublishTreeClosure.objects.ancestors(self.d)))
+            self.failUnlessEqual(['root', 'a', 'c', 'd'],
+                                 self._names(PublishTreeClosure.objects.ancestors(self.d, include_self=True)))
+            self.failUnlessEqual([], self._names(PublishTreeClosure.objects.ancestors(self.root)))
+
+        def test_descendants(self):
+            with self.assertNumQueries(1):
+                descendants = self._names(PublishTreeClosure.objects.descendants(self.root))
+            self.failUnlessEqual(['a', 'b'], sorted(descendants[:2]))
+            self.failUnlessEqual(['c', 'd'], descendants[2:])
+            self.failUnlessEqual(['c', 'd'], self._names(PublishTreeClosure.objects.descendants(self.a).filter(name__in=['c', 'd'])))
+
+        def test_move(self):
+            self.a.parent = self.b
+            self.a.save()
+            self.failUnlessEqual(['root', 'b', 'a', 'c'], self._names(PublishTreeClosure.objects.ancestors(self.d)))
+            self.failUnlessEqual(['a', 'c', 'd'], self._names(PublishTreeClosure.objects.descendants(self.b)))
+
+            self.a.parent = None
+            self.a.save()
+            self.failUnlessEqual(['a', 'c'], self._names(PublishTreeClosure.objects.ancestors(self.d)))
+            self.failUnlessEqual(['b'], self._names(PublishTreeClosure.objects.descendants(self.root)))
+
+        def test_unchanged_save(self):
+            with self.assertNumQueries(3):
+                # exists check, update and the closure check
+                self.c.save()
+
+        def test_move_under_descendant(self):
+            before = set(PublishTreeClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+            self.a.parent = self.d
+            self.failUnlessRaises(PublishException, self.a.save)
+            self.failUnlessRaises(PublishException, Folder.objects.filter(pk=self.a.pk).update, parent=self.d)
+            self.failUnlessRaises(PublishException, Folder.objects.filter(pk=self.a.pk).update, parent=self.a.pk)
+            self.failUnlessEqual(self.root.pk, Folder.objects.get(pk=self.a.pk).parent_id)
+            self.failUnlessEqual(before, set(PublishTreeClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')))
+
+        def test_rebuild_cycle(self):
+            QuerySet(Folder).filter(pk=self.a.pk).update(parent=self.d)
+            self.failUnlessRaises(PublishException, PublishTreeClosure.objects.rebuild, Folder)
+            # nothing was thrown away
+            self.failUnlessEqual(['root', 'a', 'c'], self._names(PublishTreeClosure.objects.ancestors(self.d)))
+
+        def test_public_tree(self):
+            self.d.publish()
+            public_d = Folder.objects.published().get(name='d')
+            ancestors = list(PublishTreeClosure.objects.ancestors(public_d))
+            self.failUnlessEqual(['root', 'a', 'c'], self._names(ancestors))
+            for folder in ancestors:
+                self.failUnless(folder.is_public)
+            # the draft tree is unchanged
+            self.failUnlessEqual(['root', 'a', 'c'], self._names(PublishTreeClosure.objects.ancestors(self.d)))
+
+        def test_delete(self):
+            self.c.delete(mark_for_deletion=False)
+            self.failUnlessEqual(['a', 'b'], sorted(self._names(PublishTreeClosure.objects.descendants(self.root))))
+            self.failIf(PublishTreeClosure.objects.filter(descendant_id=self.d.pk).exists())
+
+        def test_rebuild(self):
+            before = set(PublishTreeClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+            PublishTreeClosure.objects.all().delete()
+            PublishTreeClosure.objects.rebuild(Folder)
+            self.failUnlessEqual(before, set(PublishTreeClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')))
+
+        def test_subtree_levels_from_closure(self):
+            with self.assertNumQueries(1):
+                levels = Folder.objects.all().subtree_levels(self.root)
+            self.failUnlessEqual([[self.root.pk], sorted([self.a.pk, self.b.pk]), [self.c.pk], [self.d.pk]],
+                                 [sorted(level) for level in levels])
+
+
+    class TestPublishableInlineFormSet(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPublishableInlineFormSet, self).setUp()
+            self.page = Page.objects.create(slug='page', title='Page')
+            self.blocks = [PageBlock.objects.create(page=self.page, content='block %d' % i) for i in range(6)]
+            self.page.publish()
+            self.page = Page.objects.get(pk=self.page.pk)
+            self.FormSet = inlineformset_factory(Page, PageBlock, formset=PublishableBaseInlineFormSet,
+                                                 fields=['content'], extra=0)
+
+        def _data(self, deleted=(), changed=()):
+            data = {
+                'pageblock_set-TOTAL_FORMS': str(len(self.blocks)),
+                'pageblock_set-INITIAL_FORMS': str(len(self.blocks)),
+                'pageblock_set-MAX_NUM_FORMS': '',
+            }
+            for i, block in enumerate(self.blocks):
+                prefix = 'pageblock_set-%d-' % i
+                data[prefix + 'id'] = str(block.pk)
+                data[prefix + 'page'] = str(self.page.pk)
+                data[prefix + 'content'] = block.content
+                if i in changed:
+                    data[prefix + 'content'] = 'changed %d' % i
+                if i in deleted:
+                    data[prefix + 'DELETE'] = 'on'
+            return data
+
+        def test_deleted_and_changed(self):
+            formset = self.FormSet(self._data(deleted=[0, 2, 4], changed=[1]), instance=self.page)
+            self.failUnless(formset.is_valid())
+            formset.save()
+
+            drafts = PageBlock.objects.draft().order_by('pk')
+            self.failUnlessEqual(['changed 1', 'block 3', 'block 5'], [b.content for b in drafts])
+            self.failUnlessEqual(PageBlock.PUBLISH_CHANGED, drafts[0].publish_state)
+            self.failUnlessEqual(PageBlock.PUBLISH_DEFAULT, drafts[1].publish_state)
+            # deleted outright, not marked for deletion
+            self.failUnlessEqual(0, PageBlock.objects.deleted().count())
+            self.failUnlessEqual(3, len(formset.deleted_objects))
+
+            # publishing the page removes the public copies
+            Page.objects.get(pk=self.page.pk).publish()
+            self.failUnlessEqual(['block 3', 'block 5', 'changed 1'],
+                                 sorted(b.content for b in PageBlock.objects.published()))
+
+        def test_delete_is_batched(self):
+            formset = self.FormSet(self._data(deleted=range(6)), instance=self.page)
+            self.failUnless(formset.is_valid())
+            # a lookup per form (to check its pk), django marking each
+            # for deletion, then one collect and delete for all of them
+            with self.assertNumQueries(27):
+                formset.save()
+            self.failUnlessEqual(0, PageBlock.objects.draft().count())
+
+        def test_delete_uses_objects_database(self):
+            page = Page.objects.using('public').create(slug='other', title='Other', is_public=True)
+            block = PageBlock.objects.using('public').create(page=page, content='other block', is_public=True)
+            formset = self.FormSet(instance=self.page)
+            formset.delete_existing_objects([block])
+            self.failIf(PageBlock.objects.using('public').filter(pk=block.pk).exists())
+            self.failUnlessEqual(6, PageBlock.objects.draft().count())
+
+        def test_changed_saved_with_one_update(self):
+            formset = self.FormSet(self._data(changed=[1]), instance=self.page)
+            self.failUnless(formset.is_valid())
+            # a lookup per form, then just an update (including
+            # publish_state) for the changed block
+            with self.assertNumQueries(7):
+                formset.save()
+            self.failUnlessEqual(PageBlock.PUBLISH_CHANGED, PageBlock.objects.get(pk=self.blocks[1].pk).publish_state)
+
+
+    class TestPropagateChanges(TransactionTestCase):
+
+        def setUp(self):
+            super(TestPropagateChanges, self).setUp()
+            self.gallery = Gallery.objects.create(title='Gallery')
+            self.image = GalleryImage.objects.create(gallery=self.gallery, caption='one')
+            self.gallery.publish()
+            self.image = GalleryImage.objects.draft().get()
+
+        def _gallery_state(self):
+            return Gallery.objects.get(pk=self.gallery.pk).publish_state
+
+        def test_published_parent_unchanged(self):
+            self.failUnlessEqual(Gallery.PUBLISH_DEFAULT, self._gallery_state())
+
+        def test_child_save_marks_parent_changed(self):
+            self.image.caption = 'changed'
+            # the save (a select and an update) and one update of the parent
+            with self.assertNumQueries(3):
+                self.image.save()
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, self._gallery_state())
+            self.failUnlessEqual(Gallery.PUBLISH_DEFAULT, Gallery.objects.published().get().publish_state)
+
+        def test_new_child_marks_parent_changed(self):
+            GalleryImage.objects.create(gallery=self.gallery, caption='two')
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, self._gallery_state())
+
+        def test_mark_for_deletion_marks_parent_changed(self):
+            self.image.delete()
+            self.failUnlessEqual(GalleryImage.PUBLISH_DELETE, GalleryImage.objects.get(pk=self.image.pk).publish_state)
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, self._gallery_state())
+
+        def test_undelete_marks_parent_changed(self):
+            self.image.delete()
+            self.gallery.publish_state = Gallery.PUBLISH_DEFAULT
+            self.gallery.save(mark_changed=False)
+            self.image.undelete()
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, self._gallery_state())
+
+        def test_publish_leaves_parent_published(self):
+            self.image.caption = 'changed'
+            self.image.save()
+            Gallery.objects.draft().get().publish()
+            self.failUnlessEqual(Gallery.PUBLISH_DEFAULT, self._gallery_state())
+            self.failUnlessEqual('changed', GalleryImage.objects.published().get().caption)
+
+        def test_parent_marked_for_deletion_untouched(self):
+            Gallery.objects.filter(pk=self.gallery.pk).update(publish_state=Gallery.PUBLISH_DELETE)
+            self.image.caption = 'changed'
+            self.image.save()
+            self.failUnlessEqual(Gallery.PUBLISH_DELETE, self._gallery_state())
+
+        def test_not_propagated_without_flag(self):
+            page = Page.objects.create(slug='page', title='Page')
+            block = PageBlock.objects.create(page=page, content='block')
+            page.publish()
+            block = PageBlock.objects.draft().get()
+            block.content = 'changed'
+            block.save()
+            self.failUnlessEqual(Page.PUBLISH_DEFAULT, Page.objects.draft().get().publish_state)
+
+
+    class TestPublishMetrics(SettingsTestCase):
+
+        def setUp(self):
+            super(TestPublishMetrics, self).setUp()
+            self.set_setting('PUBLISH_METRICS', 'publish.metrics.InMemoryMetrics')
+            self.metrics = get_metrics()
+            self.metrics.reset()
+
+        def test_disabled_by_default(self):
+            self.set_setting('PUBLISH_METRICS', None)
+            self.failUnless(get_metrics() is None)
+            FlatPage.objects.create(url='/', title='Home').publish()
+
+        def test_run_recorded(self):
+            page = Page.objects.create(slug='page', title='Page')
+            PageBlock.objects.create(page=page, content='one')
+            PageBlock.objects.create(page=page, content='two')
+            page.publish()
+
+            self.failUnlessEqual(1, self.metrics.value('publish_runs_total', model='publish.Page', action='publish'))
+            self.failUnlessEqual(0, self.metrics.value('publish_run_failures_total', model='publish.Page', action='publish'))
+            self.failUnlessEqual(3, self.metrics.value('publish_rows_written_total', model='publish.Page', action='publish'))
+            self.failUnlessEqual(2, self.metrics.value('publish_object_duration_seconds', model='publish.PageBlock'))
+            histogram = self.metrics._values['publish_run_nodes'][(('model', 'publish.Page'), ('action', 'publish'))]
+            self.failUnlessEqual(3, histogram.sum)
+            queries = self.metrics._values['publish_run_queries'][(('model', 'publish.Page'), ('action', 'publish'))]
+            self.failUnless(queries.sum > 0)
+
+        def test_queries_counted_as_assert_num_queries_does(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            with self.assertNumQueries(5):
+                flat_page.publish()
+            queries = self.metrics._values['publish_run_queries'][(('model', 'publish.FlatPage'), ('action', 'publish'))]
+            self.failUnlessEqual(5, queries.sum)
+
+        def test_queries_not_kept(self):
+            queries = len(connection.queries)
+            counter = _QueryCounter()
+            FlatPage.objects.count()
+            # not even while counting
+            self.failUnlessEqual(queries, len(connection.queries))
+            self.failUnlessEqual(1, counter.stop())
+            self.failIf('make_debug_cursor' in connection.__dict__)
+
+        def test_unchanged_skipped(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            flat_page.publish()
+            self.failUnlessEqual(2, self.metrics.value('publish_runs_total', model='publish.FlatPage', action='publish'))
+            self.failUnlessEqual(1, self.metrics.value('publish_rows_written_total', model='publish.FlatPage', action='publish'))
+            self.failUnlessEqual(1, self.metrics.value('publish_skipped_total', model='publish.FlatPage', action='publish'))
+
+        def test_dry_run_not_recorded(self):
+            FlatPage.objects.create(url='/', title='Home').publish(dry_run=True)
+            self.failUnlessEqual(0, self.metrics.value('publish_runs_total', model='publish.FlatPage', action='publish'))
+
+        def test_queryset_is_one_run(self):
+            FlatPage.objects.create(url='/1', title='One')
+            FlatPage.objects.create(url='/2', title='Two')
+            FlatPage.objects.draft().publish()
+            self.failUnlessEqual(1, self.metrics.value('publish_runs_total', model='publish.FlatPage', action='publish'))
+            self.failUnlessEqual(2, self.metrics.value('publish_rows_written_total', model='publish.FlatPage', action='publish'))
+
+        def test_deletions_and_unpublish(self):
+            one = FlatPage.objects.create(url='/1', title='One')
+            two = FlatPage.objects.create(url='/2', title='Two')
+            FlatPage.objects.draft().publish()
+            one = FlatPage.objects.get(pk=one.pk)
+            one.delete()
+            one.publish()
+            FlatPage.objects.get(pk=two.pk).unpublish()
+            self.failUnlessEqual(3, self.metrics.value('publish_rows_written_total', model='publish.FlatPage', action='publish'))
+            self.failUnlessEqual(1, self.metrics.value('publish_runs_total', model='publish.FlatPage', action='unpublish'))
+            self.failUnlessEqual(1, self.metrics.value('publish_rows_written_total', model='publish.FlatPage', action='unpublish'))
+
+        def test_failure_recorded(self):
+            article = Article.objects.create(title='Article')
+            Article.objects.filter(pk=article.pk).update(version=5)
+            self.failUnlessRaises(VersionConflict, article.publish)
+            self.failUnlessEqual(1, self.metrics.value('publish_run_failures_total', model='publish.Article', action='publish'))
+
+        def test_prometheus_view(self):
+            FlatPage.objects.create(url='/', title='Home').publish()
+            response = metrics_view(None)
+            self.failUnless(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+            lines = response.content.splitlines()
+            self.failUnless('# TYPE publish_runs_total counter' in lines)
+            self.failUnless('publish_runs_total{model="publish.FlatPage",action="publish"} 1' in lines)
+            self.failUnless('publish_run_nodes_bucket{model="publish.FlatPage",action="publish",le="1"} 1' in lines)
+            self.failUnless('publish_run_nodes_bucket{model="publish.FlatPage",action="publish",le="+Inf"} 1' in lines)
+            self.failUnless('publish_run_nodes_count{model="publish.FlatPage",action="publish"} 1' in lines)
+
+        def test_view_needs_in_memory_backend(self):
+            self.set_setting('PUBLISH_METRICS', 'publish.metrics.PublishMetrics')
+            self.failUnlessRaises(Http404, metrics_view, None)
+
+
+    class TestExplainSlowQueries(SettingsTestCase):
+
+        def setUp(self):
+            super(TestExplainSlowQueries, self).setUp()
+            # explain everything
+            self.set_setting('PUBLISH_EXPLAIN_THRESHOLD', -1)
+            self.reports_before = len(recent_reports())
+
+        def _report(self):
+            return recent_reports()[-1]
+
+        def test_disabled_by_default(self):
+            self.set_setting('PUBLISH_EXPLAIN_THRESHOLD', None)
+            reports = recent_reports()
+            FlatPage.objects.create(url='/', title='Home').publish()
+            self.failUnlessEqual(reports, recent_reports())
+
+        def test_statements_recorded(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            report = self._report()
+            self.failUnlessEqual(FlatPage, report.model)
+            self.failUnlessEqual('publish', report.action)
+            # the same as TestPublishQueryBudget
+            self.failUnlessEqual(5, len(report.statements))
+            self.failIf(report.failed)
+
+        def test_grouped_by_table(self):
+            page = Page.objects.create(slug='page', title='Page')
+            PageBlock.objects.create(page=page, content='one')
+            page.publish()
+            tables = dict(self._report().by_table())
+            self.failUnless('publish_page' in tables)
+            self.failUnless('publish_pageblock' in tables)
+            for statement in tables['publish_pageblock']:
+                self.failUnless('publish_pageblock' in statement.sql)
+
+        def test_slow_statements_explained(self):
+            FlatPage.objects.create(url='/', title='Home').publish()
+            report = self._report()
+            for statement in report.statements:
+                verb = statement.sql.split()[0]
+                if verb in ('SELECT', 'UPDATE', 'DELETE'):
+                    self.failUnless(statement.plan, statement.sql)
+                else:
+                    self.failUnless(statement.plan is None)
+            self.failUnless(report.as_text().startswith('publish of publish.FlatPage: 5 statements'))
+
+        def test_under_threshold_not_explained(self):
+            self.set_setting('PUBLISH_EXPLAIN_THRESHOLD', 60)
+            FlatPage.objects.create(url='/', title='Home').publish()
+            report = self._report()
+            self.failUnlessEqual([], report.slow_statements)
+            self.failUnlessEqual([None] * 5, [s.plan for s in report.statements])
+
+        def test_unpublish(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            flat_page = FlatPage.objects.get(pk=flat_page.pk)
+            flat_page.unpublish()
+            report = self._report()
+            self.failUnlessEqual('unpublish', report.action)
+            self.failUnless(report.statements)
+
+        def test_queries_not_kept(self):
+            connection = connections[DEFAULT_DB_ALIAS]
+            before = len(connection.queries)
+            FlatPage.objects.create(url='/', title='Home').publish()
+            self.failUnlessEqual(before, len(connection.queries))
+
+
+    class TestEstimatePublish(SettingsTestCase):
+
+        def setUp(self):
+            super(TestEstimatePublish, self).setUp()
+            self.page = Page.objects.create(slug='page', title='Page')
+            for i in range(5):
+                PageBlock.objects.create(page=self.page, content='block %d' % i)
+            self.pages = Page.objects.filter(pk=self.page.pk)
+
+        def test_within_budget_is_exact(self):
+            estimate = estimate_publish(self.pages, max_nodes=100)
+            self.failUnless(estimate.complete)
+            self.failUnlessEqual([(Page, 1, True), (PageBlock, 5, True)], estimate.models)
+            self.failUnlessEqual(6, estimate.nodes)
+            self.failUnlessEqual(6, estimate.changed)
+            self.failUnlessEqual(6, len(estimate.all_published))
+            self.failUnless(estimate.queries > estimate.dry_run_queries)
+            self.failUnlessEqual(0, Page.objects.published().count())
+
+        def test_unchanged_not_counted_as_changes(self):
+            self.page.publish()
+            estimate = estimate_publish(self.pages)
+            self.failUnless(estimate.complete)
+            self.failUnlessEqual(6, estimate.nodes)
+            self.failUnlessEqual(0, estimate.changed)
+
+        def test_node_budget(self):
+            estimate = estimate_publish(self.pages, max_nodes=3)
+            self.failIf(estimate.complete)
+            self.failUnlessEqual(3, len(estimate.all_published))
+            # the counts come from count queries
+            self.failUnlessEqual([(Page, 1, False), (PageBlock, 5, False)], estimate.models)
+            self.failUnlessEqual(6, estimate.changed)
+
+        def test_related_counts_are_upper_bounds(self):
+            other = Page.objects.create(slug='other', title='Other')
+            PageBlock.objects.create(page=other, content='other block')
+            estimate = estimate_publish(self.pages, max_nodes=3)
+            # blocks are counted across the whole table, the selected pages aren't
+            self.failUnlessEqual([(Page, 1, False), (PageBlock, 6, False)], estimate.models)
+            self.failUnlessEqual([('pages', 1, False, False), ('page blocks', 6, False, True)],
+                                 [(unicode(name), count, exact, upper_bound)
+                                  for name, count, exact, upper_bound in estimate.model_counts])
+
+        def test_time_budget(self):
+            estimate = estimate_publish(self.pages, max_seconds=-1)
+            self.failIf(estimate.complete)
+            self.failUnlessEqual(0, len(estimate.all_published))
+            self.failUnlessEqual(6, estimate.nodes)
+
+        def test_compact(self):
+            estimate = estimate_publish(self.pages, max_nodes=100, compact=True)
+            self.failUnless(isinstance(estimate.all_published, CompactNestedSet))
+            self.failUnlessEqual([(Page, 1, True), (PageBlock, 5, True)], estimate.models)
+
+        def _admin(self, **kw):
+            page_admin = PublishableAdmin(Page, _admin_site(Page))
+            for name, value in kw.items():
+                setattr(page_admin, name, value)
+            return page_admin
+
+        def test_confirmation_page_shows_estimate(self):
+            page_admin = self._admin(dry_run_max_nodes=3)
+            response = publish_selected(page_admin, _dummy_request({}), self.pages)
+            self.failUnlessEqual(200, response.status_code)
+            self.failUnless('published in the background' in response.content)
+            self.failUnless('about 1' in response.content)
+            self.failUnless('up to 5' in response.content)
+
+        def test_oversized_published_in_background(self):
+            page_admin = self._admin(dry_run_max_nodes=3)
+            request = _dummy_request({'post': True})
+            response = publish_selected(page_admin, request, self.pages)
+            self.failUnless(response is None)
+            self.failUnless('background' in request.messages[-1][1])
+            self.failUnlessEqual(0, Page.objects.published().count())
+            self.failUnlessEqual([self.page], [s.content_object for s in PublishSchedule.objects.due()])
+            self.failUnlessEqual(['Scheduled to be published'], [e.change_message for e in LogEntry.objects.all()])
+
+            PublishSchedule.objects.run_due()
+            self.failUnlessEqual(1, Page.objects.published().count())
+            self.failUnlessEqual(5, PageBlock.objects.published().count())
+
+        def test_background_schedule_time_zone_aware(self):
+            self.set_setting('USE_TZ', True)
+            page_admin = self._admin(dry_run_max_nodes=3)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                publish_selected(page_admin, _dummy_request({'post': True}), self.pages)
+            self.failUnlessEqual([], [str(w.message) for w in caught if 'naive datetime' in str(w.message)])
+            self.failUnlessEqual([self.page], [s.content_object for s in PublishSchedule.objects.due()])
+
+        def test_oversized_checks_models_not_visited(self):
+            page_admin = self._admin(dry_run_max_nodes=1)
+            page_admin.admin_site.register(PageBlock, PublishableAdmin)
+            request = _dummy_request({'post': True}, denied=['publish.publish_pageblock'])
+            self.failUnlessRaises(PermissionDenied, publish_selected, page_admin, request, self.pages)
+            self.failUnlessEqual(0, PublishSchedule.objects.count())
+
+            response = publish_selected(page_admin, _dummy_request({}, denied=['publish.publish_pageblock']), self.pages)
+            self.failUnless('Page blocks' in response.content)
+
+        def test_within_budget_published(self):
+            page_admin = self._admin(dry_run_max_nodes=100)
+            response = publish_selected(page_admin, _dummy_request({'post': True}), self.pages)
+            self.failUnless(response is None)
+            self.failUnlessEqual(1, Page.objects.published().count())
+            self.failUnlessEqual(0, PublishSchedule.objects.count())
+
+
+    class TestPublishableBulkWrites(TransactionTestCase):
+
+        def test_update_marks_changed(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            # one update for the public rows and one for the drafts
+            with self.assertNumQueries(2):
+                self.failUnlessEqual(2, FlatPage.objects.all().update(title='Changed'))
+            draft = FlatPage.objects.draft().get()
+            self.failUnlessEqual('Changed', draft.title)
+            self.failUnlessEqual(FlatPage.PUBLISH_CHANGED, draft.publish_state)
+            public = FlatPage.objects.published().get()
+            self.failUnlessEqual('Changed', public.title)
+            self.failUnlessEqual(FlatPage.PUBLISH_DEFAULT, public.publish_state)
+
+        def test_update_published(self):
+            FlatPage.objects.create(url='/', title='Home').publish()
+            self.failUnlessEqual(1, FlatPage.objects.published().update(title='Changed'))
+            self.failUnlessEqual('Changed', FlatPage.objects.published().get().title)
+            self.failUnlessEqual(FlatPage.PUBLISH_DEFAULT, FlatPage.objects.draft().get().publish_state)
+
+        def test_update_skips_marked_for_deletion(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            FlatPage.objects.get(pk=flat_page.pk).delete()
+            self.failUnlessEqual(0, FlatPage.objects.filter(pk=flat_page.pk).update(title='Changed'))
+            draft = FlatPage.objects.get(pk=flat_page.pk)
+            self.failUnlessEqual('Home', draft.title)
+            self.failUnlessEqual(FlatPage.PUBLISH_DELETE, draft.publish_state)
+
+        def test_update_marks_parents_changed(self):
+            gallery = Gallery.objects.create(title='Gallery')
+            GalleryImage.objects.create(gallery=gallery, caption='one')
+            gallery.publish()
+            self.failUnlessEqual(1, GalleryImage.objects.draft().update(caption='two'))
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, Gallery.objects.draft().get().publish_state)
+
+        def test_update_moves_tree_nodes(self):
+            root = Folder.objects.create(name='root')
+            a = Folder.objects.create(name='a', parent=root)
+            b = Folder.objects.create(name='b', parent=a)
+            Folder.objects.filter(pk=b.pk).update(parent=root)
+            self.failUnlessEqual(['a', 'b'], sorted(f.name for f in PublishTreeClosure.objects.descendants(root)))
+            self.failIf(PublishTreeClosure.objects.descendants(a))
+
+        def test_update_without_marking_changed(self):
+            flat_page = FlatPage.objects.create(url='/', title='Home')
+            flat_page.publish()
+            self.failUnlessEqual(2, FlatPage.objects.all().update(title='Changed', mark_changed=False))
+            self.failUnlessEqual(FlatPage.PUBLISH_DEFAULT, FlatPage.objects.draft().get().publish_state)
+            self.failUnlessEqual('Changed', FlatPage.objects.published().get().title)
+
+        def test_update_publish_state(self):
+            FlatPage.objects.create(url='/', title='Home')
+            FlatPage.objects.update(publish_state=FlatPage.PUBLISH_DEFAULT)
+            self.failUnlessEqual(FlatPage.PUBLISH_DEFAULT, FlatPage.objects.get().publish_state)
+
+        def test_bulk_create_marks_changed(self):
+            FlatPage.objects.bulk_create([FlatPage(url='/1', title='One', publish_state=FlatPage.PUBLISH_DEFAULT),
+                                          FlatPage(url='/2', title='Two')])
+            self.failUnlessEqual([FlatPage.PUBLISH_CHANGED] * 2,
+                                 [p.publish_state for p in FlatPage.objects.order_by('url')])
+
+        def test_bulk_create_marks_parents_changed(self):
+            gallery = Gallery.objects.create(title='Gallery')
+            gallery.publish()
+            GalleryImage.objects.bulk_create([GalleryImage(gallery=gallery, caption='one')])
+            self.failUnlessEqual(Gallery.PUBLISH_CHANGED, Gallery.objects.draft().get().publish_state)
+
+        def test_bulk_create_tree_nodes(self):
+            root = Folder.objects.create(name='root')
+            Folder.objects.bulk_create([Folder(pk=100, name='a', parent=root), Folder(pk=101, name='b', parent_id=100)])
+            self.failUnlessEqual(['a', 'b'], sorted(f.name for f in PublishTreeClosure.objects.descendants(root)))
+            self.failUnlessRaises(PublishException, Folder.objects.bulk_create, [Folder(name='c', parent=root)])
+
+        def test_bulk_create_refuses_marked_for_deletion(self):
+            self.failUnlessRaises(PublishException, FlatPage.objects.bulk_create,
+                                  [FlatPage(url='/1', title='One', publish_state=FlatPage.PUBLISH_DELETE)])
+            self.failUnlessEqual(0, FlatPage.objects.count())
+
+        def test_bulk_create_and_publish(self):
+            drafts = FlatPage.objects.bulk_create_and_publish([FlatPage(pk=10, url='/1', title='One'),
+                                                               FlatPage(url='/2', title='Two')])
+            self.failUnlessEqual(['One', 'Two'], sorted(d.title for d in drafts))
+            for draft in drafts:
+                self.failUnlessEqual(FlatPage.PUBLISH_DEFAULT, draft.publish_state)
+                self.failUnlessEqual(draft.title, draft.public.title)
+            self.failUnlessEqual(['/1', '/2'], sorted(p.url for p in FlatPage.objects.published()))
+            self.failUnlessEqual(0, FlatPage.objects.changed().count())
+
+        def test_bulk_create_and_publish_refuses_public(self):
+            self.failUnlessRaises(PublishException, FlatPage.objects.bulk_create_and_publish,
+                                  [FlatPage(url='/1', title='One', is_public=True)])
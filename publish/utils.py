@@ -1,3 +1,5 @@
+from django.contrib.contenttypes.models import ContentType
+
 
 class NestedSet(object):
     '''
@@ -50,3 +52,88 @@ class NestedSet(object):
         items = []
         self._add_nested_items(self._root_elements, items)
         return items
+
+
+class CompactNestedSet(NestedSet):
+    '''
+        a NestedSet for model instances that only keeps a
+        (content type id, pk) key for each item, rather than
+        the item itself - handy for large dry runs.
+
+        items are loaded from the database again (in batches)
+        when iterating or calling nested_items()
+    '''
+
+    batch_size = 500
+
+    def __init__(self, batch_size=None):
+        super(CompactNestedSet, self).__init__()
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self._content_type_ids = {}
+
+    def _key(self, item):
+        model = item.__class__
+        content_type_id = self._content_type_ids.get(model)
+        if content_type_id is None:
+            content_type_id = ContentType.objects.get_for_model(model).id
+            self._content_type_ids[model] = content_type_id
+        return (content_type_id, item.pk)
+
+    def add(self, item, parent=None):
+        if parent is not None:
+            parent = self._key(parent)
+        super(CompactNestedSet, self).add(self._key(item), parent=parent)
+
+    def __contains__(self, item):
+        return self._key(item) in self._children
+
+    def __iter__(self):
+        for batch in self._batches(self._children):
+            for item in self._load(batch).values():
+                yield item
+
+    def original(self, item):
+        # we don't keep the original items around
+        return item
+
+    def keys(self):
+        return self._children.keys()
+
+    def nested_items(self):
+        nested_keys = super(CompactNestedSet, self).nested_items()
+        loaded = {}
+        for batch in self._batches(self._children):
+            loaded.update(self._load(batch))
+        return self._replace_keys(nested_keys, loaded)
+
+    def _replace_keys(self, nested_keys, loaded):
+        items = []
+        for key in nested_keys:
+            if isinstance(key, list):
+                items.append(self._replace_keys(key, loaded))
+            elif key in loaded:
+                items.append(loaded[key])
+        return items
+
+    def _batches(self, keys):
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _load(self, keys):
+        pks_by_content_type = {}
+        for content_type_id, pk in keys:
+            pks_by_content_type.setdefault(content_type_id, []).append(pk)
+
+        loaded = {}
+        for content_type_id, pks in pks_by_content_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            for pk, item in model._default_manager.in_bulk(pks).items():
+                loaded[(content_type_id, pk)] = item
+        return loaded